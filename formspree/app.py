@@ -2,7 +2,7 @@ import json
 import stripe
 import structlog
 
-from flask import Flask, g, request, redirect
+from flask import Flask, g, request, redirect, has_request_context
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import LoginManager, current_user
 from flask.ext.cdn import CDN
@@ -10,6 +10,10 @@ from flask_redis import Redis
 from flask_limiter import Limiter
 from flask_limiter.util import get_ipaddr
 import settings
+import outbound
+import instrumentation
+import metrics
+import ratelimit
 
 DB = SQLAlchemy()
 redis_store = Redis()
@@ -17,7 +21,7 @@ stripe.api_key = settings.STRIPE_SECRET_KEY
 cdn = CDN()
 
 import routes
-from users.models import User
+from users import cache as user_cache
 
 def configure_login(app):
     login_manager = LoginManager()
@@ -26,7 +30,7 @@ def configure_login(app):
 
     @login_manager.user_loader
     def load_user(id):
-        return User.query.get(int(id))
+        return user_cache.get(int(id))
 
     @app.before_request
     def before_request():
@@ -63,7 +67,7 @@ def configure_logger(app):
         return '\x1b[{clr}m{met}\x1b[0m [\x1b[35m{rid}\x1b[0m] {msg} {rest}'.format(
             clr=levelcolor,
             met=method.upper(),
-            rid=request.headers.get('X-Request-Id', '~'),
+            rid=request.headers.get('X-Request-Id', '~') if has_request_context() else '~',
             msg=event.pop('event'),
             rest=' '.join(['\x1b[%sm%s\x1b[0m=%s' % (levelcolor, k.upper(), v)
                            for k, v in event.items()])
@@ -92,6 +96,9 @@ def create_app():
     routes.configure_routes(app)
     configure_login(app)
     configure_logger(app)
+    instrumentation.configure(app, redis_store)
+    metrics.configure(app)
+    ratelimit.configure(app)
 
     app.jinja_env.filters['json'] = json.dumps
     app.config['CDN_DOMAIN'] = settings.CDN_URL
@@ -100,12 +107,23 @@ def create_app():
 
     if not app.debug and not app.testing:
         configure_ssl_redirect(app)
+        outbound.warm()
 
-    Limiter(
+    limiter = Limiter(
         app,
         key_func=get_ipaddr,
         global_limits=[settings.RATE_LIMIT],
         storage_uri=settings.REDIS_RATE_LIMIT
     )
+    # SendGrid posts batches of events from a handful of addresses all day
+    limiter.exempt(routes.forms.views.sendgrid_webhook)
+    ratelimit.exempt(routes.forms.views.sendgrid_webhook)
+
+    # pages that cost nothing to serve are only guarded by the local buckets
+    for view in (routes.static_pages.views.default,
+                 routes.static_pages.views.favicon,
+                 routes.static_pages.views.formspree_verify,
+                 routes.forms.views.thanks):
+        limiter.exempt(view)
 
     return app
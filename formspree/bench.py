@@ -0,0 +1,242 @@
+import json
+import time
+import threading
+import structlog
+from collections import OrderedDict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from sqlalchemy import event
+
+from formspree import settings, create_app
+from formspree.app import DB, redis_store
+from formspree.forms.helpers import MONTHLY_COUNTER_KEY
+from formspree.forms.models import Form
+
+# A throughput benchmark for the submission endpoint, run with
+# `manage.py bench`. Each scenario posts to its own form through the
+# Flask test client and records the latency, the number of SQL
+# statements and the number of redis calls of every request.
+
+
+def confirmed_form(email):
+    form = Form(email, 'example.com')
+    form.confirmed = True
+    DB.session.add(form)
+    DB.session.commit()
+    return form
+
+
+def setup_confirmed():
+    confirmed_form('bench-confirmed@example.com')
+    return 302, lambda i: ('/bench-confirmed@example.com', dict(
+        headers={'Referer': 'http://example.com'},
+        data={'name': 'bench', 'message': 'submission %s' % i}
+    ))
+
+
+def setup_unconfirmed():
+    form = Form('bench-unconfirmed@example.com', 'example.com')
+    form.confirm_sent = True
+    DB.session.add(form)
+    DB.session.commit()
+    return 200, lambda i: ('/bench-unconfirmed@example.com', dict(
+        headers={'Referer': 'http://example.com'},
+        data={'name': 'bench', 'message': 'submission %s' % i}
+    ))
+
+
+def setup_json():
+    confirmed_form('bench-json@example.com')
+    return 200, lambda i: ('/bench-json@example.com', dict(
+        headers={'Referer': 'http://example.com',
+                 'Accept': 'application/json',
+                 'Content-Type': 'application/json'},
+        data=json.dumps({'name': 'bench', 'message': 'submission %s' % i})
+    ))
+
+
+def setup_overquota():
+    form = confirmed_form('bench-overquota@example.com')
+    key = MONTHLY_COUNTER_KEY(form_id=form.id, month=time.localtime().tm_mon)
+    redis_store.set(key, settings.MONTHLY_SUBMISSIONS_LIMIT + 26)
+    return 402, lambda i: ('/bench-overquota@example.com', dict(
+        headers={'Referer': 'http://example.com'},
+        data={'name': 'bench', 'message': 'submission %s' % i}
+    ))
+
+
+SCENARIOS = OrderedDict([
+    ('confirmed', setup_confirmed),
+    ('unconfirmed', setup_unconfirmed),
+    ('json', setup_json),
+    ('overquota', setup_overquota),
+])
+
+
+class Counter(object):
+    '''
+    Counts SQL statements sent through the engine and calls made
+    through `redis_store` (a pipeline counts once) while active.
+    '''
+
+    def __init__(self):
+        self.queries = 0
+        self.redis = 0
+
+    def __enter__(self):
+        event.listen(DB.engine, 'before_cursor_execute', self.count_query)
+        self.originals = {}
+        for name, method in redis_store.__dict__.items():
+            if hasattr(type(redis_store.connection), name) and not name.startswith('_'):
+                self.originals[name] = method
+                redis_store.__dict__[name] = self.counting(method)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(DB.engine, 'before_cursor_execute', self.count_query)
+        redis_store.__dict__.update(self.originals)
+
+    def count_query(self, *args):
+        self.queries += 1
+
+    def counting(self, method):
+        def wrapper(*args, **kwargs):
+            self.redis += 1
+            return method(*args, **kwargs)
+        return wrapper
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def run(client, requests, scenarios=None, warmup=10):
+    '''
+    Runs the given scenarios (all by default) with `requests` measured
+    requests each, after `warmup` unmeasured ones. Must be called
+    inside an app context, with the tables created.
+    Returns a list of result dicts, one per scenario.
+    '''
+    results = []
+    for name in scenarios or SCENARIOS.keys():
+        expected, make_request = SCENARIOS[name]()
+
+        for i in range(warmup):
+            path, kwargs = make_request(-i)
+            client.post(path, **kwargs)
+
+        latencies = []
+        errors = 0
+        with Counter() as counter:
+            start = time.time()
+            for i in range(requests):
+                path, kwargs = make_request(i)
+                before = time.time()
+                r = client.post(path, **kwargs)
+                latencies.append(time.time() - before)
+                if r.status_code != expected:
+                    errors += 1
+            elapsed = time.time() - start
+
+        results.append({
+            'scenario': name,
+            'requests': requests,
+            'errors': errors,
+            'rps': requests / elapsed,
+            'p50': percentile(latencies, 50) * 1000,
+            'p95': percentile(latencies, 95) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'queries': float(counter.queries) / requests,
+            'redis': float(counter.redis) / requests,
+        })
+    return results
+
+
+def report(results):
+    lines = ['%-12s %8s %7s %9s %9s %9s %9s %9s %7s' % (
+        'scenario', 'requests', 'errors', 'req/s',
+        'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'redis')]
+    for r in results:
+        lines.append('%(scenario)-12s %(requests)8d %(errors)7d %(rps)9.1f '
+                     '%(p50)9.2f %(p95)9.2f %(p99)9.2f %(queries)9.2f %(redis)7.2f' % r)
+    return '\n'.join(lines)
+
+
+class SendGridHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # answer in a single segment, or delayed ACKs add 40ms to every message
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        body = '{"message": "success"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SendGridServer(ThreadingMixIn, HTTPServer):
+    '''
+    A local stand-in for the SendGrid API that accepts every message.
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SendGridHandler)
+        self.url = 'http://127.0.0.1:%s/api/mail.send.json' % self.server_port
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def standalone(database_url, requests, scenarios=None):
+    '''
+    Runs the benchmark in an app of its own, against fakeredis and a
+    local SendGrid stand-in, with rate limiting and quotas out of the
+    way. The tables are created in `database_url`, which must be empty,
+    and dropped at the end.
+    '''
+    import mock
+    import fakeredis
+
+    server = SendGridServer()
+    server.start()
+
+    settings.SQLALCHEMY_DATABASE_URI = database_url
+    settings.SENDGRID_URL = server.url
+    settings.TESTING = True
+    settings.RATELIMIT_ENABLED = False
+    settings.LOCAL_RATE_LIMIT = False
+    settings.REDIS_RATE_LIMIT = 'memory://'
+    settings.MONTHLY_SUBMISSIONS_LIMIT = 10 ** 9
+    with mock.patch('flask_redis.RedisClass', new_callable=fakeredis.FakeStrictRedis):
+        app = create_app()
+
+    with app.app_context():
+        if DB.engine.table_names():
+            server.stop()
+            raise ValueError('%s is not empty, refusing to benchmark on it.' % database_url)
+
+        # request logs would only get in the way
+        structlog.configure(logger_factory=structlog.ReturnLoggerFactory())
+        DB.create_all()
+        try:
+            return run(app.test_client(), requests, scenarios)
+        finally:
+            DB.session.remove()
+            DB.drop_all()
+            server.stop()
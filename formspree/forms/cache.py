@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+
+import redis
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from formspree import settings
+from formspree.app import redis_store
+from helpers import HASHIDS_CODEC, FORM_SNAPSHOT_KEY, \
+                    FORM_SNAPSHOT_GENERATION_KEY, FORM_CACHE_CHANNEL
+from models import Form
+
+# A read-through cache of the few form columns the public submission
+# path needs to accept or reject a submission, so that disabled forms
+# and submissions from the wrong host are answered without touching
+# Postgres.
+#
+# Snapshots are kept in Redis and in a small per-process dict in front
+# of it. Whenever one of the cached columns of a form is committed, its
+# keys are deleted from Redis and published on FORM_CACHE_CHANNEL, so
+# every worker on every node drops its local copy.
+#
+# A request may load a form from Postgres just before another one
+# commits a change to it, and write its snapshot after the invalidation.
+# So every key has a generation, bumped on each invalidation: snapshots
+# are stored with the generation seen before loading them, and ignored
+# when it isn't the current one anymore.
+
+FormSnapshot = namedtuple('FormSnapshot',
+    ['id', 'hash', 'email', 'host', 'sitewide', 'disabled', 'confirmed'])
+
+_local = {}
+_listener_pid = None
+
+
+def snapshot_of(form):
+    return FormSnapshot(**{f: getattr(form, f) for f in FormSnapshot._fields})
+
+
+def get_by_hash(hash):
+    return _get(FORM_SNAPSHOT_KEY(kind='hash', value=hash),
+                lambda: Form.query.filter_by(hash=hash).first())
+
+
+def get_by_hashid(hashid):
+    def load():
+        try:
+            return Form.query.get(HASHIDS_CODEC.decode(hashid)[0])
+        except IndexError:
+            return None
+    return _get(FORM_SNAPSHOT_KEY(kind='hashid', value=hashid), load)
+
+
+def invalidate(id, hash=None):
+    keys = [FORM_SNAPSHOT_KEY(kind='hashid', value=HASHIDS_CODEC.encode(id))]
+    if hash:
+        keys.append(FORM_SNAPSHOT_KEY(kind='hash', value=hash))
+
+    for key in keys:
+        _local.pop(key, None)
+    pipe = redis_store.pipeline()
+    for key in keys:
+        # kept for longer than any snapshot written before the bump
+        pipe.incr(FORM_SNAPSHOT_GENERATION_KEY(key=key))
+        pipe.expire(FORM_SNAPSHOT_GENERATION_KEY(key=key), 2 * settings.FORM_CACHE_TTL)
+    pipe.delete(*keys)
+    pipe.execute()
+    for key in keys:
+        redis_store.publish(FORM_CACHE_CHANNEL, key)
+
+
+def clear_local():
+    _local.clear()
+
+
+def _get(key, load):
+    if not settings.FORM_CACHE:
+        form = load()
+        return snapshot_of(form) if form else None
+
+    _ensure_listener()
+
+    cached = _local.get(key)
+    if cached and cached[0] > time.time():
+        return cached[1]
+
+    generation_key = FORM_SNAPSHOT_GENERATION_KEY(key=key)
+    value, generation = redis_store.mget(key, generation_key)
+    generation = int(generation or 0)
+
+    snapshot = None
+    if value:
+        row = json.loads(value)
+        if row.pop('generation', None) == generation:
+            snapshot = FormSnapshot(**row)
+
+    if not snapshot:
+        form = load()
+        if not form:
+            return None
+        snapshot = snapshot_of(form)
+
+        pipe = redis_store.pipeline()
+        pipe.set(key, json.dumps(dict(snapshot._asdict(), generation=generation)),
+                 ex=settings.FORM_CACHE_TTL)
+        pipe.get(generation_key)
+        if int(pipe.execute()[1] or 0) != generation:
+            # invalidated while we were loading it. what was written to
+            # Redis will be ignored, and nothing is kept here either.
+            return snapshot
+
+    if len(_local) >= settings.FORM_CACHE_LOCAL_SIZE:
+        clear_local()
+    _local[key] = (time.time() + settings.FORM_CACHE_LOCAL_TTL, snapshot)
+    return snapshot
+
+
+def _ensure_listener():
+    '''
+    Starts (once per process, so also after a fork) the thread that
+    drops local snapshots invalidated by other workers.
+    '''
+    global _listener_pid
+
+    if _listener_pid == os.getpid() or settings.TESTING:
+        return
+    _listener_pid = os.getpid()
+    clear_local()
+
+    thread = threading.Thread(target=_listen)
+    thread.daemon = True
+    thread.start()
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = redis_store.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(FORM_CACHE_CHANNEL)
+            for message in pubsub.listen():
+                _local.pop(message['data'], None)
+        except redis.RedisError:
+            # we may have missed invalidations while disconnected
+            clear_local()
+            time.sleep(1)
+
+
+# invalidation happens when changes to the cached columns are committed,
+# so the new values are there for whoever loads the form afterwards.
+# snapshots loaded before that are ruled out by the generation check.
+
+def _mark_stale(target):
+    stale = object_session(target).info.setdefault('stale_forms', set())
+    stale.add((target.id, target.hash))
+
+
+def _mark_stale_if_changed(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[f].history.has_changes() for f in FormSnapshot._fields):
+        _mark_stale(target)
+
+
+def _mark_deleted(mapper, connection, target):
+    _mark_stale(target)
+
+
+def _invalidate_stale(session):
+    for id, hash in session.info.pop('stale_forms', ()):
+        invalidate(id, hash)
+
+
+def _forget_stale(session):
+    session.info.pop('stale_forms', None)
+
+
+event.listen(Form, 'after_update', _mark_stale_if_changed)
+event.listen(Form, 'after_delete', _mark_deleted)
+event.listen(Session, 'after_commit', _invalidate_stale)
+event.listen(Session, 'after_rollback', _forget_stale)
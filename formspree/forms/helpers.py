@@ -1,16 +1,35 @@
 import werkzeug.datastructures
 import urlparse
-import requests
 import hashlib
 import hashids
+import json
+import requests
 from urlparse import urljoin
 from flask import request, g
 
-from formspree import settings
+from formspree import settings, outbound
+from formspree.app import redis_store
 
 HASH = lambda x, y: hashlib.md5(x+y+settings.NONCE_SECRET).hexdigest()
 EXCLUDE_KEYS = ['_gotcha', '_next', '_subject', '_cc', '_format']
 MONTHLY_COUNTER_KEY = 'monthly_{form_id}_{month}'.format
+OVERLIMIT_KEY = 'overlimit_{form_id}_{month}'.format  # set when submissions are being rejected
+ARCHIVE_SIZES_KEY = 'archive_sizes'            # hash of form_id -> archived submissions
+ARCHIVE_COMPACTION_KEY = 'archive_compaction'  # set of form ids waiting to be compacted
+ARCHIVE_COMPACTION_LOCK_KEY = 'archive_compaction_lock_{form_id}'.format
+PENDING_COUNTERS_KEY = 'pending_counters'  # hash of form_id -> increments not yet in forms.counter
+PENDING_COUNTERS_LOCK_KEY = 'pending_counters_lock'
+CONFIRMATION_LOCK_KEY = 'confirmation_lock_{nonce}'.format  # held while a confirmation is being sent
+SITEWIDE_RESULT_KEY = 'sitewide_result_{url}_{email}'.format  # whether the email is in the file
+SITEWIDE_FILE_KEY = 'sitewide_file_{url}'.format  # the emails in the file and its validators
+SITEWIDE_QUEUE_KEY = 'sitewide_checks'  # list of sitewide forms waiting for verification
+SITEWIDE_PENDING_KEY = 'sitewide_pending'  # hash of form_id -> url and state of unsettled verifications
+SITEWIDE_LISTED, SITEWIDE_NOT_LISTED, SITEWIDE_FETCH_FAILED = 'listed', 'not listed', 'fetch failed'
+DIGEST_KEY = 'digest_{form_id}'.format  # list of submissions waiting for the next digest
+DIGEST_PENDING_KEY = 'digest_pending'    # hash of form_id -> submissions since the last digest
+FORM_SNAPSHOT_KEY = 'form_snapshot_{kind}_{value}'.format
+FORM_SNAPSHOT_GENERATION_KEY = 'form_snapshot_generation_{key}'.format  # bumped on every invalidation
+FORM_CACHE_CHANNEL = 'form_snapshot_invalidations'
 HASHIDS_CODEC = hashids.Hashids(alphabet='abcdefghijklmnopqrstuvwxyz',
                                 min_length=8,
                                 salt=settings.HASHIDS_SALT)
@@ -74,23 +93,86 @@ def remove_www(host):
     return host
 
 
-def sitewide_file_check(url, email):
+def sitewide_file_url(url):
     if not url.startswith('http://') and not url.startswith('https://'):
         url = 'http://' + url
-    url = urljoin(url, '/formspree-verify.txt')
+    return urljoin(url, '/formspree-verify.txt')
 
-    g.log = g.log.bind(url=url, email=email)
 
-    res = requests.get(url, timeout=2)
-    if not res.ok:
-        g.log.debug('Sitewide file not found.')
-        return False
+def cached_sitewide_check(url, email):
+    '''
+    The cached result of `sitewide_file_check`, or None if there is none.
+    '''
+    cached = redis_store.get(SITEWIDE_RESULT_KEY(url=sitewide_file_url(url), email=email))
+    if cached is not None:
+        return cached == '1'
 
-    for line in res.text.splitlines():
-        line = line.strip(u'\xef\xbb\xbf ')
-        if line == email:
-            g.log.debug('Email found in sitewide file.')
-            return True
 
-    g.log.warn('Email not found in sitewide file.', contents=res.text[:100])
-    return False
+def sitewide_file_check(url, email):
+    '''
+    Whether `email` is listed in the formspree-verify.txt file at the
+    root of the domain of `url`. A file that couldn't be fetched counts
+    as not listing it.
+    '''
+    return sitewide_file_status(url, email) == SITEWIDE_LISTED
+
+
+def sitewide_file_status(url, email):
+    '''
+    SITEWIDE_LISTED or SITEWIDE_NOT_LISTED, when the formspree-verify.txt
+    file at the root of the domain of `url` was read, or
+    SITEWIDE_FETCH_FAILED when it couldn't be (network errors and
+    responses other than 200 and 304).
+
+    Results are cached for SITEWIDE_CHECK_TTL seconds (or, when the
+    email isn't there, SITEWIDE_CHECK_NEGATIVE_TTL, so a file that was
+    just uploaded is seen soon). After that the file is revalidated with
+    a conditional request, which is answered with a bodyless 304 while
+    it hasn't changed. Failures are not cached.
+    '''
+    url = sitewide_file_url(url)
+    g.log = g.log.bind(url=url, email=email)
+
+    cached = cached_sitewide_check(url, email)
+    if cached is not None:
+        return SITEWIDE_LISTED if cached else SITEWIDE_NOT_LISTED
+
+    file_key = SITEWIDE_FILE_KEY(url=url)
+    known = json.loads(redis_store.get(file_key) or 'null')
+    headers = {}
+    if known and known.get('etag'):
+        headers['If-None-Match'] = known['etag']
+    if known and known.get('last_modified'):
+        headers['If-Modified-Since'] = known['last_modified']
+
+    try:
+        res = outbound.get(url, timeout=2, headers=headers)
+    except requests.RequestException as e:
+        g.log.info('Could not fetch the sitewide file.', error=str(e))
+        return SITEWIDE_FETCH_FAILED
+
+    if res.status_code == 304 and known:
+        g.log.debug('Sitewide file not modified.')
+        emails = known['emails']
+    elif res.status_code == 200:
+        emails = [line.strip(u'\xef\xbb\xbf ') for line in res.text.splitlines()]
+        if res.headers.get('ETag') or res.headers.get('Last-Modified'):
+            redis_store.set(file_key, json.dumps({
+                'etag': res.headers.get('ETag'),
+                'last_modified': res.headers.get('Last-Modified'),
+                'emails': emails
+            }), ex=settings.SITEWIDE_FILE_TTL)
+    else:
+        g.log.info('Could not fetch the sitewide file.', status=res.status_code)
+        redis_store.delete(file_key)
+        return SITEWIDE_FETCH_FAILED
+
+    found = email in emails
+    if found:
+        g.log.debug('Email found in sitewide file.')
+    else:
+        g.log.warn('Email not found in sitewide file.', contents=res.text[:100])
+
+    redis_store.set(SITEWIDE_RESULT_KEY(url=url, email=email), '1' if found else '0',
+                    ex=settings.SITEWIDE_CHECK_TTL if found else settings.SITEWIDE_CHECK_NEGATIVE_TTL)
+    return SITEWIDE_LISTED if found else SITEWIDE_NOT_LISTED
@@ -1,30 +1,42 @@
+import json
 import datetime
+import uuid
+from sqlalchemy import bindparam
+from sqlalchemy.dialects.postgresql import insert
 
 from formspree.app import DB, redis_store
-from formspree import settings
+from formspree import settings, outbound
 from formspree.utils import send_email, unix_time_for_12_months_from_now, \
                             next_url, IS_VALID_EMAIL
 from flask import url_for, render_template, g
-from sqlalchemy.sql.expression import delete
 from werkzeug.datastructures import ImmutableMultiDict, \
                                     ImmutableOrderedMultiDict
-from helpers import HASH, HASHIDS_CODEC, MONTHLY_COUNTER_KEY, \
+from helpers import HASH, HASHIDS_CODEC, MONTHLY_COUNTER_KEY, OVERLIMIT_KEY, \
+                    ARCHIVE_SIZES_KEY, ARCHIVE_COMPACTION_KEY, \
+                    ARCHIVE_COMPACTION_LOCK_KEY, PENDING_COUNTERS_KEY, \
+                    PENDING_COUNTERS_LOCK_KEY, DIGEST_KEY, DIGEST_PENDING_KEY, \
+                    CONFIRMATION_LOCK_KEY, \
                     http_form_to_dict, referrer_to_path
 
 
 class Form(DB.Model):
     __tablename__ = 'forms'
+    __table_args__ = (DB.Index('ix_forms_email_host', 'email', 'host'),)
 
     id = DB.Column(DB.Integer, primary_key=True)
     hash = DB.Column(DB.String(32), unique=True)
     email = DB.Column(DB.String(120))
-    host = DB.Column(DB.String(300))
+    host = DB.Column(DB.String(300), index=True)
     sitewide = DB.Column(DB.Boolean)
     disabled = DB.Column(DB.Boolean)
     confirm_sent = DB.Column(DB.Boolean)
     confirmed = DB.Column(DB.Boolean)
     counter = DB.Column(DB.Integer)
-    owner_id = DB.Column(DB.Integer, DB.ForeignKey('users.id'))
+    upgraded = DB.Column(DB.Boolean) # whether any controller is upgraded, kept
+                                     # up to date by the listeners below
+    digest = DB.Column(DB.String(10)) # None, or one of DIGEST_PERIODS to have
+                                      # submissions emailed together, see `send_digest`
+    owner_id = DB.Column(DB.Integer, DB.ForeignKey('users.id'), index=True)
 
     owner = DB.relationship('User') # direct owner, defined by 'owner_id'
                                     # this property is basically useless. use .controllers
@@ -59,6 +71,8 @@ class Form(DB.Model):
     STATUS_CONFIRMATION_DUPLICATED = 11
     STATUS_CONFIRMATION_FAILED     = 12
 
+    DIGEST_PERIODS = ['hourly', 'daily']
+
     def __init__(self, email, host=None, owner=None):
         if host:
             self.hash = HASH(email, host)
@@ -72,10 +86,42 @@ class Form(DB.Model):
         self.confirmed = False
         self.counter = 0
         self.disabled = False
+        # forms that aren't owned by an upgraded user may still be
+        # controlled by one through their email, see `form_inserting`
+        self.upgraded = bool(owner and owner.upgraded)
 
     def __repr__(self):
         return '<Form %s, email=%s, host=%s>' % (self.id, self.email, self.host)
 
+    @classmethod
+    def get_or_create(cls, email, host):
+        '''
+        The form created by spontaneous submissions to `email` from
+        `host`. It is inserted, if it doesn't exist yet, with a single
+        INSERT ... ON CONFLICT DO NOTHING, so concurrent first
+        submissions all end up with the same row instead of failing on
+        the unique `hash`. Committing is left to the caller.
+        '''
+        hash = HASH(email, host)
+        forms = cls.__table__
+        DB.session.execute(
+            insert(forms) \
+                .values(hash=hash, email=email, host=host,
+                        confirm_sent=False, confirmed=False, counter=0,
+                        disabled=False, upgraded=upgraded_controller(email)) \
+                .on_conflict_do_nothing(index_elements=[forms.c.hash])
+        )
+        return cls.query.filter_by(hash=hash).first()
+
+    @classmethod
+    def status_name(cls, code):
+        '''
+        'email_sent' for STATUS_EMAIL_SENT and so on.
+        '''
+        for attr in dir(cls):
+            if attr.startswith('STATUS_') and getattr(cls, attr) == code:
+                return attr[len('STATUS_'):].lower()
+
     @property
     def controllers(self):
         from formspree.users.models import User, Email
@@ -96,10 +142,11 @@ class Form(DB.Model):
         except IndexError:
             return None
 
-    def send(self, submitted_data, referrer):
+    @staticmethod
+    def parse_submission(submitted_data, referrer):
         '''
-        Sends form to user's email.
-        Assumes sender's email has been verified.
+        Normalizes the submitted form or JSON data, once, into the
+        payload used by `reject_early`, `send` and `send_confirmation`.
         '''
 
         if type(submitted_data) in (ImmutableMultiDict, ImmutableOrderedMultiDict):
@@ -107,27 +154,39 @@ class Form(DB.Model):
         else:
             data, keys = submitted_data, submitted_data.keys()
 
-        subject = data.get('_subject', 'New submission from %s' % referrer_to_path(referrer))
-        reply_to = data.get('_replyto', data.get('email', data.get('Email', ''))).strip()
         cc = data.get('_cc', None)
-        next = next_url(referrer, data.get('_next'))
-        spam = data.get('_gotcha', None)
-        format = data.get('_format', None)
+        return {
+            'data': data,
+            'keys': keys,
+            'referrer': referrer,
+            'subject': data.get('_subject', 'New submission from %s' % referrer_to_path(referrer)),
+            'reply_to': data.get('_replyto', data.get('email', data.get('Email', ''))).strip(),
+            # turn cc emails into array
+            'cc': [email.strip() for email in cc.split(',')] if cc else None,
+            'next': next_url(referrer, data.get('_next')),
+            'spam': data.get('_gotcha', None),
+            'format': data.get('_format', None)
+        }
 
-        # turn cc emails into array
-        if cc:
-            cc = [email.strip() for email in cc.split(',')]
+    @staticmethod
+    def reject_early(payload):
+        '''
+        The checks that need nothing but the payload, run before the
+        form is even looked up. Returns the status for a rejected
+        submission, or None.
+        '''
 
         # prevent submitting empty form
-        if not any(data.values()):
+        if not any(payload['data'].values()):
             return {'code': Form.STATUS_EMAIL_EMPTY}
 
         # return a fake success for spam
-        if spam:
-            g.log.info('Submission rejected.', gotcha=spam)
-            return {'code': Form.STATUS_EMAIL_SENT, 'next': next}
+        if payload['spam']:
+            g.log.info('Submission rejected.', gotcha=payload['spam'])
+            return {'code': Form.STATUS_EMAIL_SENT, 'next': payload['next']}
 
         # validate reply_to, if it is not a valid email address, reject
+        reply_to = payload['reply_to']
         if reply_to and not IS_VALID_EMAIL(reply_to):
             g.log.info('Submission rejected. Reply-To is invalid.',
                        reply_to=reply_to)
@@ -136,15 +195,38 @@ class Form(DB.Model):
                 'error-message': '"%s" is not a valid email address.' %
                                  reply_to,
                 'address': reply_to,
-                'referrer': referrer
+                'referrer': payload['referrer']
             }
 
-        # increase the monthly counter
+    def send(self, payload):
+        '''
+        Sends form to user's email.
+        Assumes sender's email has been verified and the payload
+        passed `reject_early`.
+        '''
+
+        data = payload['data']
+
+        # increase the monthly counter and decide on the quota
+        # before anything is written to the database
         request_date = datetime.datetime.now()
-        self.increase_monthly_counter(basedate=request_date)
+        monthly_counter, overlimit = self.increase_monthly_counter(basedate=request_date)
+
+        # check if the forms are over the counter and the user is not upgraded
+        if overlimit and self.upgraded:
+            overlimit = False
+
+        if overlimit and monthly_counter - settings.MONTHLY_SUBMISSIONS_LIMIT > 25:
+            g.log.info('Submission rejected. Form over quota.', monthly_counter=monthly_counter)
+            # only send this overlimit notification for the first 25 overlimit emails
+            # after that, return an error so the user can know the website owner is not
+            # going to read his message.
+            # the next submissions this month are rejected straight away.
+            self.set_hard_overlimit(basedate=request_date)
+            return { 'code': Form.STATUS_OVERLIMIT }
 
         # increment the forms counter
-        self.counter = Form.counter + 1
+        self.increment_counter()
         DB.session.add(self)
 
         # archive the form contents
@@ -155,54 +237,27 @@ class Form(DB.Model):
         # commit changes
         DB.session.commit()
 
-        # delete all archived submissions over the limit
-        records_to_keep = settings.ARCHIVED_SUBMISSIONS_LIMIT
-        newest = self.submissions.with_entities(Submission.id).limit(records_to_keep)
-        DB.engine.execute(
-          delete('submissions'). \
-          where(Submission.form_id == self.id). \
-          where(~Submission.id.in_(newest))
-        )
-
-        # check if the forms are over the counter and the user is not upgraded
-        overlimit = False
-        monthly_counter = self.get_monthly_counter()
-        if monthly_counter > settings.MONTHLY_SUBMISSIONS_LIMIT:
-            overlimit = True
-            if self.controllers:
-                for c in self.controllers:
-                    if c.upgraded:
-                        overlimit = False
-                        break
+        # archived submissions over the limit are deleted later, in batches
+        self.schedule_compaction()
 
+        if self.digest and not overlimit:
+            self.queue_for_digest([payload])
+            return { 'code': Form.STATUS_EMAIL_SENT, 'next': payload['next'] }
 
-        now = datetime.datetime.utcnow().strftime('%I:%M %p UTC - %d %B %Y')
         if not overlimit:
-            text = render_template('email/form.txt', data=data, host=self.host, keys=keys, now=now)
-            # check if the user wants a new or old version of the email
-            if format == 'plain':
-                html = render_template('email/plain_form.html', data=data, host=self.host, keys=keys, now=now)
-            else:
-                html = render_template('email/form.html', data=data, host=self.host, keys=keys, now=now)
+            text, html = self.render_submission(payload)
         else:
-            if monthly_counter - settings.MONTHLY_SUBMISSIONS_LIMIT > 25:
-                g.log.info('Submission rejected. Form over quota.', monthly_counter=monthly_counter)
-                # only send this overlimit notification for the first 25 overlimit emails
-                # after that, return an error so the user can know the website owner is not
-                # going to read his message.
-                return { 'code': Form.STATUS_OVERLIMIT }
-
             text = render_template('email/overlimit-notification.txt', host=self.host)
             html = render_template('email/overlimit-notification.html', host=self.host)
 
         result = send_email(
             to=self.email,
-            subject=subject,
+            subject=payload['subject'],
             text=text,
             html=html,
             sender=settings.DEFAULT_SENDER,
-            reply_to=reply_to,
-            cc=cc
+            reply_to=payload['reply_to'],
+            cc=payload['cc']
         )
 
         if not result[0]:
@@ -211,7 +266,185 @@ class Form(DB.Model):
                 return { 'code': Form.STATUS_REPLYTO_ERROR}
             return{ 'code': Form.STATUS_EMAIL_FAILED, 'mailer-code': result[2], 'error-message': result[1] }
 
-        return { 'code': Form.STATUS_EMAIL_SENT, 'next': next }
+        return { 'code': Form.STATUS_EMAIL_SENT, 'next': payload['next'] }
+
+    def send_batch(self, payloads, combined=True):
+        '''
+        Stores many submissions with a single multi-row INSERT and a
+        single counter update, then delivers them in one combined email
+        or in one email each (queued like any other when MAIL_QUEUE is
+        enabled). Assumes the form is confirmed and every payload passed
+        `reject_early`.
+        '''
+
+        request_date = datetime.datetime.now()
+        monthly_counter, overlimit = self.increase_monthly_counter(
+            basedate=request_date, amount=len(payloads))
+
+        if overlimit and self.upgraded:
+            overlimit = False
+
+        if overlimit and monthly_counter - settings.MONTHLY_SUBMISSIONS_LIMIT > 25:
+            g.log.info('Batch rejected. Form over quota.', monthly_counter=monthly_counter)
+            self.set_hard_overlimit(basedate=request_date)
+            return { 'code': Form.STATUS_OVERLIMIT }
+
+        submitted_at = datetime.datetime.utcnow()
+        DB.session.execute(Submission.__table__.insert().values([
+            {'form_id': self.id, 'submitted_at': submitted_at, 'data': p['data']}
+            for p in payloads
+        ]))
+        self.increment_counter(len(payloads))
+        DB.session.add(self)
+        DB.session.commit()
+
+        self.schedule_compaction(len(payloads))
+
+        if self.digest and not overlimit:
+            self.queue_for_digest(payloads)
+            return { 'code': Form.STATUS_EMAIL_SENT }
+
+        if overlimit:
+            messages = [{
+                'subject': 'New submissions from %s' % self.host,
+                'text': render_template('email/overlimit-notification.txt', host=self.host),
+                'html': render_template('email/overlimit-notification.html', host=self.host)
+            }]
+        elif combined:
+            now = submitted_at.strftime('%I:%M %p UTC - %d %B %Y')
+            messages = [{
+                'subject': '%s new submissions from %s' % (len(payloads), self.host),
+                'text': render_template('email/batch.txt', payloads=payloads, host=self.host, now=now),
+                'html': render_template('email/batch.html', payloads=payloads, host=self.host, now=now)
+            }]
+        else:
+            messages = []
+            for payload in payloads:
+                text, html = self.render_submission(payload)
+                messages.append({
+                    'subject': payload['subject'],
+                    'text': text,
+                    'html': html,
+                    'reply_to': payload['reply_to'],
+                    'cc': payload['cc']
+                })
+
+        for message in messages:
+            result = send_email(to=self.email, sender=settings.DEFAULT_SENDER, **message)
+            if not result[0]:
+                g.log.warning('Failed to send email.', reason=result[1], code=result[2])
+                return { 'code': Form.STATUS_EMAIL_FAILED, 'mailer-code': result[2], 'error-message': result[1] }
+
+        return { 'code': Form.STATUS_EMAIL_SENT }
+
+    def queue_for_digest(self, payloads):
+        '''
+        Holds submissions for the next digest instead of emailing them.
+        Only the first DIGEST_MAX_SUBMISSIONS of a digest are kept in
+        full, the ones after that are just counted (they are archived
+        like any other anyway).
+        '''
+        submitted_at = datetime.datetime.utcnow().strftime('%I:%M %p UTC - %d %B %Y')
+        entries = [json.dumps({'data': p['data'],
+                               'keys': list(p['keys']),
+                               'submitted_at': submitted_at}) for p in payloads]
+
+        key = DIGEST_KEY(form_id=self.id)
+        pipe = redis_store.pipeline(transaction=True)
+        pipe.rpush(key, *entries)
+        pipe.ltrim(key, 0, settings.DIGEST_MAX_SUBMISSIONS - 1)
+        pipe.hincrby(DIGEST_PENDING_KEY, self.id, len(payloads))
+        pipe.execute()
+
+    def send_digest(self):
+        '''
+        Emails the submissions held by `queue_for_digest` in a single
+        message. Returns how many submissions it had, or None if it
+        could not be sent, in which case they are held for the next one.
+        '''
+        key = DIGEST_KEY(form_id=self.id)
+        pipe = redis_store.pipeline(transaction=True)
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        pipe.hget(DIGEST_PENDING_KEY, self.id)
+        pipe.hdel(DIGEST_PENDING_KEY, self.id)
+        entries, _, total, _ = pipe.execute()
+
+        total = int(total or 0)
+        if not total:
+            return 0
+
+        submissions = [json.loads(entry) for entry in entries]
+        now = datetime.datetime.utcnow().strftime('%I:%M %p UTC - %d %B %Y')
+        result = send_email(
+            to=self.email,
+            subject='%s new submission%s from %s' % (total, '' if total == 1 else 's', self.host),
+            text=render_template('email/digest.txt', submissions=submissions,
+                                 total=total, host=self.host, now=now),
+            html=render_template('email/digest.html', submissions=submissions,
+                                 total=total, host=self.host, now=now),
+            sender=settings.DEFAULT_SENDER
+        )
+
+        if not result[0]:
+            g.log.warning('Failed to send digest.', form=self.id, reason=result[1], code=result[2])
+            # put them back in front of whatever arrived in the meantime
+            pipe = redis_store.pipeline(transaction=True)
+            if entries:
+                pipe.lpush(key, *reversed(entries))
+                pipe.ltrim(key, 0, settings.DIGEST_MAX_SUBMISSIONS - 1)
+            pipe.hincrby(DIGEST_PENDING_KEY, self.id, total)
+            pipe.execute()
+            return None
+
+        return total
+
+    @classmethod
+    def send_digests(cls, period):
+        '''
+        Sends the digests of the forms on `period` (one of DIGEST_PERIODS)
+        and whatever is left for forms that have since left digest mode.
+        Meant to be run by `manage.py send_digests` every hour or day.
+        '''
+        pending = [int(form_id) for form_id in redis_store.hkeys(DIGEST_PENDING_KEY)]
+        if not pending:
+            return 0
+
+        forms = cls.query.filter(cls.id.in_(pending)).all()
+
+        # forget the digests of deleted forms
+        gone = set(pending) - set(form.id for form in forms)
+        if gone:
+            pipe = redis_store.pipeline(transaction=False)
+            for form_id in gone:
+                pipe.delete(DIGEST_KEY(form_id=form_id))
+            pipe.hdel(DIGEST_PENDING_KEY, *gone)
+            pipe.execute()
+
+        sent = 0
+        for form in forms:
+            if form.digest not in (period, None):
+                continue
+            delivered = form.send_digest()
+            if delivered:
+                g.log.info('Sent digest.', form=form.id, submissions=delivered)
+                sent += 1
+        return sent
+
+    def render_submission(self, payload):
+        '''
+        The text and html bodies of the email for one submission.
+        '''
+        data, keys = payload['data'], payload['keys']
+        now = datetime.datetime.utcnow().strftime('%I:%M %p UTC - %d %B %Y')
+
+        text = render_template('email/form.txt', data=data, host=self.host, keys=keys, now=now)
+        # check if the user wants a new or old version of the email
+        if payload['format'] == 'plain':
+            html = render_template('email/plain_form.html', data=data, host=self.host, keys=keys, now=now)
+        else:
+            html = render_template('email/form.html', data=data, host=self.host, keys=keys, now=now)
+        return text, html
 
     def get_monthly_counter(self, basedate=None):
         basedate = basedate or datetime.datetime.now()
@@ -220,18 +453,261 @@ class Form(DB.Model):
         counter = redis_store.get(key) or 0
         return int(counter)
 
-    def increase_monthly_counter(self, basedate=None):
+    def increase_monthly_counter(self, basedate=None, amount=1):
+        '''
+        Increments the counter and refreshes its expiration in a single
+        MULTI/EXEC round trip. Returns the new count and whether the
+        form is now over MONTHLY_SUBMISSIONS_LIMIT.
+        '''
         basedate = basedate or datetime.datetime.now()
         month = basedate.month
         key = MONTHLY_COUNTER_KEY(form_id=self.id, month=month)
-        redis_store.incr(key)
+        pipe = redis_store.pipeline(transaction=True)
+        pipe.incrby(key, amount)
+        pipe.expireat(key, unix_time_for_12_months_from_now(basedate))
+        counter = pipe.execute()[0]
+        return counter, counter > settings.MONTHLY_SUBMISSIONS_LIMIT
+
+    @staticmethod
+    def is_hard_overlimit(form_id, basedate=None):
+        '''
+        Whether the form was flagged by `set_hard_overlimit` this month.
+        Only needs the id, so the form doesn't have to be loaded.
+        '''
+        basedate = basedate or datetime.datetime.now()
+        return bool(redis_store.exists(OVERLIMIT_KEY(form_id=form_id, month=basedate.month)))
+
+    def set_hard_overlimit(self, basedate=None):
+        basedate = basedate or datetime.datetime.now()
+        key = OVERLIMIT_KEY(form_id=self.id, month=basedate.month)
+        redis_store.set(key, 1)
         redis_store.expireat(key, unix_time_for_12_months_from_now(basedate))
 
-    def send_confirmation(self, with_data=None):
+    @staticmethod
+    def get_monthly_counters(forms, basedate=None):
+        '''
+        Monthly counters for many forms with a single MGET.
+        '''
+        basedate = basedate or datetime.datetime.now()
+        keys = [MONTHLY_COUNTER_KEY(form_id=form.id, month=basedate.month)
+                for form in forms]
+        if not keys:
+            return []
+        return [int(counter or 0) for counter in redis_store.mget(keys)]
+
+    def iter_submissions(self):
+        '''
+        Yields the archived submissions, newest first, fetching them
+        EXPORT_CHUNK_SIZE at a time (by id, so every chunk is an index
+        range scan) to keep exports of big archives out of memory.
+        '''
+        remaining = settings.ARCHIVED_SUBMISSIONS_LIMIT
+        last_id = None
+        while remaining > 0:
+            size = min(settings.EXPORT_CHUNK_SIZE, remaining)
+            query = self.submissions
+            if last_id is not None:
+                query = query.filter(Submission.id < last_id)
+            chunk = query.limit(size).all()
+
+            for sub in chunk:
+                yield sub
+            if len(chunk) < size:
+                return
+
+            remaining -= size
+            last_id = chunk[-1].id
+
+    def submissions_page(self, after_id=None, limit=None):
+        '''
+        Returns a list with up to `limit` archived submissions older than
+        `after_id`, newest first, and the id to pass as `after_id` for the
+        next page (None on the last one).
+        '''
+        limit = limit or settings.SUBMISSIONS_PAGE_SIZE
+
+        # the archive may be over the limit until it is compacted
+        oldest_id = self.submissions.with_entities(Submission.id) \
+            .offset(settings.ARCHIVED_SUBMISSIONS_LIMIT - 1) \
+            .limit(1).scalar()
+
+        query = self.submissions
+        if after_id is not None:
+            query = query.filter(Submission.id < after_id)
+        if oldest_id is not None:
+            query = query.filter(Submission.id >= oldest_id)
+
+        page = query.limit(limit + 1).all()
+        if len(page) > limit:
+            return page[:limit], page[limit - 1].id
+        return page, None
+
+    def submission_fields(self):
+        '''
+        The set of field names used in the archived submissions, computed
+        by the database so the submissions don't have to be loaded.
+        '''
+        archive = DB.session.query(Submission.data) \
+            .filter(Submission.form_id == self.id) \
+            .order_by(Submission.id.desc()) \
+            .limit(settings.ARCHIVED_SUBMISSIONS_LIMIT) \
+            .subquery()
+        keys = DB.session.query(DB.func.json_object_keys(archive.c.data)).distinct()
+        return set(key for key, in keys)
+
+    @property
+    def total_counter(self):
+        '''
+        forms.counter plus the increments still buffered in redis.
+        '''
+        pending = redis_store.hget(PENDING_COUNTERS_KEY, self.id)
+        return self.counter + int(pending or 0)
+
+    @staticmethod
+    def total_counters(forms):
+        '''
+        `total_counter` of many forms at once, with a single HMGET.
+        Returns a dict of form id -> counter.
+        '''
+        if not forms:
+            return {}
+        pending = redis_store.hmget(PENDING_COUNTERS_KEY, [form.id for form in forms])
+        return {form.id: form.counter + int(n or 0)
+                for form, n in zip(forms, pending)}
+
+    def increment_counter(self, n=1):
+        '''
+        Adds n to forms.counter. With COUNTER_WRITE_BEHIND the increment
+        is buffered in redis and written later by `flush_counters`, so
+        busy forms don't serialize every submission on their row lock.
+        '''
+        if settings.COUNTER_WRITE_BEHIND:
+            redis_store.hincrby(PENDING_COUNTERS_KEY, self.id, n)
+        else:
+            self.counter = Form.counter + n
+
+    @classmethod
+    def flush_counters(cls):
+        '''
+        Writes the buffered counter increments to the database in a
+        single batch. Returns the number of updated forms, or None if
+        another worker is flushing.
+        Meant to be run periodically by `manage.py flush_counters`.
+        '''
+        token = uuid.uuid4().hex
+        if not redis_store.set(PENDING_COUNTERS_LOCK_KEY, token, nx=True, ex=300):
+            return None
+
+        try:
+            buffered = {int(form_id): int(n) for form_id, n
+                        in redis_store.hgetall(PENDING_COUNTERS_KEY).items()}
+            pending = [{'form_id': form_id, 'n': n}
+                       for form_id, n in buffered.items() if n]
+            if pending:
+                forms = cls.__table__
+                DB.session.execute(
+                    forms.update() \
+                        .where(forms.c.id == bindparam('form_id')) \
+                        .values(counter=forms.c.counter + bindparam('n')),
+                    pending
+                )
+                DB.session.commit()
+
+            # increments made while we were flushing stay in the buffer,
+            # fields with nothing else buffered are removed.
+            def drain(pipe):
+                ids = list(buffered)
+                current = pipe.hmget(PENDING_COUNTERS_KEY, ids) if ids else []
+                pipe.multi()
+                for form_id, left in zip(ids, current):
+                    if int(left or 0) == buffered[form_id]:
+                        pipe.hdel(PENDING_COUNTERS_KEY, form_id)
+                    else:
+                        pipe.hincrby(PENDING_COUNTERS_KEY, form_id, -buffered[form_id])
+            redis_store.transaction(drain, PENDING_COUNTERS_KEY)
+            return len(pending)
+        finally:
+            if redis_store.get(PENDING_COUNTERS_LOCK_KEY) == token:
+                redis_store.delete(PENDING_COUNTERS_LOCK_KEY)
+
+    def schedule_compaction(self, archived=1):
+        '''
+        Keeps count of the size of the archive (counting it in full the
+        first time, when redis knows nothing about the form) and, once
+        it is over ARCHIVED_SUBMISSIONS_LIMIT by more than
+        ARCHIVE_COMPACTION_SLACK, flags the form for compaction.
+        '''
+        size = redis_store.hincrby(ARCHIVE_SIZES_KEY, self.id, archived)
+        if size == archived:
+            # the archived submissions are already in the count
+            size = redis_store.hincrby(ARCHIVE_SIZES_KEY, self.id,
+                                       self.submissions.count() - archived)
+        if size > settings.ARCHIVED_SUBMISSIONS_LIMIT + settings.ARCHIVE_COMPACTION_SLACK:
+            redis_store.sadd(ARCHIVE_COMPACTION_KEY, self.id)
+
+    def compact_archive(self):
+        '''
+        Deletes archived submissions over the limit, newest first kept,
+        ARCHIVE_COMPACTION_BATCH rows at a time. Returns the number of
+        deleted rows, or None if another worker is compacting this form.
+        '''
+        lock = ARCHIVE_COMPACTION_LOCK_KEY(form_id=self.id)
+        token = uuid.uuid4().hex
+        if not redis_store.set(lock, token, nx=True, ex=300):
+            return None
+
+        try:
+            deleted = 0
+            while True:
+                over_limit = DB.session.query(Submission.id) \
+                    .filter(Submission.form_id == self.id) \
+                    .order_by(Submission.id.desc()) \
+                    .offset(settings.ARCHIVED_SUBMISSIONS_LIMIT) \
+                    .limit(settings.ARCHIVE_COMPACTION_BATCH)
+                result = DB.session.execute(
+                    Submission.__table__.delete() \
+                        .where(Submission.id.in_(over_limit))
+                )
+                DB.session.commit()
+                deleted += result.rowcount
+                if result.rowcount < settings.ARCHIVE_COMPACTION_BATCH:
+                    redis_store.hincrby(ARCHIVE_SIZES_KEY, self.id, -deleted)
+                    return deleted
+        finally:
+            if redis_store.get(lock) == token:
+                redis_store.delete(lock)
+
+    @classmethod
+    def compact_archives(cls):
+        '''
+        Compacts every form flagged by `schedule_compaction`.
+        Meant to be run periodically by `manage.py compact_archives`.
+        '''
+        compacted = 0
+        while True:
+            form_id = redis_store.spop(ARCHIVE_COMPACTION_KEY)
+            if form_id is None:
+                return compacted
+
+            form = cls.query.get(int(form_id))
+            if not form:
+                redis_store.hdel(ARCHIVE_SIZES_KEY, form_id)
+                continue
+
+            deleted = form.compact_archive()
+            if deleted is None:
+                # locked by another worker, it will take care of it
+                continue
+            g.log.info('Compacted archive.', form=form.id, deleted=deleted)
+            compacted += 1
+
+    def send_confirmation(self, payload=None):
         '''
         Helper that actually creates confirmation nonce
         and sends the email to associated email. Renders
-        different templates depending on the result
+        different templates depending on the result.
+        The submission that triggered it, if any, is shown
+        in the email.
         '''
 
         g.log = g.log.new(form=self.id, to=self.email, host=self.host)
@@ -246,22 +722,49 @@ class Form(DB.Model):
         # (whenever the form was created from the dashboard)
         id = str(self.id)
         nonce = self.hash or '%s:%s' % (HASH(self.email, id), self.hashid)
+
+        # concurrent submissions to a new form share a single confirmation:
+        # whoever gets the lock sends it, the others are told it was sent.
+        lock = CONFIRMATION_LOCK_KEY(nonce=nonce)
+        token = uuid.uuid4().hex
+        if not redis_store.set(lock, token, nx=True, ex=settings.CONFIRMATION_LOCK_TIMEOUT):
+            g.log.debug('Being sent by another request.')
+            return { 'code': Form.STATUS_CONFIRMATION_DUPLICATED }
+
+        try:
+            # it may have been sent while we waited for the lock
+            DB.session.refresh(self)
+            if self.confirm_sent:
+                g.log.debug('Already sent in the past.')
+                return { 'code': Form.STATUS_CONFIRMATION_DUPLICATED }
+            return self._send_confirmation(nonce, payload)
+        finally:
+            if redis_store.get(lock) == token:
+                redis_store.delete(lock)
+
+    def confirm_for_owner(self):
+        '''
+        Dashboard forms targeting one of the owner's verified addresses
+        need no confirmation, the others are sent one.
+        '''
+        if self.owner.emails.filter_by(address=self.email).first():
+            g.log.info('No need for email confirmation.')
+            self.confirmed = True
+            DB.session.add(self)
+            DB.session.commit()
+        else:
+            self.send_confirmation()
+
+    def _send_confirmation(self, nonce, payload):
         link = url_for('confirm_email', nonce=nonce, _external=True)
 
         def render_content(ext):
-            data, keys = None, None
-            if with_data:
-                if type(with_data) in (ImmutableMultiDict, ImmutableOrderedMultiDict):
-                    data, keys = http_form_to_dict(with_data)
-                else:
-                    data, keys = with_data, with_data.keys()
-
             return render_template('email/confirm.%s' % ext,
                                       email=self.email,
                                       host=self.host,
                                       nonce_link=link,
-                                      data=data,
-                                      keys=keys)
+                                      data=payload and payload['data'],
+                                      keys=payload and payload['keys'])
 
         result = send_email(to=self.email,
                             subject='Confirm email for %s' % settings.SERVICE_NAME,
@@ -331,3 +834,247 @@ class Submission(DB.Model):
     def __repr__(self):
         return '<Submission %s, form=%s, date=%s, keys=%s>' % \
             (self.id or 'with an id to be assigned', self.form_id, self.submitted_at.isoformat(), self.data.keys())
+
+DB.Index('ix_submissions_form_id_id', Submission.form_id, Submission.id.desc())
+
+
+class Suppression(DB.Model):
+    '''
+    Addresses we don't send email to, because they bounced or their
+    owner reported us as spam, as told by SendGrid's event webhook.
+
+    The table is the record, the SUPPRESSIONS_KEY hash in redis a copy
+    of it that `send_email` checks before every message.
+
+    Without the webhook (SENDGRID_WEBHOOK_TOKEN unset) the table stays
+    empty, and `reason_for` and `remove` ask SendGrid's bounce list.
+    '''
+    __tablename__ = 'suppressions'
+
+    address = DB.Column(DB.String(120), primary_key=True)
+    event = DB.Column(DB.String(20))
+    reason = DB.Column(DB.Text)
+    created_at = DB.Column(DB.DateTime)
+
+    # 'blocked' bounces are temporary, SendGrid retries them
+    EVENTS = ['bounce', 'spamreport', 'dropped']
+    DROPPED_REASONS = ['Bounced Address', 'Spam Reporting Address', 'Invalid']
+
+    @classmethod
+    def from_event(cls, event):
+        '''
+        The suppression a SendGrid event calls for, if any.
+        '''
+        kind = event.get('event')
+        if kind not in cls.EVENTS or not event.get('email'):
+            return None
+        if kind == 'bounce' and event.get('type') == 'blocked':
+            return None
+        if kind == 'dropped' and event.get('reason') not in cls.DROPPED_REASONS:
+            return None
+        return {'address': event['email'].lower(), 'event': kind,
+                'reason': event.get('reason') or kind}
+
+    @classmethod
+    def record(cls, events):
+        '''
+        Stores the suppressions called for by a batch of SendGrid events
+        with one multi-row upsert. Returns how many addresses were suppressed.
+        '''
+        rows = {}
+        for event in events:
+            row = cls.from_event(event)
+            if row:
+                rows[row['address']] = row
+        if not rows:
+            return 0
+
+        now = datetime.datetime.utcnow()
+        suppressions = cls.__table__
+        stmt = insert(suppressions).values([dict(row, created_at=now) for row in rows.values()])
+        DB.session.execute(stmt.on_conflict_do_update(
+            index_elements=[suppressions.c.address],
+            set_={'event': stmt.excluded.event,
+                  'reason': stmt.excluded.reason,
+                  'created_at': stmt.excluded.created_at}
+        ))
+        DB.session.commit()
+
+        redis_store.hmset(settings.SUPPRESSIONS_KEY,
+                          {address: row['reason'] for address, row in rows.items()})
+        return len(rows)
+
+    @classmethod
+    def reason_for(cls, address):
+        '''
+        Why the address is suppressed, or None if it isn't.
+        '''
+        if not settings.SENDGRID_WEBHOOK_TOKEN:
+            r = outbound.get('https://api.sendgrid.com/api/bounces.get.json', params={
+                'email': address,
+                'api_user': settings.SENDGRID_USERNAME,
+                'api_key': settings.SENDGRID_PASSWORD
+            })
+            if r.ok and len(r.json()) and 'reason' in r.json()[0]:
+                return r.json()[0]['reason']
+            return None
+
+        return redis_store.hget(settings.SUPPRESSIONS_KEY, address.lower())
+
+    @classmethod
+    def remove(cls, address):
+        '''
+        Sends email to the address again. With the webhook, SendGrid's own
+        bounce list is cleared later, by `manage.py sync_suppressions`.
+        Returns whether it worked (or was queued).
+        '''
+        if not settings.SENDGRID_WEBHOOK_TOKEN:
+            r = outbound.post('https://api.sendgrid.com/api/bounces.delete.json', data={
+                'email': address,
+                'api_user': settings.SENDGRID_USERNAME,
+                'api_key': settings.SENDGRID_PASSWORD
+            })
+            return r.ok and r.json().get('message') == 'success'
+
+        address = address.lower()
+        cls.query.filter_by(address=address).delete()
+        DB.session.commit()
+
+        # SendGrid may have a bounce we never heard of, so it is always asked
+        pipe = redis_store.pipeline(transaction=True)
+        pipe.hdel(settings.SUPPRESSIONS_KEY, address)
+        pipe.rpush(settings.SUPPRESSIONS_UNBLOCK_KEY, address)
+        pipe.execute()
+        return True
+
+    @classmethod
+    def import_bounces(cls):
+        '''
+        Suppresses every address on SendGrid's bounce list. For setting
+        the table up, the webhook keeps it current afterwards.
+        '''
+        r = outbound.get('https://api.sendgrid.com/api/bounces.get.json', params={
+            'api_user': settings.SENDGRID_USERNAME,
+            'api_key': settings.SENDGRID_PASSWORD
+        })
+        r.raise_for_status()
+        return cls.record([dict(bounce, event='bounce') for bounce in r.json()])
+
+    @classmethod
+    def sync_unblocks(cls):
+        '''
+        Clears the addresses unblocked with `remove` from SendGrid's own
+        bounce list, which it checks before sending. Returns how many.
+        '''
+        unblocked = 0
+        while True:
+            address = redis_store.lpop(settings.SUPPRESSIONS_UNBLOCK_KEY)
+            if address is None:
+                return unblocked
+            r = outbound.post('https://api.sendgrid.com/api/bounces.delete.json', data={
+                'email': address,
+                'api_user': settings.SENDGRID_USERNAME,
+                'api_key': settings.SENDGRID_PASSWORD
+            })
+            if r.status_code / 100 == 5:
+                # try again next time
+                redis_store.rpush(settings.SUPPRESSIONS_UNBLOCK_KEY, address)
+                g.log.warning('Failed to unblock address on SendGrid.', address=address)
+                return unblocked
+            unblocked += 1
+
+    @classmethod
+    def reload(cls):
+        '''
+        Rebuilds the redis copy from the table. Returns its size.
+        '''
+        reasons = dict(DB.session.query(cls.address, cls.reason))
+        pipe = redis_store.pipeline(transaction=True)
+        pipe.delete(settings.SUPPRESSIONS_KEY)
+        if reasons:
+            pipe.hmset(settings.SUPPRESSIONS_KEY, reasons)
+        pipe.execute()
+        return len(reasons)
+
+
+from sqlalchemy import event, inspect, exists, select, or_, true
+from sqlalchemy.orm import Session, object_session
+from formspree.users.models import User, Email
+
+
+# `Form.upgraded` is a denormalization of "any of the form controllers is
+# upgraded" (see `Form.controllers`), so the submission path doesn't have to
+# join users and emails. New forms get it in their INSERT, and it is
+# refreshed in the same transaction whenever one of its inputs changes.
+
+def upgraded_controller(email, owner_id=None):
+    '''
+    SQL for whether the owner or a user who confirmed `email` is
+    upgraded. Takes values, for a single form, or columns of `forms`.
+    '''
+    users, emails = User.__table__, Email.__table__
+    controller = users.c.id.in_(select([emails.c.owner_id]).where(emails.c.address == email))
+    if owner_id is not None:
+        controller = or_(users.c.id == owner_id, controller)
+    return exists().where(users.c.upgraded == true()).where(controller)
+
+
+def refresh_upgraded_flags(session, connection, whereclause):
+    forms = Form.__table__
+    connection.execute(forms.update().where(whereclause).values(
+        upgraded=upgraded_controller(forms.c.email, forms.c.owner_id)))
+
+    # forms that were rejecting submissions should accept them again, once
+    # the new flags are committed (see `clear_overlimit_flags`)
+    upgraded_ids = select([forms.c.id]).where(whereclause).where(forms.c.upgraded == true())
+    session.info.setdefault('upgraded_forms', set()).update(
+        row.id for row in connection.execute(upgraded_ids))
+
+
+def forms_controlled_by(user_id):
+    forms, emails = Form.__table__, Email.__table__
+    return or_(
+        forms.c.owner_id == user_id,
+        forms.c.email.in_(select([emails.c.address]).where(emails.c.owner_id == user_id))
+    )
+
+
+@event.listens_for(User, 'after_update')
+def user_updated(mapper, connection, user):
+    if inspect(user).attrs.upgraded.history.has_changes():
+        refresh_upgraded_flags(object_session(user), connection, forms_controlled_by(user.id))
+
+
+@event.listens_for(Email, 'after_insert')
+@event.listens_for(Email, 'after_delete')
+def email_changed(mapper, connection, email):
+    refresh_upgraded_flags(object_session(email), connection,
+                           Form.__table__.c.email == email.address)
+
+
+@event.listens_for(Form, 'before_insert')
+def form_inserting(mapper, connection, form):
+    if not form.upgraded:
+        # evaluated by the INSERT itself
+        form.upgraded = upgraded_controller(form.email, form.owner_id)
+
+
+@event.listens_for(Form, 'after_update')
+def form_updated(mapper, connection, form):
+    state = inspect(form)
+    if state.attrs.email.history.has_changes() or state.attrs.owner_id.history.has_changes():
+        refresh_upgraded_flags(object_session(form), connection,
+                               Form.__table__.c.id == form.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def clear_overlimit_flags(session):
+    ids = session.info.pop('upgraded_forms', ())
+    if ids:
+        month = datetime.datetime.now().month
+        redis_store.delete(*[OVERLIMIT_KEY(form_id=id, month=month) for id in ids])
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_upgraded_forms(session):
+    session.info.pop('upgraded_forms', None)
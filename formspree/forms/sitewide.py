@@ -0,0 +1,135 @@
+import json
+import time
+from urlparse import urljoin
+
+from flask import g, render_template
+
+from formspree import settings
+from formspree.app import DB, redis_store
+from formspree.utils import send_email
+from helpers import SITEWIDE_QUEUE_KEY, SITEWIDE_PENDING_KEY, SITEWIDE_LISTED, \
+                    SITEWIDE_NOT_LISTED, sitewide_file_status, referrer_to_path, \
+                    remove_www
+from models import Form
+
+# When SITEWIDE_CHECK_ASYNC is enabled, sitewide forms created from the
+# dashboard are saved disabled and without a host, and verified here by
+# `manage.py sitewide_worker`, so the dashboard request doesn't wait for
+# the verification file to be fetched. Until then the form is no
+# different from a dashboard form created without an URL, except for
+# the dashboard telling it is being verified (or that it couldn't be).
+
+
+def sitewide_host(url):
+    return remove_www(referrer_to_path(urljoin(url, '/'))[:-1])
+
+
+def enqueue(form, url):
+    pipe = redis_store.pipeline(transaction=True)
+    pipe.rpush(SITEWIDE_QUEUE_KEY, json.dumps({'form_id': form.id, 'url': url}))
+    pipe.hset(SITEWIDE_PENDING_KEY, form.id, json.dumps({'url': url, 'failed': False}))
+    pipe.execute()
+
+
+def pending(forms):
+    '''
+    The verifications of these forms that haven't been settled, as a
+    dict of form id -> {'url': ..., 'failed': ...}, with a single HMGET.
+    '''
+    if not forms:
+        return {}
+    states = redis_store.hmget(SITEWIDE_PENDING_KEY, [form.id for form in forms])
+    return {form.id: json.loads(state)
+            for form, state in zip(forms, states) if state}
+
+
+def forget(form_id):
+    redis_store.hdel(SITEWIDE_PENDING_KEY, form_id)
+
+
+def give_up(form, url, attempts):
+    '''
+    Tells the owner the file at `url` couldn't be read, and marks the
+    verification as failed for the dashboard. The form stays disabled,
+    for the owner to delete or create again.
+    '''
+    g.log.error('Could not fetch the sitewide file, giving up. The form stays disabled.',
+                attempts=attempts)
+    redis_store.hset(SITEWIDE_PENDING_KEY, form.id, json.dumps({'url': url, 'failed': True}))
+
+    if form.owner:
+        send_email(to=form.owner.email,
+                   subject='Could not verify your sitewide form on %s' % sitewide_host(url),
+                   text=render_template('email/sitewide-failed.txt',
+                                        email=form.email, host=sitewide_host(url)),
+                   html=render_template('email/sitewide-failed.html',
+                                        email=form.email, host=sitewide_host(url)),
+                   sender=settings.DEFAULT_SENDER)
+
+
+def process(timeout=5):
+    '''
+    Verifies one form from the queue. When the file lists the form's
+    email the form becomes sitewide and enabled, and is confirmed (or
+    sent a confirmation) like in the dashboard. When the file was read
+    and doesn't list it, the form is deleted, as the dashboard would
+    have refused to create it.
+
+    When the file can't be fetched the form is queued again, to be
+    checked after SITEWIDE_CHECK_RETRY_DELAY seconds, doubling every
+    time. After SITEWIDE_CHECK_MAX_ATTEMPTS the owner is told, and the
+    form left disabled.
+
+    Returns whether the form was verified, or None when no form was
+    settled (the queue was empty, or the check will be retried).
+    '''
+
+    item = redis_store.blpop([SITEWIDE_QUEUE_KEY], timeout)
+    if not item:
+        return None
+
+    job = json.loads(item[1])
+    if job.get('retry_at', 0) > time.time():
+        # not due yet, back to the end of the queue
+        redis_store.rpush(SITEWIDE_QUEUE_KEY, item[1])
+        time.sleep(min(timeout, 1))
+        return None
+
+    form = Form.query.get(job['form_id'])
+    if not form or form.host:
+        # deleted, or put to use without being sitewide in the meantime
+        forget(job['form_id'])
+        return False
+
+    g.log = g.log.bind(form=form.id, url=job['url'])
+    status = sitewide_file_status(job['url'], form.email)
+
+    if status == SITEWIDE_NOT_LISTED:
+        g.log.info('Sitewide form not verified, deleting it.')
+        DB.session.delete(form)
+        DB.session.commit()
+        forget(job['form_id'])
+        return False
+
+    if status != SITEWIDE_LISTED:
+        attempts = job.get('attempts', 0) + 1
+        if attempts >= settings.SITEWIDE_CHECK_MAX_ATTEMPTS:
+            give_up(form, job['url'], attempts)
+            return False
+
+        g.log.info('Could not fetch the sitewide file, will try again.', attempts=attempts)
+        job.update(attempts=attempts,
+                   retry_at=time.time() + settings.SITEWIDE_CHECK_RETRY_DELAY * 2 ** (attempts - 1))
+        redis_store.rpush(SITEWIDE_QUEUE_KEY, json.dumps(job))
+        return None
+
+    g.log.info('Sitewide form verified.')
+    form.host = sitewide_host(job['url'])
+    form.sitewide = True
+    form.disabled = False
+    DB.session.add(form)
+    DB.session.commit()
+    forget(form.id)
+
+    form.confirm_for_owner()
+    return True
@@ -1,22 +1,28 @@
 import unicodecsv as csv
 import json
-import requests
 import datetime
 import io
+import hmac
 
 from flask import request, url_for, render_template, redirect, \
-                  jsonify, flash, make_response, Response, g
+                  jsonify, flash, make_response, Response, g, \
+                  stream_with_context
 from flask.ext.login import current_user, login_required
 from flask.ext.cors import cross_origin
 from urlparse import urljoin
 
-from formspree import settings
+from formspree import settings, outbound, metrics
 from formspree.app import DB
 from formspree.utils import request_wants_json, jsonerror, IS_VALID_EMAIL
 from helpers import ordered_storage, referrer_to_path, remove_www, \
                     referrer_to_baseurl, sitewide_file_check, \
+                    cached_sitewide_check, \
                     HASH, EXCLUDE_KEYS
-from models import Form, Submission
+from models import Form, Submission, Suppression
+from sitewide import sitewide_host, enqueue as enqueue_sitewide_check, \
+                     pending as pending_sitewide_checks, \
+                     forget as forget_sitewide_check
+import cache
 
 
 def thanks():
@@ -30,12 +36,24 @@ def send(email_or_string):
     Main endpoint, finds or creates the form row from the database,
     checks validity and state of the form and sends either form data
     or verification to email.
+
+    Submissions go through stages that get more expensive as they go,
+    so most rejections are cheap:
+      1. negotiate the response format and check the referrer;
+      2. parse the payload and reject empty, spam or invalid-reply-to
+         submissions, without any database or redis work;
+      3. resolve the form from its cached snapshot (disabled forms,
+         wrong hosts, unknown hashids);
+      4. reject forms that are over their quota, from redis;
+      5. load the form, then persist and deliver the submission
+         (or ask for a confirmation).
     '''
 
     g.log = g.log.bind(target=email_or_string)
+    wants_json = request_wants_json()
 
     if request.method == 'GET':
-        if request_wants_json():
+        if wants_json:
             return jsonerror(405, {'error': "Please submit POST request."})
         else:
             return render_template('info.html',
@@ -44,35 +62,47 @@ def send(email_or_string):
 
     host = referrer_to_path(request.referrer)
     if not host:
-        if request_wants_json():
+        if wants_json:
             return jsonerror(400, {'error': "Invalid \"Referrer\" header"})
         else:
             return render_template('error.html',
                                    title='Unable to submit form',
                                    text='<p>Make sure you open this page through a web server, Formspree will not work in pages browsed as HTML files. Also make sure that you\'re posting to <b>https://</b>{host}.</p><p>For geeks: could not find the "Referrer" header.</p>'.format(host=request.url.split('//')[1])), 400
 
-    g.log = g.log.bind(host=host, wants='json' if request_wants_json() else 'html')
+    g.log = g.log.bind(host=host, wants='json' if wants_json else 'html')
 
     g.log.info('Received submission.')
+
+    payload = Form.parse_submission(request.form or request.get_json() or {},
+                                    request.referrer)
+    status = Form.reject_early(payload)
+    if status:
+        return submission_response(status, wants_json)
+
+    # the form is resolved from a cached snapshot, so submissions
+    # that are going to be rejected never reach the database.
     if not IS_VALID_EMAIL(email_or_string):
         # in this case it can be a hashid identifying a
         # form generated from the dashboard
         hashid = email_or_string
-        form = Form.get_with_hashid(hashid)
+        snapshot = cache.get_by_hashid(hashid)
 
-        if form:
-            if form.disabled:
+        if snapshot:
+            if snapshot.disabled:
                 # owner has disabled the form, so it should not receive any submissions
-                if request_wants_json():
+                if wants_json:
                     return jsonerror(403, {'error': 'Form not active'})
                 else:
                     return render_template('error.html',
                                            title='Form not active',
                                            text='The owner of this form has disabled this form and it is no longer accepting submissions. Your submissions was not accepted'), 403
-            email = form.email
+            email = snapshot.email
 
-            if not form.host:
+            if not snapshot.host:
                 # add the host to the form
+                form = Form.query.get(snapshot.id)
+                if not form:
+                    return form_not_found(snapshot, email_or_string, wants_json)
                 form.host = host
                 DB.session.add(form)
                 DB.session.commit()
@@ -80,65 +110,196 @@ def send(email_or_string):
                 # it is an error when
                 #   form is sitewide, but submission came from a host rooted somewhere else, or
                 #   form is not sitewide, and submission came from a different host
-            elif (not form.sitewide and form.host != host) or (
-                   form.sitewide and (
-                     not host.startswith(form.host) and \
-                     not remove_www(host).startswith(form.host)
-                   )
-                 ):
+            elif not from_confirmed_host(snapshot, host):
                 g.log.info('Submission rejected. From a different host than confirmed.')
-                if request_wants_json():
+                if wants_json:
                     return jsonerror(403, {
                        'error': "Submission from different host than confirmed",
-                       'submitted': host, 'confirmed': form.host
+                       'submitted': host, 'confirmed': snapshot.host
                     })
                 else:
                     return render_template('error.html',
                                            title='Check form address',
                                            text='This submission came from "%s" but the form was\
-                                                 confirmed for address "%s"' % (host, form.host)), 403
+                                                 confirmed for address "%s"' % (host, snapshot.host)), 403
         else:
             # no form row found. it is an error.
-            g.log.info('Submission rejected. No form found for this target.')
-            if request_wants_json():
-                return jsonerror(400, {'error': "Invalid email address"})
-            else:
-                return render_template('error.html',
-                                       title='Check email address',
-                                       text='Email address %s is not formatted correctly' \
-                                            % str(email_or_string)), 400
+            return form_not_found(None, email_or_string, wants_json)
     else:
         # in this case, it is a normal email
         email = email_or_string.lower()
 
         # get the form for this request
-        form = Form.query.filter_by(hash=HASH(email, host)).first() \
-               or Form(email, host) # or create it if it doesn't exists
-        if form.disabled:
+        snapshot = cache.get_by_hash(HASH(email, host))
+        if snapshot and snapshot.disabled:
             g.log.info('submission rejected. Form is disabled.')
-            if request_wants_json():
+            if wants_json:
                 return jsonerror(403, {'error': 'Form not active'})
             else:
                 return render_template('error.html',
                                        title='Form not active',
                                        text='The owner of this form has disabled this form and it is no longer accepting submissions. Your submissions was not accepted'), 403
 
+    if snapshot and snapshot.confirmed and Form.is_hard_overlimit(snapshot.id):
+        # this form has been rejecting submissions for the rest of the month
+        g.log.info('Submission rejected. Form over quota.')
+        return submission_response({'code': Form.STATUS_OVERLIMIT}, wants_json)
+
+    # the submission is accepted, load the actual form
+    # (or, for an email, create it if it doesn't exists)
+    form = Form.query.get(snapshot.id) if snapshot else None
+    if not form and not IS_VALID_EMAIL(email_or_string):
+        return form_not_found(snapshot, email_or_string, wants_json)
+    if not form:
+        form = Form.get_or_create(email, host)
+        DB.session.commit()
+
     # If form exists and is confirmed, send email
     # otherwise send a confirmation email
-    received_data = request.form or request.get_json() or {}
     if form.confirmed:
-        status = form.send(received_data, request.referrer)
+        status = form.send(payload)
+    else:
+        status = form.send_confirmation(payload)
+
+    return submission_response(status, wants_json, email=email, host=host)
+
+
+def form_not_found(snapshot, target, wants_json):
+    '''
+    The response to a submission to a hashid with no form. A snapshot of
+    the form, if still cached, is dropped.
+    '''
+    if snapshot:
+        cache.invalidate(snapshot.id, snapshot.hash)
+
+    g.log.info('Submission rejected. No form found for this target.')
+    if wants_json:
+        return jsonerror(400, {'error': "Invalid email address"})
+    else:
+        return render_template('error.html',
+                               title='Check email address',
+                               text='Email address %s is not formatted correctly' \
+                                    % str(target)), 400
+
+
+def from_confirmed_host(snapshot, host):
+    '''
+    Whether a submission from `host` is acceptable for the form:
+    sitewide forms take submissions from any page rooted at their host,
+    other forms only from the exact page they were confirmed on.
+    '''
+    if snapshot.sitewide:
+        return host.startswith(snapshot.host) or \
+               remove_www(host).startswith(snapshot.host)
+    return snapshot.host == host
+
+
+def send_batch(hashid):
+    '''
+    Accepts many submissions to a confirmed dashboard form in a single
+    request, for sites that relay submissions from their own servers.
+    The body is a JSON list of submissions, or an object with that list
+    under "submissions" and "delivery" set to "combined" (the default,
+    one email listing every submission) or "individual" (one email per
+    submission).
+
+    The batch is validated as a whole before anything is stored: if a
+    submission is empty or has an invalid reply-to address the batch is
+    rejected. Spam submissions are dropped.
+    '''
+
+    g.log = g.log.bind(target=hashid)
+
+    host = referrer_to_path(request.referrer)
+    if not host:
+        return jsonerror(400, {'error': "Invalid \"Referrer\" header"})
+
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        submissions = body.get('submissions')
+        delivery = body.get('delivery', 'combined')
+    else:
+        submissions = body
+        delivery = 'combined'
+
+    if not isinstance(submissions, list) or not submissions or \
+       not all(isinstance(s, dict) for s in submissions):
+        return jsonerror(400, {'error': "Send a list of submissions"})
+    if len(submissions) > settings.BATCH_SUBMISSIONS_LIMIT:
+        return jsonerror(413, {'error': "Too many submissions in a single batch",
+                               'limit': settings.BATCH_SUBMISSIONS_LIMIT})
+    if delivery not in ('combined', 'individual'):
+        return jsonerror(400, {'error': "delivery must be \"combined\" or \"individual\""})
+
+    g.log = g.log.bind(host=host, batch=len(submissions), delivery=delivery)
+    g.log.info('Received batch of submissions.')
+
+    payloads = []
+    invalid = []
+    for index, submitted_data in enumerate(submissions):
+        payload = Form.parse_submission(submitted_data, request.referrer)
+        status = Form.reject_early(payload)
+        if not status:
+            payloads.append(payload)
+        elif status['code'] == Form.STATUS_EMAIL_EMPTY:
+            invalid.append({'index': index, 'error': "Can't send an empty form"})
+        elif status['code'] == Form.STATUS_REPLYTO_ERROR:
+            invalid.append({'index': index, 'error': "Invalid _replyto or email field"})
+        # otherwise it is spam, which is silently dropped
+
+    if invalid:
+        g.log.info('Batch rejected. Invalid submissions.', invalid=len(invalid))
+        return jsonerror(400, {'error': "Invalid submissions in batch", 'invalid': invalid})
+
+    snapshot = cache.get_by_hashid(hashid)
+    if not snapshot:
+        return jsonerror(404, {'error': "Form not found"})
+    if snapshot.disabled:
+        return jsonerror(403, {'error': 'Form not active'})
+    if not snapshot.confirmed or not snapshot.host:
+        return jsonerror(403, {'error': "Form not confirmed. Submit to it once before sending batches"})
+    if not from_confirmed_host(snapshot, host):
+        g.log.info('Batch rejected. From a different host than confirmed.')
+        return jsonerror(403, {
+           'error': "Submission from different host than confirmed",
+           'submitted': host, 'confirmed': snapshot.host
+        })
+    if Form.is_hard_overlimit(snapshot.id):
+        g.log.info('Batch rejected. Form over quota.')
+        return jsonerror(402, {'error': "form over quota"})
+
+    if payloads:
+        form = Form.query.get(snapshot.id)
+        if not form:
+            cache.invalidate(snapshot.id, snapshot.hash)
+            return jsonerror(404, {'error': "Form not found"})
+        status = form.send_batch(payloads, combined=delivery == 'combined')
+        metrics.increment('formspree_submissions_total', amount=len(payloads),
+                          status=Form.status_name(status['code']))
     else:
-        status = form.send_confirmation(received_data)
+        status = {'code': Form.STATUS_EMAIL_SENT}
 
-    # Respond to the request accordingly to the status code
     if status['code'] == Form.STATUS_EMAIL_SENT:
-        if request_wants_json():
+        return jsonify({'success': "submissions received", 'received': len(submissions)})
+    elif status['code'] == Form.STATUS_OVERLIMIT:
+        return jsonerror(402, {'error': "form over quota"})
+    return jsonerror(500, {'error': "Unable to send email"})
+
+
+def submission_response(status, wants_json, email=None, host=None):
+    '''
+    The response to a submission, according to its status code.
+    '''
+
+    metrics.increment('formspree_submissions_total', status=Form.status_name(status['code']))
+
+    if status['code'] == Form.STATUS_EMAIL_SENT:
+        if wants_json:
             return jsonify({'success': "email sent", 'next': status['next']})
         else:
             return redirect(status['next'], code=302)
     elif status['code'] == Form.STATUS_EMAIL_EMPTY:
-        if request_wants_json():
+        if wants_json:
             return jsonerror(400, {'error': "Can't send an empty form"})
         else:
             return render_template('error.html',
@@ -147,7 +308,7 @@ def send(email_or_string):
     elif status['code'] == Form.STATUS_CONFIRMATION_SENT or \
          status['code'] == Form.STATUS_CONFIRMATION_DUPLICATED:
 
-        if request_wants_json():
+        if wants_json:
             return jsonify({'success': "confirmation email sent"})
         else:
             return render_template('forms/confirmation_sent.html',
@@ -156,19 +317,19 @@ def send(email_or_string):
                 resend=status['code'] == Form.STATUS_CONFIRMATION_DUPLICATED
             )
     elif status['code'] == Form.STATUS_OVERLIMIT:
-        if request_wants_json():
+        if wants_json:
             return jsonify({'error': "form over quota"})
         else:
             return render_template('error.html', title='Form over quota', text='It looks like this form is getting a lot of submissions and ran out of its quota. Try contacting this website through other means or try submitting again later.'), 402
 
     elif status['code'] == Form.STATUS_REPLYTO_ERROR:
-        if request_wants_json():
+        if wants_json:
             return jsonerror(500, {'error': "_replyto or email field has not been sent correctly"})
         else:
             return render_template('error.html', title='Invalid email address', text='You entered <span class="code">{address}</span>. That is an invalid email address. Please correct the form and try to submit again <a href="{back}">here</a>.<p style="font-size: small">This could also be a problem with the form. For example, there could be two fields with <span class="code">_replyto</span> or <span class="code">email</span> name attribute. If you suspect the form is broken, please contact the form owner and ask them to investigate</p>'''.format(address=status['address'], back=status['referrer'])), 400
 
     # error fallback -- shouldn't happen
-    if request_wants_json():
+    if wants_json:
         return jsonerror(500, {'error': "Unable to send email"})
     else:
         return render_template('error.html',
@@ -181,24 +342,17 @@ def resend_confirmation(email):
     g.log.info('Resending confirmation.')
 
     # the first thing to do is to check the captcha
-    r = requests.post('https://www.google.com/recaptcha/api/siteverify', data={
+    r = outbound.post('https://www.google.com/recaptcha/api/siteverify', data={
         'secret': settings.RECAPTCHA_SECRET,
         'response': request.form['g-recaptcha-response'],
         'remoteip': request.remote_addr
     })
     if r.ok and r.json().get('success'):
-        # then proceed to check if this email is listed on SendGrid's bounces
-        r = requests.get('https://api.sendgrid.com/api/bounces.get.json',
-            params={
-                'email': email,
-                'api_user': settings.SENDGRID_USERNAME,
-                'api_key': settings.SENDGRID_PASSWORD
-            }
-        )
-        if r.ok and len(r.json()) and 'reason' in r.json()[0]:
+        # then proceed to check if this email bounced before
+        reason = Suppression.reason_for(email)
+        if reason:
             # tell the user to verify his mailbox
-            reason = r.json()[0]['reason']
-            g.log.info('Email is blocked on SendGrid. Telling the user.')
+            g.log.info('Email is suppressed. Telling the user.')
             if request_wants_json():
                 resp = jsonify({'error': "Verify your mailbox, we can't reach it.", 'reason': reason})
             else:
@@ -219,6 +373,8 @@ def resend_confirmation(email):
                                        title='Check email address',
                                        text='This form does not exist.'), 400
         form.confirm_sent = False
+        DB.session.add(form)
+        DB.session.commit()
         status = form.send_confirmation()
         if status['code'] == Form.STATUS_CONFIRMATION_SENT:
             if request_wants_json():
@@ -237,28 +393,40 @@ def resend_confirmation(email):
                            text='Please make sure you pass the <i>reCaptcha</i> test before submitting.'), 500
 
 
+def sendgrid_webhook():
+    '''
+    Receives SendGrid's event webhook, a JSON list of delivery events,
+    and suppresses the addresses that bounced or reported spam.
+    '''
+    if not settings.SENDGRID_WEBHOOK_TOKEN:
+        return jsonerror(404, {'error': "Not found"})
+    if not hmac.compare_digest(str(request.args.get('token', '')),
+                               settings.SENDGRID_WEBHOOK_TOKEN):
+        return jsonerror(401, {'error': "Invalid token"})
+
+    events = request.get_json(silent=True)
+    if not isinstance(events, list):
+        return jsonerror(400, {'error': "Send a list of events"})
+
+    suppressed = Suppression.record([e for e in events if isinstance(e, dict)])
+    g.log.info('Webhook from SendGrid', events=len(events), suppressed=suppressed)
+    return 'ok'
+
+
 def unblock_email(email):
     if request.method == 'POST':
         g.log = g.log.bind(email=email)
-        g.log.info('Unblocking email on SendGrid.')
+        g.log.info('Unblocking email.')
 
         # check the captcha
-        r = requests.post('https://www.google.com/recaptcha/api/siteverify', data={
+        r = outbound.post('https://www.google.com/recaptcha/api/siteverify', data={
             'secret': settings.RECAPTCHA_SECRET,
             'response': request.form['g-recaptcha-response'],
             'remoteip': request.remote_addr
         })
         if r.ok and r.json().get('success'):
-            # then proceed to clear the bounce from SendGrid
-            r = requests.post(
-                'https://api.sendgrid.com/api/bounces.delete.json',
-                data={
-                    'email': email,
-                    'api_user': settings.SENDGRID_USERNAME,
-                    'api_key': settings.SENDGRID_PASSWORD
-                }
-            )
-            if r.ok and r.json()['message'] == 'success':
+            # then proceed to clear the bounce
+            if Suppression.remove(email):
                 g.log.info('Unblocked address.')
                 return render_template('info.html',
                                        title='Successfully unblocked email address!',
@@ -332,6 +500,8 @@ def forms():
         })
     else:
         return render_template('forms/list.html',
+            counters=Form.total_counters(forms),
+            sitewide_checks=pending_sitewide_checks(forms),
             enabled_forms=[form for form in forms if not form.disabled],
             disabled_forms=[form for form in forms if form.disabled]
         )
@@ -368,14 +538,21 @@ def create_form():
 
     email = email.lower() # case-insensitive
     form = Form(email, owner=current_user)
+    pending = False
     if url:
         url = 'http://' + url if not url.startswith('http') else url
         form.host = referrer_to_path(url)
 
         # sitewide forms, verified with a file at the root of the target domain
-        if sitewide:
+        # (later, by the sitewide worker, unless we already know the answer)
+        if sitewide and settings.SITEWIDE_CHECK_ASYNC and \
+           cached_sitewide_check(url, email) is None:
+            form.host = None
+            form.disabled = True
+            pending = True
+        elif sitewide:
             if sitewide_file_check(url, email):
-                form.host = remove_www(referrer_to_path(urljoin(url, '/'))[:-1])
+                form.host = sitewide_host(url)
                 form.sitewide = True
             else:
                 return jsonerror(403, {'error': "Couldn't verify the file at %s." % url})
@@ -383,28 +560,24 @@ def create_form():
     DB.session.add(form)
     DB.session.commit()
 
-    if form.host:
+    if pending:
+        enqueue_sitewide_check(form, url)
+    elif form.host:
         # when the email and url are provided, we can automatically confirm the form
         # but only if the email is registered for this account
-        for email in current_user.emails:
-            if email.address == form.email:
-                g.log.info('No need for email confirmation.')
-                form.confirmed = True
-                DB.session.add(form)
-                DB.session.commit()
-                break
-        else:
-            # in case the email isn't registered for this user
-            # we automatically send the email confirmation
-            form.send_confirmation()
+        form.confirm_for_owner()
 
     if request_wants_json():
         return jsonify({
             'ok': True,
             'hashid': form.hashid,
             'submission_url': settings.API_ROOT + '/' + form.hashid,
-            'confirmed': form.confirmed
+            'confirmed': form.confirmed,
+            'pending': pending
         })
+    elif pending:
+        flash('Your new form endpoint was created! It will be enabled as soon as %s is verified.' % urljoin(url, '/formspree-verify.txt'), 'success')
+        return redirect(url_for('dashboard'))
     else:
         flash('Your new form endpoint was created!', 'success')
         return redirect(url_for('dashboard', new=form.hashid) + '#form-' + form.hashid)
@@ -436,15 +609,25 @@ def form_submissions(hashid, format=None):
         else:
             return redirect(url_for('dashboard'))
 
-    submissions = form.submissions
-
     if not format:
-        # normal request.
+        # normal request, paginated by submission id.
+        limit = min(request.args.get('limit', settings.SUBMISSIONS_PAGE_SIZE, type=int),
+                    settings.SUBMISSIONS_PAGE_MAX_SIZE)
+        if limit < 1:
+            return jsonerror(400, {'error': "Invalid limit."})
+        submissions, next_id = form.submissions_page(
+            after_id=request.args.get('after_id', type=int),
+            limit=limit
+        )
+        next_url = url_for('form-submissions', hashid=hashid,
+                           after_id=next_id, limit=limit) if next_id else None
+
         if request_wants_json():
             return jsonify({
                 'host': form.host,
                 'email': form.email,
-                'submissions': [dict(s.data, date=s.submitted_at.isoformat()) for s in submissions]
+                'submissions': [dict(s.data, date=s.submitted_at.isoformat()) for s in submissions],
+                'next': next_url
             })
         else:
             fields = set()
@@ -455,35 +638,66 @@ def form_submissions(hashid, format=None):
             return render_template('forms/submissions.html',
                 form=form,
                 fields=sorted(fields),
-                submissions=submissions
+                submissions=submissions,
+                next_url=next_url
             )
     elif format:
-        # an export request, format can be json or csv
+        # an export request, format can be json, ndjson or csv
         if format == 'json':
+            def generate():
+                # the same document json.dumps(..., indent=2) would give,
+                # written one submission at a time
+                yield '{\n  "email": %s,\n  "host": %s,\n  "submissions": [' % \
+                    (json.dumps(form.email), json.dumps(form.host))
+                separator = '\n'
+                for sub in form.iter_submissions():
+                    item = json.dumps(dict(sub.data, date=sub.submitted_at.isoformat()),
+                                      sort_keys=True, indent=2, separators=(',', ': '))
+                    yield separator + '    ' + item.replace('\n', '\n    ')
+                    separator = ',\n'
+                yield '\n  ]\n}'
+
             return Response(
-                json.dumps({
-                    'host': form.host,
-                    'email': form.email,
-                    'submissions': [dict(s.data, date=s.submitted_at.isoformat()) for s in submissions]
-                }, sort_keys=True, indent=2),
+                stream_with_context(generate()),
                 mimetype='application/json',
                 headers={
                     'Content-Disposition': 'attachment; filename=form-%s-submissions-%s.json' \
                                 % (hashid, datetime.datetime.now().isoformat().split('.')[0])
                 }
             )
+        elif format == 'ndjson':
+            def generate():
+                for sub in form.iter_submissions():
+                    yield json.dumps(dict(sub.data, date=sub.submitted_at.isoformat()),
+                                     sort_keys=True) + '\n'
+
+            return Response(
+                stream_with_context(generate()),
+                mimetype='application/x-ndjson',
+                headers={
+                    'Content-Disposition': 'attachment; filename=form-%s-submissions-%s.ndjson' \
+                                % (hashid, datetime.datetime.now().isoformat().split('.')[0])
+                }
+            )
         elif format == 'csv':
-            out = io.BytesIO()
-            fieldnames = set(field for sub in submissions for field in sub.data.keys())
-            fieldnames = ['date'] + sorted(fieldnames)
-            
-            w = csv.DictWriter(out, fieldnames=fieldnames, encoding='utf-8')
-            w.writeheader()
-            for sub in submissions:
-                w.writerow(dict(sub.data, date=sub.submitted_at.isoformat()))
+            fieldnames = ['date'] + sorted(form.submission_fields())
+
+            def generate():
+                # rows are written to a small buffer that is flushed
+                # whenever it fills up, so the export is never held whole
+                out = io.BytesIO()
+                w = csv.DictWriter(out, fieldnames=fieldnames, encoding='utf-8')
+                w.writeheader()
+                for sub in form.iter_submissions():
+                    w.writerow(dict(sub.data, date=sub.submitted_at.isoformat()))
+                    if out.tell() >= 16384:
+                        yield out.getvalue()
+                        out.seek(0)
+                        out.truncate()
+                yield out.getvalue()
 
             return Response(
-                out.getvalue(),
+                stream_with_context(generate()),
                 mimetype='text/csv',
                 headers={
                     'Content-Disposition': 'attachment; filename=form-%s-submissions-%s.csv' \
@@ -524,6 +738,46 @@ def form_toggle(hashid):
         return redirect(url_for('dashboard'))
 
 
+@login_required
+def form_digest(hashid):
+    form = Form.get_with_hashid(hashid)
+
+    # check that this request came from user dashboard to prevent XSS and CSRF
+    referrer = referrer_to_baseurl(request.referrer)
+    service = referrer_to_baseurl(settings.SERVICE_URL)
+    if referrer != service:
+        return render_template('error.html',
+                               title='Improper Request',
+                               text='The request you made is not valid.<br />Please visit your dashboard and try again.'), 400
+
+    if not form:
+        return render_template('error.html',
+                               title='Not a valid form',
+                               text='That form does not exist.<br />Please check the link and try again.'), 400
+    if form.owner_id != current_user.id and form not in current_user.forms:
+        return render_template('error.html',
+                               title='Wrong user',
+                               text='You aren\'t the owner of that form.<br />Please log in as the form owner and try again.'), 400
+
+    digest = request.form.get('digest') or None
+    if digest and digest not in Form.DIGEST_PERIODS:
+        return render_template('error.html',
+                               title='Invalid digest',
+                               text='Submissions can be sent right away or in an hourly or daily digest.'), 400
+
+    form.digest = digest
+    DB.session.add(form)
+    DB.session.commit()
+
+    if digest:
+        flash('Submissions will be sent in a%s digest' % (' daily' if digest == 'daily' else 'n hourly'), 'success')
+    else:
+        # don't make the owner wait for what was held for the digest
+        form.send_digest()
+        flash('Submissions will be sent right away', 'success')
+    return redirect(url_for('dashboard'))
+
+
 @login_required
 def form_deletion(hashid):
     form = Form.get_with_hashid(hashid)
@@ -550,6 +804,7 @@ def form_deletion(hashid):
             DB.session.delete(submission)
         DB.session.delete(form)
         DB.session.commit()
+        forget_sitewide_check(form.id)
         flash('Form successfully deleted', 'success')
         return redirect(url_for('dashboard'))
 
@@ -582,7 +837,7 @@ def submission_deletion(hashid, submissionid):
                               text='That submission does not match the form provided.<br />Please check the link and try again.'), 400
     else:
         DB.session.delete(submission)
-        form.counter -= 1
+        form.increment_counter(-1)
         DB.session.add(form)
         DB.session.commit()
         flash('Submission successfully deleted', 'success')
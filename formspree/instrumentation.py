@@ -0,0 +1,143 @@
+import time
+from contextlib import contextmanager
+
+from flask import g, request, has_app_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from formspree import settings
+
+# Per-request latency breakdown. Time spent in Postgres, Redis, outbound
+# HTTP calls and template rendering is added up in `g.timings` and
+# logged in a single line when the request ends, together with the time
+# the request waited in the Heroku router (from X-Request-Start).
+
+COMPONENTS = ['db', 'redis', 'http', 'template']
+
+_listening = False
+
+
+def record(component, started):
+    timings = getattr(g, 'timings', None) if has_app_context() else None
+    if timings is not None:
+        spent, calls = timings.get(component, (0, 0))
+        timings[component] = (spent + time.time() - started, calls + 1)
+
+
+@contextmanager
+def timed(component):
+    started = time.time()
+    try:
+        yield
+    finally:
+        record(component, started)
+
+
+def timed_function(component, f):
+    def wrapper(*args, **kwargs):
+        with timed(component):
+            return f(*args, **kwargs)
+    return wrapper
+
+
+class TimedPipeline(object):
+    '''
+    Wraps a redis pipeline so its single round trip is timed.
+    '''
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def execute(self, *args, **kwargs):
+        with timed('redis'):
+            return self.pipe.execute(*args, **kwargs)
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        with timed('template'):
+            return Template.render(self, *args, **kwargs)
+
+
+# the start time goes on the execution context, which is discarded
+# along with it when a statement fails and after_cursor_execute never runs.
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_start', None)
+    if started is not None:
+        record('db', started)
+
+
+def instrument_redis(redis_store):
+    '''
+    Replaces the connection methods `flask_redis` copied to
+    `redis_store` with timed ones.
+    '''
+    for name, method in redis_store.__dict__.items():
+        if name.startswith('_') or not hasattr(type(redis_store.connection), name):
+            continue
+        if name in ('pipeline', 'pubsub'):
+            continue
+        redis_store.__dict__[name] = timed_function('redis', method)
+
+    pipeline = redis_store.pipeline
+    redis_store.__dict__['pipeline'] = lambda *args, **kwargs: \
+        TimedPipeline(pipeline(*args, **kwargs))
+
+
+def queue_time(started):
+    '''
+    Milliseconds between the router receiving the request (in ms or,
+    as some proxies send it, in us since the epoch) and us starting it.
+    '''
+    header = request.headers.get('X-Request-Start', '')
+    try:
+        received = int(header.replace('t=', ''))
+    except ValueError:
+        return None
+    if received > 10 ** 14:
+        received /= 1000.0
+    return max(0, int(started * 1000 - received))
+
+
+def configure(app, redis_store):
+    global _listening
+
+    if not settings.REQUEST_TIMINGS:
+        return
+
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+        _listening = True
+    instrument_redis(redis_store)
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_timings():
+        g.timings = {}
+        g.timings_started = time.time()
+
+    @app.teardown_request
+    def log_timings(exc):
+        timings = getattr(g, 'timings', None)
+        if timings is None or not hasattr(g, 'log'):
+            return
+
+        fields = {'total_ms': int((time.time() - g.timings_started) * 1000),
+                  'queue_ms': queue_time(g.timings_started)}
+        for component in COMPONENTS:
+            spent, calls = timings.get(component, (0, 0))
+            fields[component + '_ms'] = int(spent * 1000)
+            fields[component + '_calls'] = calls
+        g.log.info('Request timings.', **fields)
+        del g.timings
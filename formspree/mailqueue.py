@@ -0,0 +1,64 @@
+import json
+import time
+import requests
+
+from flask import g
+
+from formspree import settings
+from formspree.app import redis_store
+
+
+def enqueue(message):
+    '''
+    Pushes an already rendered message (the payload built by
+    `utils.send_email`) to the outbound mail queue.
+    '''
+
+    job = {'message': message, 'queued_at': time.time(), 'attempts': 0}
+    redis_store.rpush(settings.MAIL_QUEUE_KEY, json.dumps(job))
+
+
+def stats():
+    '''
+    Depth of the queue and age (in seconds) of its oldest message,
+    for monitoring.
+    '''
+
+    depth = redis_store.llen(settings.MAIL_QUEUE_KEY)
+    oldest = redis_store.lindex(settings.MAIL_QUEUE_KEY, 0)
+    age = time.time() - json.loads(oldest)['queued_at'] if oldest else 0
+    return {'depth': depth, 'age': age}
+
+
+def process(deliver, timeout=5):
+    '''
+    Pops one message from the queue and hands it to `deliver`, which
+    should behave like `utils.deliver_email`. Messages that fail with a
+    server error, or that couldn't reach the server at all, are pushed
+    back to the end of the queue until they reach MAIL_QUEUE_MAX_ATTEMPTS.
+
+    Returns None when the queue was empty, or the result of `deliver`.
+    '''
+
+    item = redis_store.blpop([settings.MAIL_QUEUE_KEY], timeout)
+    if not item:
+        return None
+
+    job = json.loads(item[1])
+    try:
+        result = deliver(job['message'])
+        retry = not result[0] and result[2] / 100 == 5
+    except requests.RequestException as e:
+        g.log.warning('Email could not be sent.', err=str(e))
+        result = False, str(e), None
+        retry = True
+
+    if retry:
+        job['attempts'] += 1
+        if job['attempts'] < settings.MAIL_QUEUE_MAX_ATTEMPTS:
+            g.log.info('Requeueing email.', attempts=job['attempts'])
+            redis_store.rpush(settings.MAIL_QUEUE_KEY, json.dumps(job))
+        else:
+            g.log.error('Giving up on email.', attempts=job['attempts'])
+
+    return result
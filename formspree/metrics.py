@@ -0,0 +1,146 @@
+import re
+import hmac
+import time
+import urlparse
+
+import redis
+from flask import g, request, abort, Response, has_app_context
+
+from formspree import settings
+
+# Counters and latency histograms, kept in a single redis hash so every
+# worker on every dyno adds to the same numbers, and exposed in the
+# Prometheus text format at /metrics when METRICS is enabled.
+#
+# Observations made while serving a request are written together, in
+# one pipeline, when the request ends.
+
+METRICS_KEY = 'metrics'
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+FAMILIES = [
+    ('formspree_request_duration_seconds', 'histogram',
+        'Time spent serving requests, by endpoint and status code.'),
+    ('formspree_submissions_total', 'counter',
+        'Form submissions, by result (Form.STATUS_*).'),
+    ('formspree_outbound_duration_seconds', 'histogram',
+        'Time spent in calls to external services, by host and status code.'),
+]
+
+
+def labelset(labels):
+    return ','.join('%s="%s"' % (k, labels[k]) for k in sorted(labels))
+
+
+def increment(name, amount=1, **labels):
+    _write([(name + '{' + labelset(labels) + '}', amount)])
+
+
+def observe(name, seconds, **labels):
+    ops = [(name + '_count{' + labelset(labels) + '}', 1),
+           (name + '_sum{' + labelset(labels) + '}', seconds)]
+    for le in BUCKETS + ['+Inf']:
+        # every bucket is written, so empty ones are listed too
+        hit = le == '+Inf' or seconds <= le
+        ops.append((name + '_bucket{' + labelset(dict(labels, le=le)) + '}', int(hit)))
+    _write(ops)
+
+
+def _write(ops):
+    if not settings.METRICS:
+        return
+
+    pending = getattr(g, 'metrics_pending', None) if has_app_context() else None
+    if pending is not None:
+        pending.extend(ops)
+    else:
+        _flush(ops)
+
+
+def _flush(ops):
+    from formspree.app import redis_store
+
+    if not ops:
+        return
+    try:
+        pipe = redis_store.pipeline(transaction=False)
+        for field, amount in ops:
+            if isinstance(amount, float):
+                pipe.hincrbyfloat(METRICS_KEY, field, amount)
+            else:
+                pipe.hincrby(METRICS_KEY, field, amount)
+        pipe.execute()
+    except redis.RedisError as e:
+        if has_app_context() and hasattr(g, 'log'):
+            g.log.warning('Failed to record metrics.', error=str(e))
+
+
+def observe_outbound(url, started, status):
+    observe('formspree_outbound_duration_seconds', time.time() - started,
+            host=urlparse.urlparse(url).netloc, status=status)
+
+
+def render():
+    '''
+    The metrics in the Prometheus text format.
+    '''
+    from formspree.app import redis_store
+
+    values = redis_store.hgetall(METRICS_KEY)
+
+    def order(field):
+        le = re.search(r'le="([^"]+)"', field)
+        return (re.sub(r',?le="[^"]+"', '', field), float(le.group(1)) if le else 0)
+
+    lines = []
+    for name, kind, help in FAMILIES:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        fields = [f for f in values if f.split('{')[0] in
+                  (name, name + '_count', name + '_sum', name + '_bucket')]
+        for field in sorted(fields, key=order):
+            lines.append('%s %s' % (field, values[field]))
+    return '\n'.join(lines) + '\n'
+
+
+def view():
+    if not settings.METRICS:
+        abort(404)
+
+    token = request.headers.get('Authorization', '').replace('Bearer ', '', 1) or \
+        request.args.get('token', '')
+    if not settings.METRICS_TOKEN or not hmac.compare_digest(str(token), settings.METRICS_TOKEN):
+        abort(401)
+
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def configure(app):
+    if not settings.METRICS:
+        return
+
+    @app.before_request
+    def start_metrics():
+        g.metrics_pending = []
+        g.metrics_started = time.time()
+
+    @app.after_request
+    def observe_request(response):
+        if hasattr(g, 'metrics_started'):
+            observe('formspree_request_duration_seconds', time.time() - g.metrics_started,
+                    endpoint=request.endpoint or 'none', status=response.status_code)
+            g.metrics_observed = True
+        return response
+
+    @app.teardown_request
+    def flush_metrics(exc):
+        if hasattr(g, 'metrics_started') and not getattr(g, 'metrics_observed', False):
+            # the request failed with an unhandled exception
+            observe('formspree_request_duration_seconds', time.time() - g.metrics_started,
+                    endpoint=request.endpoint or 'none', status=500)
+
+        ops = getattr(g, 'metrics_pending', None)
+        for attr in ('metrics_pending', 'metrics_started', 'metrics_observed'):
+            g.pop(attr, None)
+        if ops:
+            _flush(ops)
@@ -0,0 +1,79 @@
+import os
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+from formspree import settings
+from formspree import metrics
+from formspree.instrumentation import timed
+
+# a keep-alive session shared by every outbound API call made by this
+# worker process (SendGrid, reCaptcha, sitewide verification files), so
+# the submission path doesn't pay a new TCP+TLS handshake each time.
+_session = None
+_pid = None
+
+
+def session():
+    global _session, _pid
+
+    # gunicorn forks workers after the app may have been loaded, so
+    # each process must open its own connections.
+    if _session is None or _pid != os.getpid():
+        adapter = HTTPAdapter(pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                              pool_maxsize=settings.HTTP_POOL_MAXSIZE)
+        _session = requests.Session()
+        _session.mount('https://', adapter)
+        _session.mount('http://', adapter)
+        _pid = os.getpid()
+    return _session
+
+
+def get(url, **kwargs):
+    return request('get', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('post', url, **kwargs)
+
+
+def request(method, url, **kwargs):
+    started = time.time()
+    status = 'error'
+    try:
+        with timed('http'):
+            r = session().request(method, url, **kwargs)
+        status = r.status_code
+        return r
+    finally:
+        metrics.observe_outbound(url, started, status)
+
+
+def warm():
+    '''
+    Opens connections to the hosts we talk to on the hot path,
+    so the first submissions served by a new worker reuse them.
+    '''
+
+    for url in settings.HTTP_WARM_URLS:
+        try:
+            session().head(url, timeout=2)
+        except requests.RequestException:
+            pass
+
+
+def stats():
+    '''
+    How many requests this worker made and how many of them
+    needed a new connection.
+    '''
+
+    connections, reqs = 0, 0
+    for adapter in set(session().adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            reqs += pool.num_requests
+    return {'requests': reqs, 'connections': connections,
+            'reused': reqs - connections}
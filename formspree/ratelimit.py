@@ -0,0 +1,121 @@
+import time
+import threading
+
+from flask import g, request, abort, current_app
+from flask_limiter.util import get_ipaddr
+
+from formspree import settings
+
+# In-process token buckets checked before the Redis-backed Flask-Limiter.
+# They are much more generous than RATE_LIMIT and only meant to turn
+# away obvious floods without a round trip to Redis; Flask-Limiter is
+# still the limit that counts across workers and dynos.
+#
+# Every IP has a bucket, and every form has another one for
+# submissions, so a single form being flooded from many addresses is
+# turned away too. Buckets are per process and start over on restart.
+
+_buckets = {}
+_lock = threading.Lock()
+_exempt_routes = set()
+
+# the endpoints that submit to a form, and the view argument naming it
+FORM_ENDPOINTS = {'send': 'email_or_string', 'send-batch': 'hashid'}
+
+
+def form_key(target):
+    '''
+    Names the form a submission goes to the way `send` looks it up: by
+    hashid, or by the lowercased email and the host in the referrer.
+    '''
+    # imported here, as both import the app this module is part of
+    from formspree.utils import IS_VALID_EMAIL
+    from formspree.forms.helpers import referrer_to_path
+
+    target = target.lower().strip()
+    if IS_VALID_EMAIL(target):
+        return ('form', target, referrer_to_path(request.referrer))
+    return ('form', target)
+
+
+def exempt(view):
+    '''
+    Skips the local buckets for a view, like `Limiter.exempt`.
+    '''
+    _exempt_routes.add('%s.%s' % (view.__module__, view.__name__))
+    return view
+
+
+def reset():
+    with _lock:
+        _buckets.clear()
+
+
+def take(key, burst, per_minute):
+    '''
+    Takes a token from the bucket of `key`, which holds up to `burst`
+    tokens and gets `per_minute` back every minute. Returns False when
+    the bucket is empty.
+    '''
+    now = time.time()
+    with _lock:
+        if key in _buckets:
+            tokens = _refilled(_buckets[key], now)
+        else:
+            if len(_buckets) >= settings.LOCAL_RATE_LIMIT_SIZE:
+                _prune(now)
+            tokens = burst
+
+        if tokens < 1:
+            _buckets[key] = (tokens, now, burst, per_minute)
+            return False
+        _buckets[key] = (tokens - 1, now, burst, per_minute)
+        return True
+
+
+def _refilled(bucket, now):
+    tokens, updated, burst, per_minute = bucket
+    return min(burst, tokens + (now - updated) * per_minute / 60.0)
+
+
+def _prune(now):
+    '''
+    Drops the buckets that have filled up again, since a full bucket is
+    the same as none. If that doesn't make room, drops them all.
+    '''
+    for key, bucket in _buckets.items():
+        if _refilled(bucket, now) >= bucket[2]:
+            del _buckets[key]
+    if len(_buckets) >= settings.LOCAL_RATE_LIMIT_SIZE:
+        _buckets.clear()
+
+
+def check_request():
+    view = current_app.view_functions.get(request.endpoint)
+    if not view or '%s.%s' % (view.__module__, view.__name__) in _exempt_routes:
+        return
+
+    ip = get_ipaddr()
+    if not take(('ip', ip), settings.LOCAL_RATE_LIMIT_IP_BURST,
+                settings.LOCAL_RATE_LIMIT_IP_PER_MINUTE):
+        g.log.info('Rejected by the local rate limit.', ip=ip)
+        abort(429)
+
+    arg = FORM_ENDPOINTS.get(request.endpoint)
+    if arg and request.method == 'POST':
+        form = form_key(request.view_args.get(arg) or '')
+        if not take(form, settings.LOCAL_RATE_LIMIT_FORM_BURST,
+                    settings.LOCAL_RATE_LIMIT_FORM_PER_MINUTE):
+            g.log.info('Rejected by the local rate limit for the form.', ip=ip, form=form[1:])
+            abort(429)
+
+
+def configure(app):
+    '''
+    Must be called before Flask-Limiter is set up, so the local buckets
+    are checked first.
+    '''
+    if not settings.LOCAL_RATE_LIMIT:
+        return
+
+    app.before_request(check_request)
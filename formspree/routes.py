@@ -1,6 +1,7 @@
 import forms
 import users
 import static_pages
+import metrics
 
 def configure_routes(app):
     app.add_url_rule('/', 'index', view_func=static_pages.views.default, methods=['GET'])
@@ -10,6 +11,7 @@ def configure_routes(app):
 
     # Public forms
     app.add_url_rule('/<email_or_string>', 'send', view_func=forms.views.send, methods=['GET', 'POST'])
+    app.add_url_rule('/<hashid>/batch', 'send-batch', view_func=forms.views.send_batch, methods=['POST'])
     app.add_url_rule('/unblock/<email>', 'unblock_email', view_func=forms.views.unblock_email, methods=['GET', 'POST'])
     app.add_url_rule('/resend/<email>', 'resend_confirmation', view_func=forms.views.resend_confirmation, methods=['POST'])
     app.add_url_rule('/confirm/<nonce>', 'confirm_email', view_func=forms.views.confirm_email, methods=['GET'])
@@ -37,8 +39,13 @@ def configure_routes(app):
     app.add_url_rule('/forms/<hashid>/', 'form-submissions', view_func=forms.views.form_submissions, methods=['GET'])
     app.add_url_rule('/forms/<hashid>.<format>', 'form-submissions', view_func=forms.views.form_submissions, methods=['GET'])
     app.add_url_rule('/forms/<hashid>/toggle', 'form-toggle', view_func=forms.views.form_toggle, methods=['POST'])
+    app.add_url_rule('/forms/<hashid>/digest', 'form-digest', view_func=forms.views.form_digest, methods=['POST'])
     app.add_url_rule('/forms/<hashid>/delete', 'form-deletion', view_func=forms.views.form_deletion, methods=['POST'])
     app.add_url_rule('/forms/<hashid>/delete/<submissionid>', 'submission-deletion', view_func=forms.views.submission_deletion, methods=['POST'])
 
+    # Monitoring
+    app.add_url_rule('/metrics', 'metrics', view_func=metrics.view, methods=['GET'])
+
     # Webhooks
     app.add_url_rule('/webhooks/stripe', view_func=users.views.stripe_webhook, methods=['POST'])
+    app.add_url_rule('/webhooks/sendgrid', view_func=forms.views.sendgrid_webhook, methods=['POST'])
@@ -11,6 +11,11 @@ TESTING = os.getenv('TESTING') in ['True', 'true', '1', 'yes']
 SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
 
 LOG_LEVEL = os.getenv('LOG_LEVEL') or 'debug'
+# log the time each request spent in postgres, redis, outbound http and templates
+REQUEST_TIMINGS = os.getenv('REQUEST_TIMINGS', 'true') in ['True', 'true', '1', 'yes']
+# counters and histograms aggregated in redis, served at /metrics to METRICS_TOKEN holders
+METRICS = os.getenv('METRICS') in ['True', 'true', '1', 'yes']
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
 
 SECRET_KEY = os.getenv('SECRET_KEY')
 NONCE_SECRET = os.getenv('NONCE_SECRET')
@@ -18,8 +23,51 @@ HASHIDS_SALT = os.getenv('HASHIDS_SALT')
 
 MONTHLY_SUBMISSIONS_LIMIT = int(os.getenv('MONTHLY_SUBMISSIONS_LIMIT') or 1000)
 ARCHIVED_SUBMISSIONS_LIMIT = int(os.getenv('ARCHIVED_SUBMISSIONS_LIMIT') or 100)
+# how long a worker sending a confirmation keeps the others from sending it too
+CONFIRMATION_LOCK_TIMEOUT = int(os.getenv('CONFIRMATION_LOCK_TIMEOUT') or 30)
+# submissions listed in full in a digest email, the others are only counted
+DIGEST_MAX_SUBMISSIONS = int(os.getenv('DIGEST_MAX_SUBMISSIONS') or 200)
+# how many submissions a single request to /<hashid>/batch may carry
+BATCH_SUBMISSIONS_LIMIT = int(os.getenv('BATCH_SUBMISSIONS_LIMIT') or 100)
+# archives are trimmed by `manage.py compact_archives` (to be run periodically, see
+# the README) once they exceed the limit by this much
+ARCHIVE_COMPACTION_SLACK = int(os.getenv('ARCHIVE_COMPACTION_SLACK') or 20)
+ARCHIVE_COMPACTION_BATCH = int(os.getenv('ARCHIVE_COMPACTION_BATCH') or 500)
+# the submissions page and API list this many submissions per page by default
+SUBMISSIONS_PAGE_SIZE = int(os.getenv('SUBMISSIONS_PAGE_SIZE') or 100)
+SUBMISSIONS_PAGE_MAX_SIZE = int(os.getenv('SUBMISSIONS_PAGE_MAX_SIZE') or 1000)
+# exports fetch archived submissions this many at a time
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE') or 500)
+# buffer forms.counter increments in redis, flushed by `manage.py flush_counters`
+COUNTER_WRITE_BEHIND = os.getenv('COUNTER_WRITE_BEHIND') in ['True', 'true', '1', 'yes']
 REDIS_URL = os.getenv('REDISTOGO_URL') or os.getenv('REDISCLOUD_URL')
 
+# cache of form state for the submission endpoint, see formspree/forms/cache.py
+FORM_CACHE = os.getenv('FORM_CACHE', 'true') in ['True', 'true', '1', 'yes']
+FORM_CACHE_TTL = int(os.getenv('FORM_CACHE_TTL') or 3600)
+FORM_CACHE_LOCAL_TTL = int(os.getenv('FORM_CACHE_LOCAL_TTL') or 30)
+FORM_CACHE_LOCAL_SIZE = int(os.getenv('FORM_CACHE_LOCAL_SIZE') or 10000)
+
+# cache of the logged in user for Flask-Login, see formspree/users/cache.py
+USER_CACHE = os.getenv('USER_CACHE', 'true') in ['True', 'true', '1', 'yes']
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL') or 300)
+
+# werkzeug method for new password hashes; existing ones made with another
+# method are rehashed when their owners log in
+PASSWORD_HASH_METHOD = os.getenv('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256:50000'
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS') or 2)  # concurrent hashes per process
+PASSWORD_HASH_TIMEOUT = int(os.getenv('PASSWORD_HASH_TIMEOUT') or 5)  # seconds, waiting included
+
+# verification of sitewide forms, see `forms.helpers.sitewide_file_check`
+SITEWIDE_CHECK_TTL = int(os.getenv('SITEWIDE_CHECK_TTL') or 3600)
+SITEWIDE_CHECK_NEGATIVE_TTL = int(os.getenv('SITEWIDE_CHECK_NEGATIVE_TTL') or 10)
+SITEWIDE_FILE_TTL = int(os.getenv('SITEWIDE_FILE_TTL') or 86400)  # how long validators are kept
+# when enabled, sitewide forms are verified by `manage.py sitewide_worker` after they are created
+SITEWIDE_CHECK_ASYNC = os.getenv('SITEWIDE_CHECK_ASYNC') in ['True', 'true', '1', 'yes']
+# forms whose file couldn't be fetched are checked again, waiting twice as long each time
+SITEWIDE_CHECK_MAX_ATTEMPTS = int(os.getenv('SITEWIDE_CHECK_MAX_ATTEMPTS') or 6)
+SITEWIDE_CHECK_RETRY_DELAY = int(os.getenv('SITEWIDE_CHECK_RETRY_DELAY') or 60)  # seconds, first retry
+
 CDN_URL = os.getenv('CDN_URL')
 
 SERVICE_NAME = os.getenv('SERVICE_NAME') or 'Forms'
@@ -32,11 +80,32 @@ API_ROOT = os.getenv('API_ROOT') or '//example.com'
 
 SENDGRID_USERNAME = os.getenv('SENDGRID_USERNAME')
 SENDGRID_PASSWORD = os.getenv('SENDGRID_PASSWORD')
+SENDGRID_URL = os.getenv('SENDGRID_URL') or 'https://api.sendgrid.com/api/mail.send.json'
+SENDGRID_TIMEOUT = int(os.getenv('SENDGRID_TIMEOUT') or 10)  # seconds
+
+# when enabled, emails are pushed to a redis list and delivered by `manage.py mail_worker`
+MAIL_QUEUE = os.getenv('MAIL_QUEUE') in ['True', 'true', '1', 'yes']
+MAIL_QUEUE_KEY = os.getenv('MAIL_QUEUE_KEY') or 'mail_queue'
+MAIL_QUEUE_MAX_ATTEMPTS = int(os.getenv('MAIL_QUEUE_MAX_ATTEMPTS') or 5)
+
+# addresses that bounced or reported spam, kept by the SendGrid event webhook
+# at /webhooks/sendgrid?token=SENDGRID_WEBHOOK_TOKEN (disabled when unset)
+SENDGRID_WEBHOOK_TOKEN = os.getenv('SENDGRID_WEBHOOK_TOKEN')
+SUPPRESSIONS_KEY = os.getenv('SUPPRESSIONS_KEY') or 'suppressions'  # hash of address -> reason
+SUPPRESSIONS_UNBLOCK_KEY = os.getenv('SUPPRESSIONS_UNBLOCK_KEY') or 'suppressions_unblock'
 
 STRIPE_TEST_PUBLISHABLE_KEY = os.getenv('STRIPE_TEST_PUBLISHABLE_KEY')
 STRIPE_TEST_SECRET_KEY = os.getenv('STRIPE_TEST_SECRET_KEY')
 STRIPE_PUBLISHABLE_KEY = os.getenv('STRIPE_PUBLISHABLE_KEY') or STRIPE_TEST_PUBLISHABLE_KEY
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY') or STRIPE_TEST_SECRET_KEY
+# how long the copy of a customer's cards and subscription shown on /account
+# is kept; the Stripe webhook and our own changes refresh it before that
+STRIPE_SNAPSHOT_TTL = int(os.getenv('STRIPE_SNAPSHOT_TTL') or 86400)
+
+# keep-alive pools used by formspree.outbound
+HTTP_POOL_CONNECTIONS = int(os.getenv('HTTP_POOL_CONNECTIONS') or 10)  # number of hosts
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE') or 10)  # connections per host
+HTTP_WARM_URLS = (os.getenv('HTTP_WARM_URLS') or 'https://api.sendgrid.com').split()
 
 RECAPTCHA_SECRET = os.getenv('RECAPTCHA_SECRET')
 RECAPTCHA_KEY = os.getenv('RECAPTCHA_KEY')
@@ -44,6 +113,14 @@ RECAPTCHA_KEY = os.getenv('RECAPTCHA_KEY')
 RATE_LIMIT = os.getenv('RATE_LIMIT', '30 per hour')
 REDIS_RATE_LIMIT = os.getenv('REDIS_URL')  # heroku-redis
 
+# in-process token buckets checked before RATE_LIMIT, see formspree/ratelimit.py
+LOCAL_RATE_LIMIT = os.getenv('LOCAL_RATE_LIMIT', 'true') in ['True', 'true', '1', 'yes']
+LOCAL_RATE_LIMIT_IP_BURST = int(os.getenv('LOCAL_RATE_LIMIT_IP_BURST') or 120)
+LOCAL_RATE_LIMIT_IP_PER_MINUTE = int(os.getenv('LOCAL_RATE_LIMIT_IP_PER_MINUTE') or 60)
+LOCAL_RATE_LIMIT_FORM_BURST = int(os.getenv('LOCAL_RATE_LIMIT_FORM_BURST') or 60)
+LOCAL_RATE_LIMIT_FORM_PER_MINUTE = int(os.getenv('LOCAL_RATE_LIMIT_FORM_PER_MINUTE') or 30)
+LOCAL_RATE_LIMIT_SIZE = int(os.getenv('LOCAL_RATE_LIMIT_SIZE') or 100000)  # buckets per process
+
 CONTACT_FORM_HASHID = os.getenv('CONTACT_FORM_HASHID', CONTACT_EMAIL)
 
 TYPEKIT_KEY = os.getenv('TYPEKIT_KEY', '1234567')
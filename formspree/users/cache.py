@@ -0,0 +1,92 @@
+import json
+import datetime
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session, make_transient_to_detached
+
+from formspree import settings
+from formspree.app import DB, redis_store
+from helpers import USER_SNAPSHOT_KEY
+from models import User
+
+# A short-lived copy of the users row of logged in users, so Flask-Login
+# can load `current_user` on every dashboard request without a query.
+#
+# The copy is merged into the session as if it had been loaded, so the
+# user can be changed and committed like any other. Whenever one of its
+# columns is committed the copy is deleted from Redis.
+
+# the password hash is left out, and loaded from Postgres if ever needed
+COLUMNS = ['id', 'email', 'upgraded', 'stripe_id', 'registered_on']
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def dump(user):
+    row = {c: getattr(user, c) for c in COLUMNS}
+    if row['registered_on']:
+        row['registered_on'] = row['registered_on'].strftime(DATETIME_FORMAT)
+    return json.dumps(row)
+
+
+def load(value):
+    row = json.loads(value)
+    if row['registered_on']:
+        row['registered_on'] = datetime.datetime.strptime(row['registered_on'], DATETIME_FORMAT)
+
+    # built without User.__init__, which would hash the password again
+    user = User.__mapper__.class_manager.new_instance()
+    for column, v in row.items():
+        setattr(user, column, v)
+    make_transient_to_detached(user)
+    return DB.session.merge(user, load=False)
+
+
+def get(id):
+    if not settings.USER_CACHE:
+        return User.query.get(id)
+
+    key = USER_SNAPSHOT_KEY(id=id)
+    value = redis_store.get(key)
+    if value:
+        return load(value)
+
+    user = User.query.get(id)
+    if user:
+        redis_store.set(key, dump(user), ex=settings.USER_CACHE_TTL)
+    return user
+
+
+def invalidate(id):
+    redis_store.delete(USER_SNAPSHOT_KEY(id=id))
+
+
+# as with forms, invalidation happens when the changes are committed,
+# so no other request can load the old values back in between.
+
+def _mark_stale(target):
+    object_session(target).info.setdefault('stale_users', set()).add(target.id)
+
+
+def _mark_stale_if_changed(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[c].history.has_changes() for c in COLUMNS + ['password']):
+        _mark_stale(target)
+
+
+def _mark_deleted(mapper, connection, target):
+    _mark_stale(target)
+
+
+def _invalidate_stale(session):
+    for id in session.info.pop('stale_users', ()):
+        invalidate(id)
+
+
+def _forget_stale(session):
+    session.info.pop('stale_users', None)
+
+
+event.listen(User, 'after_update', _mark_stale_if_changed)
+event.listen(User, 'after_delete', _mark_deleted)
+event.listen(Session, 'after_commit', _invalidate_stale)
+event.listen(Session, 'after_rollback', _forget_stale)
@@ -1,7 +1,85 @@
-from werkzeug.security import generate_password_hash, check_password_hash
+import os
+import time
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from werkzeug.security import generate_password_hash, check_password_hash, \
+                              DEFAULT_PBKDF2_ITERATIONS
+
+from formspree import settings
+
+STRIPE_SNAPSHOT_KEY = 'stripe_snapshot_{customer_id}'.format  # cards and subscription of a customer
+USER_SNAPSHOT_KEY = 'user_snapshot_{id}'.format  # the users row of a logged in user
+
+# Password hashing is deliberately slow, so it runs in a small pool of
+# threads instead of on the request thread: at most PASSWORD_HASH_WORKERS
+# hashes are computed at once per process, and requests that can't get
+# theirs done within PASSWORD_HASH_TIMEOUT seconds give up.
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class PasswordHashingBusy(Exception):
+    pass
+
 
 def hash_pwd(password):
-    return generate_password_hash(password)
+    return _run(generate_password_hash, password, method=settings.PASSWORD_HASH_METHOD)
+
 
 def check_password(hashed, password):
-    return check_password_hash(hashed, password)
+    return _run(check_password_hash, hashed, password)
+
+
+def needs_rehash(hashed):
+    '''
+    Whether a stored hash was made with other than the current
+    PASSWORD_HASH_METHOD (which includes the number of iterations).
+    '''
+    return hashed.split('$', 1)[0] != stored_method(settings.PASSWORD_HASH_METHOD)
+
+
+def stored_method(method):
+    '''
+    The method as werkzeug writes it in front of the hashes it makes,
+    which always has the number of iterations of pbkdf2, even when
+    `method` leaves it to the default.
+    '''
+    if not method.startswith('pbkdf2:'):
+        return method
+    args = method[7:].split(':')
+    iterations = len(args) > 1 and int(args[1] or 0) or DEFAULT_PBKDF2_ITERATIONS
+    return 'pbkdf2:%s:%d' % (args[0], iterations)
+
+
+def _run(f, *args, **kwargs):
+    deadline = time.time() + settings.PASSWORD_HASH_TIMEOUT
+
+    def job():
+        # nobody is waiting for jobs that stayed queued past the timeout
+        if time.time() > deadline:
+            raise PasswordHashingBusy()
+        return f(*args, **kwargs)
+
+    result = _executor().apply_async(job)
+    try:
+        return result.get(max(0, deadline - time.time()))
+    except TimeoutError:
+        raise PasswordHashingBusy()
+
+
+def _executor():
+    '''
+    The pool of this process (threads don't survive a fork, so
+    workers forked by gunicorn start their own).
+    '''
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool = ThreadPool(settings.PASSWORD_HASH_WORKERS)
+            _pool_pid = os.getpid()
+    return _pool
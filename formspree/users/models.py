@@ -1,12 +1,26 @@
 import hmac
+import json
 import hashlib
+import stripe
 from datetime import datetime
 from flask import url_for, render_template, g
 
 from formspree import settings
 from formspree.utils import send_email, IS_VALID_EMAIL
-from formspree.app import DB
-from helpers import hash_pwd
+from formspree.app import DB, redis_store
+from helpers import hash_pwd, STRIPE_SNAPSHOT_KEY
+
+CARD_ICONS = {
+    'Visa': 'cc-visa',
+    'American Express': 'cc-amex',
+    'MasterCard': 'cc-mastercard',
+    'Discover': 'cc-discover',
+    'JCB': 'cc-jcb',
+    'Diners Club': 'cc-diners-club',
+    'Unknown': 'credit-card'
+}
+CARD_FIELDS = ['id', 'brand', 'last4', 'exp_month', 'exp_year',
+               'funding', 'country', 'cvc_check']
 
 class User(DB.Model):
     __tablename__ = 'users'
@@ -93,6 +107,54 @@ class User(DB.Model):
         else:
             return None
 
+    def stripe_snapshot(self):
+        '''
+        The cards and subscription of this user's Stripe customer, from
+        the copy kept in redis. Stripe is only called when there's no
+        copy yet. Returns None for users without a customer or when
+        Stripe can't be reached.
+        '''
+        if not self.stripe_id:
+            return None
+
+        cached = redis_store.get(STRIPE_SNAPSHOT_KEY(customer_id=self.stripe_id))
+        if cached:
+            return json.loads(cached)
+        return self.refresh_stripe_snapshot()
+
+    def refresh_stripe_snapshot(self):
+        '''
+        Fetches the customer from Stripe and replaces the copy used by
+        `stripe_snapshot`. Must be called after anything that changes
+        the customer's cards or subscription.
+        '''
+        key = STRIPE_SNAPSHOT_KEY(customer_id=self.stripe_id)
+        try:
+            customer = stripe.Customer.retrieve(self.stripe_id)
+            cards = customer.sources.all(object='card').data
+        except stripe.error.StripeError as e:
+            # don't leave an outdated copy behind
+            redis_store.delete(key)
+            g.log.warning('Failed to fetch Stripe customer.', account=self.email, error=str(e))
+            return None
+
+        sub = customer.subscriptions.data[0] if customer.subscriptions.data else None
+        snapshot = {
+            'cards': [dict({f: card.get(f) for f in CARD_FIELDS},
+                           default=card.id == customer.default_source,
+                           css_name=CARD_ICONS.get(card.brand, 'credit-card'))
+                      for card in cards],
+            'sub': {
+                'current_period_end': sub.current_period_end,
+                'cancel_at_period_end': sub.cancel_at_period_end,
+            } if sub else None
+        }
+        redis_store.set(key, json.dumps(snapshot), ex=settings.STRIPE_SNAPSHOT_TTL)
+        return snapshot
+
+    def forget_stripe_snapshot(self):
+        redis_store.delete(STRIPE_SNAPSHOT_KEY(customer_id=self.stripe_id))
+
 
 class Email(DB.Model):
     __tablename__ = 'emails'
@@ -102,7 +164,7 @@ class Email(DB.Model):
     """
 
     address = DB.Column(DB.Text, primary_key=True)
-    owner_id = DB.Column(DB.Integer, DB.ForeignKey('users.id'), primary_key=True)
+    owner_id = DB.Column(DB.Integer, DB.ForeignKey('users.id'), primary_key=True, index=True)
     registered_on = DB.Column(DB.DateTime, default=DB.func.now())
 
     @staticmethod
@@ -5,11 +5,13 @@ from flask import request, flash, url_for, render_template, redirect, g
 from flask.ext.login import login_user, logout_user, \
                             current_user, login_required
 from sqlalchemy.exc import IntegrityError
-from helpers import check_password, hash_pwd
+from helpers import check_password, hash_pwd, needs_rehash, PasswordHashingBusy
 from formspree.app import DB
 from formspree import settings
 from models import User, Email
 
+BUSY_MESSAGE = "We're a little overloaded right now. Please try again in a moment."
+
 
 def register():
     if request.method == 'GET':
@@ -32,6 +34,11 @@ def register():
         flash("An account with this email already exists.", "error")
         g.log.info('Account creation failed. Address is use.')
         return render_template('users/register.html')
+    except PasswordHashingBusy:
+        DB.session.rollback()
+        flash(BUSY_MESSAGE, "warning")
+        g.log.warning('Account creation failed. Timed out hashing the password.')
+        return render_template('users/register.html'), 503
 
     login_user(user, remember=True)
 
@@ -107,9 +114,25 @@ def login():
     if user is None:
         flash("We couldn't find an account related with this email. Please verify the email entered.", "warning")
         return redirect(url_for('login'))
-    elif not check_password(user.password, password):
-        flash("Invalid Password. Please verify the password entered.", 'warning')
-        return redirect(url_for('login'))
+
+    try:
+        if not check_password(user.password, password):
+            flash("Invalid Password. Please verify the password entered.", 'warning')
+            return redirect(url_for('login'))
+    except PasswordHashingBusy:
+        flash(BUSY_MESSAGE, 'warning')
+        g.log.warning('Login failed. Timed out checking the password.', account=email)
+        return render_template('users/login.html'), 503
+
+    if needs_rehash(user.password):
+        try:
+            user.password = hash_pwd(password)
+            DB.session.add(user)
+            DB.session.commit()
+            g.log.info('Rehashed password.', account=email)
+        except PasswordHashingBusy:
+            pass  # will be done at the next login
+
     login_user(user, remember=True)
     flash('Logged in successfully!', 'success')
     return redirect(request.args.get('next') or url_for('dashboard'))
@@ -150,7 +173,11 @@ def reset_password(digest):
         user = User.from_password_reset(current_user.email, digest)
         if user and user.id == current_user.id:
             if request.form['password1'] == request.form['password2']:
-                user.password = hash_pwd(request.form['password1'])
+                try:
+                    user.password = hash_pwd(request.form['password1'])
+                except PasswordHashingBusy:
+                    flash(BUSY_MESSAGE, 'warning')
+                    return redirect(url_for('reset-password', digest=digest, next=request.args.get('next')))
                 DB.session.add(user)
                 DB.session.commit()
                 flash('Changed password successfully!', 'success')
@@ -205,6 +232,7 @@ def upgrade():
     current_user.upgraded = True
     DB.session.add(current_user)
     DB.session.commit()
+    current_user.refresh_stripe_snapshot()
     flash("Congratulations! You are now a {SERVICE_NAME} {UPGRADED_PLAN_NAME} user!".format(**settings.__dict__), 'success')
     g.log.info('Subscription created.')
 
@@ -221,6 +249,7 @@ def resubscribe():
         
     sub.plan = 'gold'
     sub.save()
+    current_user.refresh_stripe_snapshot()
     
     g.log.info('Resubscribed user.', account=current_user.email)
     flash('Glad to have you back! Your subscription will now automatically renew on {date}'.format(date=datetime.datetime.fromtimestamp(sub.current_period_end).strftime('%A, %B %d, %Y')), 'success')
@@ -237,6 +266,7 @@ def downgrade():
         return redirect(url_for('account'))
 
     sub = sub.delete(at_period_end=True)
+    current_user.refresh_stripe_snapshot()
     flash("You were unregistered from the {SERVICE_NAME} {UPGRADED_PLAN_NAME} plan."\
         .format(**settings.__dict__), 'success')
     flash("Your card will not be charged anymore, but your plan will remain active until {date}."\
@@ -251,11 +281,25 @@ def stripe_webhook():
     event = request.get_json()
     g.log.info('Webhook from Stripe', type=event['type'])
 
+    obj = event['data']['object']
+    customer_id = obj.get('id') if obj.get('object') == 'customer' else obj.get('customer')
+    user = User.query.filter_by(stripe_id=customer_id).first() if customer_id else None
+    if not user:
+        return 'ok'
+
+    if event['type'] == 'customer.deleted':
+        user.forget_stripe_snapshot()
+        return 'ok'
+
+    # any other event about the customer may have changed
+    # what the account page shows
+    snapshot = user.refresh_stripe_snapshot()
+    if snapshot is None:
+        # have Stripe send the event again later
+        return 'failed to fetch customer', 503
+
     if event['type'] == 'customer.subscription.deleted':
-        customer_id = event['data']['object']['customer']
-        customer = stripe.Customer.retrieve(customer_id)
-        if len(customer.subscriptions.data) == 0:
-            user = User.query.filter_by(stripe_id=customer_id).first()
+        if not snapshot['sub']:
             user.upgraded = False
             DB.session.add(user)
             DB.session.commit()
@@ -284,6 +328,7 @@ def add_card():
             flash('That card already exists in your wallet', 'error')
         else:
             customer.sources.create(source=token)
+            current_user.refresh_stripe_snapshot()
             flash('You\'ve successfully added a new card!', 'success')
             g.log.info('Added card to stripe account.')
     except stripe.CardError as e:
@@ -303,6 +348,7 @@ def delete_card(cardid):
     if current_user.stripe_id:
         customer = stripe.Customer.retrieve(current_user.stripe_id)
         customer.sources.retrieve(cardid).delete()
+        current_user.refresh_stripe_snapshot()
         flash('Successfully deleted card', 'success')
         g.log.info('Deleted card from account.', account=current_user.email)
     else:
@@ -319,25 +365,11 @@ def account():
     sub = None
     cards = {}
     if current_user.stripe_id:
-        try:
-            customer = stripe.Customer.retrieve(current_user.stripe_id)
-            card_mappings = {
-                'Visa': 'cc-visa',
-                'American Express': 'cc-amex',
-                'MasterCard': 'cc-mastercard',
-                'Discover': 'cc-discover',
-                'JCB': 'cc-jcb',
-                'Diners Club': 'cc-diners-club',
-                'Unknown': 'credit-card'
-            }
-            cards = customer.sources.all(object='card').data
-            for card in cards:
-                if customer.default_source == card.id:
-                    card.default = True
-                card.css_name = card_mappings[card.brand]
-            sub = customer.subscriptions.data[0] if customer.subscriptions.data else None
-            if sub:
-                sub.current_period_end = datetime.datetime.fromtimestamp(sub.current_period_end).strftime('%A, %B %d, %Y')
-        except stripe.error.StripeError:
+        snapshot = current_user.stripe_snapshot()
+        if not snapshot:
             return render_template('error.html', title='Unable to connect', text="We're unable to make a secure connection to verify your account details. Please try again in a little bit. If this problem persists, please contact <strong>%s</strong>" % settings.CONTACT_EMAIL)
+        cards = snapshot['cards']
+        sub = snapshot['sub']
+        if sub:
+            sub['current_period_end'] = datetime.datetime.fromtimestamp(sub['current_period_end']).strftime('%A, %B %d, %Y')
     return render_template('users/account.html', emails=emails, cards=cards, sub=sub)
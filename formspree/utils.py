@@ -1,4 +1,3 @@
-import requests
 import datetime
 import calendar
 import urlparse
@@ -6,7 +5,8 @@ import uuid
 import re
 from flask import request, url_for, jsonify, g
 
-from formspree import settings
+from formspree import settings, mailqueue, outbound
+from formspree.app import redis_store
 
 IS_VALID_EMAIL = lambda x: re.match(r"[^@]+@[^@]+\.[^@]+", x)
 
@@ -91,15 +91,32 @@ def next_url(referrer=None, next=None):
         return url_for('thanks', next=referrer)
 
 
+def suppression_reasons(addresses):
+    '''
+    Why each of the addresses is suppressed (see `forms.models.Suppression`),
+    or None for the ones that aren't, in a single redis call. Addresses
+    are kept lowercased, so they are looked up that way too.
+    '''
+    if not addresses:
+        return []
+    return redis_store.hmget(settings.SUPPRESSIONS_KEY, [a.lower() for a in addresses])
+
+
 def send_email(to=None, subject=None, text=None, html=None, sender=None, cc=None, reply_to=None):
     g.log = g.log.new(to=to, sender=sender)
 
     if None in [to, subject, text, sender]:
         raise ValueError('to, subject text and sender are required to send email')
 
-    data = {'api_user': settings.SENDGRID_USERNAME,
-            'api_key': settings.SENDGRID_PASSWORD,
-            'to': to,
+    reasons = suppression_reasons([to] + list(cc or []))
+    if reasons[0]:
+        # SendGrid would accept the message and drop it, so we do the same
+        # without calling it. the address can be unblocked at /unblock/<email>
+        g.log.info('Not sending to suppressed address.', reason=reasons[0])
+        return True, '', 200
+    cc = [email for email, reason in zip(cc or [], reasons[1:]) if not reason]
+
+    data = {'to': to,
             'subject': subject,
             'text': text,
             'html': html}
@@ -121,12 +138,28 @@ def send_email(to=None, subject=None, text=None, html=None, sender=None, cc=None
         valid_emails = [email for email in cc if IS_VALID_EMAIL(email)]
         data.update({'cc': valid_emails})
 
-    result = requests.post(
-        'https://api.sendgrid.com/api/mail.send.json',
-        data=data
-    )
+    if settings.MAIL_QUEUE:
+        # the actual delivery happens later, in the mail worker
+        mailqueue.enqueue(data)
+        g.log.info('Enqueued email.', to=to)
+        return True, '', 202
+
+    return deliver_email(data)
+
+
+def deliver_email(data):
+    '''
+    Posts a message built by `send_email` to SendGrid. Called directly
+    by `send_email` or by the mail worker when MAIL_QUEUE is enabled.
+    '''
+
+    data = dict(data,
+                api_user=settings.SENDGRID_USERNAME,
+                api_key=settings.SENDGRID_PASSWORD)
+
+    result = outbound.post(settings.SENDGRID_URL, data=data, timeout=settings.SENDGRID_TIMEOUT)
 
-    g.log.info('Queued email.', to=to)
+    g.log.info('Queued email.', to=data['to'])
     errmsg = ""
     if result.status_code / 100 != 2:
         try:
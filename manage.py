@@ -5,14 +5,17 @@ import dotenv
 dotenv.load_dotenv(os.path.join(os.path.dirname(__file__), ".env"))
 
 import datetime
+import structlog
 
+from flask import g
 from flask.ext.script import Manager, prompt_bool
 from flask.ext.migrate import Migrate, MigrateCommand
 
-from formspree import create_app, app
-from formspree.app import redis_store
-from formspree.forms.helpers import MONTHLY_COUNTER_KEY
-from formspree.forms.models import Form
+from formspree import create_app, app, settings, mailqueue
+from formspree import bench as benchmark
+from formspree.utils import deliver_email
+from formspree.forms.models import Form, Suppression
+from formspree.forms import sitewide
 
 forms_app = create_app()
 manager = Manager(forms_app)
@@ -81,9 +84,97 @@ def monthly_counters(email=None, host=None, id=None, month=datetime.date.today()
         print 'supply each --email or --form or both (or --id).'
         return 1
 
-    for form in query:
-        nsubmissions = redis_store.get(MONTHLY_COUNTER_KEY(form_id=form.id, month=month)) or 0
-        print '%s submissions for %s' % (nsubmissions, form)
+    forms = list(query)
+    basedate = datetime.date.today().replace(month=int(month), day=1)
+    for form, nsubmissions in zip(forms, Form.get_monthly_counters(forms, basedate)):
+        overlimit = nsubmissions > settings.MONTHLY_SUBMISSIONS_LIMIT
+        print '%s submissions for %s%s' % (nsubmissions, form, ' (over quota)' if overlimit else '')
+
+
+@manager.command
+def compact_archives():
+    '''deletes archived submissions over ARCHIVED_SUBMISSIONS_LIMIT for the forms that need it.
+    should be run periodically.'''
+    with forms_app.app_context():
+        g.log = structlog.get_logger().new(job='compact_archives')
+        print '%s archives compacted.' % Form.compact_archives()
+
+
+@manager.command
+def flush_counters():
+    '''writes the form counter increments buffered when COUNTER_WRITE_BEHIND is enabled.
+    should be run periodically.'''
+    with forms_app.app_context():
+        g.log = structlog.get_logger().new(job='flush_counters')
+        print '%s form counters flushed.' % Form.flush_counters()
+
+
+@manager.option('-p', '--period', dest='period', default='hourly',
+                help='one of %s' % ', '.join(Form.DIGEST_PERIODS))
+def send_digests(period='hourly'):
+    '''emails the submissions held for the forms on an hourly or daily digest.
+    should be run every hour with -p hourly and every day with -p daily.'''
+    if period not in Form.DIGEST_PERIODS:
+        print 'period must be one of %s.' % ', '.join(Form.DIGEST_PERIODS)
+        return 1
+    # the emails link to static files and the dashboard, which needs a request context
+    with forms_app.test_request_context(base_url=settings.SERVICE_URL):
+        g.log = structlog.get_logger().new(job='send_digests', period=period)
+        print '%s digests sent.' % Form.send_digests(period)
+
+
+@manager.option('-n', '--requests', dest='requests', default=1000, help='measured requests per scenario')
+@manager.option('-s', '--scenario', dest='scenarios', action='append',
+                help='one of %s, can be repeated. all by default' % ', '.join(benchmark.SCENARIOS))
+@manager.option('-d', '--database', dest='database', default=os.getenv('BENCH_DATABASE_URL'),
+                help='an empty database to run on, BENCH_DATABASE_URL by default')
+def bench(requests=1000, scenarios=None, database=None):
+    '''measures the submission endpoint with fakeredis and a local SendGrid stand-in.'''
+    if not database or database == os.getenv('DATABASE_URL'):
+        print 'Give the benchmark an empty database of its own with -d or BENCH_DATABASE_URL.'
+        return
+    print benchmark.report(benchmark.standalone(database, int(requests), scenarios))
+
+
+@manager.option('-t', '--timeout', dest='timeout', default=5, help='seconds to block waiting for a message')
+def mail_worker(timeout=5):
+    '''delivers the emails enqueued when MAIL_QUEUE is enabled. runs forever.'''
+    with forms_app.app_context():
+        g.log = structlog.get_logger().new(worker='mail')
+        g.log.info('Mail worker started.', queue=settings.MAIL_QUEUE_KEY)
+        while True:
+            mailqueue.process(deliver_email, timeout=int(timeout))
+
+
+@manager.command
+def sitewide_worker(timeout=5):
+    '''verifies the sitewide forms created when SITEWIDE_CHECK_ASYNC is enabled. runs forever.'''
+    # confirmation emails link to the service, which needs a request context
+    with forms_app.test_request_context(base_url=settings.SERVICE_URL):
+        g.log = structlog.get_logger().new(worker='sitewide')
+        g.log.info('Sitewide worker started.')
+        while True:
+            sitewide.process(timeout=int(timeout))
+
+
+@manager.option('-i', '--import-bounces', dest='import_bounces', action='store_true',
+                help="suppress every address on SendGrid's bounce list first")
+def sync_suppressions(import_bounces=False):
+    '''clears the addresses unblocked by their owners from SendGrid's bounce list and
+    rebuilds the redis copy of the suppressions table. should be run periodically.'''
+    with forms_app.app_context():
+        g.log = structlog.get_logger().new(job='sync_suppressions')
+        if import_bounces:
+            print '%s bounces imported.' % Suppression.import_bounces()
+        print '%s addresses unblocked on SendGrid.' % Suppression.sync_unblocks()
+        print '%s addresses suppressed.' % Suppression.reload()
+
+
+@manager.command
+def mail_queue():
+    '''prints the depth of the outbound mail queue and the age of its oldest message.'''
+    queue = mailqueue.stats()
+    print '%s messages in the queue, oldest enqueued %.1f seconds ago' % (queue['depth'], queue['age'])
 
 
 @manager.command
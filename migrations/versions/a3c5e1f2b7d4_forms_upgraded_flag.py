@@ -0,0 +1,31 @@
+"""forms upgraded flag.
+
+Revision ID: a3c5e1f2b7d4
+Revises: 614c1d90428e
+Create Date: 2026-10-17 10:12:41.508130
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a3c5e1f2b7d4'
+down_revision = '614c1d90428e'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('forms', sa.Column('upgraded', sa.Boolean(), nullable=True))
+    op.execute('''
+        UPDATE forms SET upgraded = EXISTS (
+            SELECT 1 FROM users
+            WHERE users.upgraded AND (
+                users.id = forms.owner_id OR
+                users.id IN (SELECT owner_id FROM emails WHERE address = forms.email)
+            )
+        )
+    ''')
+
+
+def downgrade():
+    op.drop_column('forms', 'upgraded')
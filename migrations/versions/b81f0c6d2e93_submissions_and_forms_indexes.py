@@ -0,0 +1,39 @@
+"""submissions and forms indexes.
+
+Revision ID: b81f0c6d2e93
+Revises: a3c5e1f2b7d4
+Create Date: 2026-10-17 11:03:12.774015
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b81f0c6d2e93'
+down_revision = 'a3c5e1f2b7d4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The indexes are built CONCURRENTLY, so submissions keep being
+    # written while they are, which can't be done in a transaction.
+    with op.get_context().autocommit_block():
+        # Form.submissions, the archive compaction and the submissions page
+        op.create_index('ix_submissions_form_id_id', 'submissions',
+                        ['form_id', sa.text('id DESC')], postgresql_concurrently=True)
+        # lookups by email (and host), User.forms and Form.controllers
+        op.create_index('ix_forms_email_host', 'forms', ['email', 'host'],
+                        postgresql_concurrently=True)
+        # lookups by host alone, as in `manage.py unsubscribe`
+        op.create_index('ix_forms_host', 'forms', ['host'], postgresql_concurrently=True)
+        # User.forms, by owner
+        op.create_index('ix_forms_owner_id', 'forms', ['owner_id'], postgresql_concurrently=True)
+        # User.forms, by the user's emails
+        op.create_index('ix_emails_owner_id', 'emails', ['owner_id'], postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for index in ['ix_emails_owner_id', 'ix_forms_owner_id', 'ix_forms_host',
+                      'ix_forms_email_host', 'ix_submissions_form_id_id']:
+            op.execute('DROP INDEX CONCURRENTLY %s' % index)
@@ -0,0 +1,22 @@
+"""forms digest.
+
+Revision ID: c5e9a2d41f70
+Revises: b81f0c6d2e93
+Create Date: 2026-10-17 16:40:12.118304
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c5e9a2d41f70'
+down_revision = 'b81f0c6d2e93'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('forms', sa.Column('digest', sa.String(length=10), nullable=True))
+
+
+def downgrade():
+    op.drop_column('forms', 'digest')
@@ -0,0 +1,28 @@
+"""suppressions.
+
+Revision ID: d2a7f3b95c18
+Revises: c5e9a2d41f70
+Create Date: 2026-10-17 18:21:45.903127
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd2a7f3b95c18'
+down_revision = 'c5e9a2d41f70'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('suppressions',
+        sa.Column('address', sa.String(length=120), nullable=False),
+        sa.Column('event', sa.String(length=20), nullable=True),
+        sa.Column('reason', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('address')
+    )
+
+
+def downgrade():
+    op.drop_table('suppressions')
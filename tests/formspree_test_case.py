@@ -7,8 +7,9 @@ from flask.ext.testing import TestCase
 import mock
 import formspree
 from formspree import create_app
-from formspree import settings
+from formspree import settings, ratelimit
 from formspree.app import DB, redis_store
+from formspree.forms import cache
 
 
 # the different redis database only accessed by flask-limiter
@@ -22,6 +23,7 @@ class FormspreeTestCase(TestCase):
 
         settings.MONTHLY_SUBMISSIONS_LIMIT = 2
         settings.ARCHIVED_SUBMISSIONS_LIMIT = 2
+        settings.ARCHIVE_COMPACTION_SLACK = 0
         settings.PRESERVE_CONTEXT_ON_EXCEPTION = False
         settings.SQLALCHEMY_DATABASE_URI = os.getenv('TEST_DATABASE_URL')
         settings.STRIPE_PUBLISHABLE_KEY = settings.STRIPE_TEST_PUBLISHABLE_KEY
@@ -39,6 +41,7 @@ class FormspreeTestCase(TestCase):
 
         # clear the rate limiting
         rlredis.flushall()
+        ratelimit.reset()
 
         super(FormspreeTestCase, self).setUp()
 
@@ -46,6 +49,7 @@ class FormspreeTestCase(TestCase):
         DB.session.remove()
         DB.drop_all()
         redis_store.flushdb()
+        cache.clear_local()
 
         self.redis_patcher.stop()
 
@@ -2,8 +2,8 @@ import httpretty
 import json
 
 from formspree import settings
-from formspree.app import DB
-from formspree.forms.helpers import HASH
+from formspree.app import DB, redis_store
+from formspree.forms.helpers import HASH, ARCHIVE_COMPACTION_LOCK_KEY, ARCHIVE_SIZES_KEY
 from formspree.users.models import User
 from formspree.forms.models import Form, Submission
 
@@ -73,6 +73,9 @@ class ArchiveSubmissionsTestCase(FormspreeTestCase):
             headers = {'referer': 'http://somewhere.com'},
             data={'which-submission-is-this': 'the third!'}
         )
+        # they are only deleted when the archive is compacted
+        self.assertEqual(3, form.submissions.count())
+        Form.compact_archives()
         self.assertEqual(2, form.submissions.count())
         newest = form.submissions.first() # first should be the newest
         self.assertEqual(newest.data['which-submission-is-this'], 'the third!')
@@ -81,6 +84,7 @@ class ArchiveSubmissionsTestCase(FormspreeTestCase):
             headers = {'referer': 'http://somewhere.com'},
             data={'which-submission-is-this': 'the fourth!'}
         )
+        Form.compact_archives()
         self.assertEqual(2, form.submissions.count())
         newest, last = form.submissions.all()
         self.assertEqual(newest.data['which-submission-is-this'], 'the fourth!')
@@ -129,6 +133,7 @@ class ArchiveSubmissionsTestCase(FormspreeTestCase):
             data={'name': 'husserl'}
         )
 
+        Form.compact_archives()
         self.assertEqual(2, secondform.submissions.count())
         newest, last = secondform.submissions.all()
         self.assertEqual(newest.data['name'], 'husserl')
@@ -143,6 +148,7 @@ class ArchiveSubmissionsTestCase(FormspreeTestCase):
             headers = {'referer': 'http://somewhere.com'},
             data={'which-submission-is-this': 'the fifth!'}
         )
+        Form.compact_archives()
         self.assertEqual(2, form.submissions.count())
         newest, last = form.submissions.all()
         self.assertEqual(newest.data['which-submission-is-this'], 'the fifth!')
@@ -224,3 +230,137 @@ class ArchiveSubmissionsTestCase(FormspreeTestCase):
         self.client.get('/logout')
         r = self.client.get('/forms/' + form_endpoint + '/')
         self.assertEqual(r.status_code, 302) # it should return a redirect (via @user_required)
+
+    @httpretty.activate
+    def test_archive_compaction(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('bob@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+
+        # with some slack, compaction only happens after a few extra submissions
+        settings.ARCHIVE_COMPACTION_SLACK = 5
+        try:
+            for i in range(5):
+                self.client.post('/bob@example.com',
+                    headers={'referer': 'http://example.com'},
+                    data={'n': str(i)}
+                )
+                self.assertEqual(i + 1, form.submissions.count())
+            self.assertEqual(0, Form.compact_archives())
+        finally:
+            settings.ARCHIVE_COMPACTION_SLACK = 0
+
+        # and archives under the limit are never compacted, whatever the slack
+        settings.ARCHIVED_SUBMISSIONS_LIMIT = 10
+        try:
+            self.client.post('/bob@example.com',
+                headers={'referer': 'http://example.com'},
+                data={'n': '5'}
+            )
+            self.assertEqual(0, Form.compact_archives())
+        finally:
+            settings.ARCHIVED_SUBMISSIONS_LIMIT = 2
+
+        # the size is counted again when redis doesn't know it
+        redis_store.delete(ARCHIVE_SIZES_KEY)
+        form.schedule_compaction(0)
+        self.assertEqual(6, int(redis_store.hget(ARCHIVE_SIZES_KEY, form.id)))
+
+        # another worker is compacting this form
+        lock = ARCHIVE_COMPACTION_LOCK_KEY(form_id=form.id)
+        redis_store.set(lock, 'someone-else')
+        self.assertIsNone(form.compact_archive())
+        self.assertEqual(6, form.submissions.count())
+
+        # until it releases the lock
+        redis_store.delete(lock)
+        self.assertEqual(4, form.compact_archive())
+        self.assertEqual(['5', '4'], [s.data['n'] for s in form.submissions])
+        self.assertEqual(2, int(redis_store.hget(ARCHIVE_SIZES_KEY, form.id)))
+        self.assertIsNone(redis_store.get(lock))
+
+    def create_archive(self):
+        '''
+        Registers an upgraded user with a form that has 7 archived
+        submissions, numbered from 0 to 6.
+        '''
+        r = self.client.post('/register',
+            data={'email': 'colorado@springs.com',
+                  'password': 'banana'}
+        )
+        user = User.query.filter_by(email='colorado@springs.com').first()
+        user.upgraded = True
+        DB.session.add(user)
+        form = Form('colorado@springs.com', 'springs.com')
+        form.owner_id = user.id
+        DB.session.add(form)
+        DB.session.commit()
+
+        for i in range(7):
+            sub = Submission(form.id)
+            sub.data = {'n': str(i)} if i % 2 else {'n': str(i), 'extra': 'x'}
+            DB.session.add(sub)
+        DB.session.commit()
+        return form
+
+    @httpretty.activate
+    def test_streamed_exports(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+        form = self.create_archive()
+
+        # more chunks than fit in the archive limit
+        settings.ARCHIVED_SUBMISSIONS_LIMIT = 5
+        settings.EXPORT_CHUNK_SIZE = 2
+        try:
+            self.assertEqual(form.submission_fields(), set(['n', 'extra']))
+
+            r = self.client.get('/forms/' + form.hashid + '.csv')
+            self.assertTrue(r.is_streamed)
+            lines = r.data.splitlines()
+            self.assertEqual(lines[0], 'date,extra,n')
+            self.assertEqual([l.split(',')[2] for l in lines[1:]], ['6', '5', '4', '3', '2'])
+
+            r = self.client.get('/forms/' + form.hashid + '.json')
+            self.assertTrue(r.is_streamed)
+            exported = json.loads(r.data)
+            self.assertEqual(exported['email'], 'colorado@springs.com')
+            self.assertEqual([s['n'] for s in exported['submissions']], ['6', '5', '4', '3', '2'])
+            self.assertEqual(exported['submissions'][0]['extra'], 'x')
+
+            r = self.client.get('/forms/' + form.hashid + '.ndjson')
+            self.assertTrue(r.is_streamed)
+            self.assertEqual(r.mimetype, 'application/x-ndjson')
+            lines = r.data.splitlines()
+            self.assertEqual([json.loads(l)['n'] for l in lines], ['6', '5', '4', '3', '2'])
+            self.assertIn('date', json.loads(lines[0]))
+        finally:
+            settings.ARCHIVED_SUBMISSIONS_LIMIT = 2
+            settings.EXPORT_CHUNK_SIZE = 500
+
+    @httpretty.activate
+    def test_submissions_pagination(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+        form = self.create_archive()
+
+        settings.ARCHIVED_SUBMISSIONS_LIMIT = 5
+        try:
+            pages = []
+            url = '/forms/' + form.hashid + '/?limit=2'
+            while url:
+                r = self.client.get(url, headers={'Accept': 'application/json'})
+                resp = json.loads(r.data)
+                pages.append([s['n'] for s in resp['submissions']])
+                url = resp['next']
+            # only the archived ones, even before compaction
+            self.assertEqual(pages, [['6', '5'], ['4', '3'], ['2']])
+
+            r = self.client.get('/forms/' + form.hashid + '/?limit=2')
+            self.assertIn('after_id=', r.data)
+            r = self.client.get('/forms/' + form.hashid + '/?limit=0',
+                headers={'Accept': 'application/json'})
+            self.assertEqual(r.status_code, 400)
+        finally:
+            settings.ARCHIVED_SUBMISSIONS_LIMIT = 2
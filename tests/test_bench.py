@@ -0,0 +1,26 @@
+import httpretty
+
+from formspree import bench
+
+from formspree_test_case import FormspreeTestCase
+
+
+class BenchTestCase(FormspreeTestCase):
+    @httpretty.activate
+    def test_scenarios(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        results = bench.run(self.client, 5, warmup=2)
+        self.assertEqual([r['scenario'] for r in results], bench.SCENARIOS.keys())
+        for r in results:
+            self.assertEqual(r['errors'], 0, r['scenario'])
+            self.assertGreater(r['rps'], 0)
+            self.assertLessEqual(r['p50'], r['p99'])
+
+        # submissions to forms over quota are rejected from redis alone
+        overquota = results[-1]
+        self.assertEqual(overquota['queries'], 0)
+        self.assertEqual(overquota['redis'], 1)
+
+        report = bench.report(results)
+        self.assertEqual(len(report.splitlines()), len(results) + 1)
@@ -0,0 +1,178 @@
+import httpretty
+
+from sqlalchemy import event
+
+from formspree.app import DB, redis_store
+from formspree.forms import cache
+from formspree.forms.helpers import HASH, FORM_SNAPSHOT_KEY
+from formspree.forms.models import Form, Submission
+
+from formspree_test_case import FormspreeTestCase
+
+ajax_headers = {
+    'Referer': 'http://example.com',
+    'X_REQUESTED_WITH': 'xmlhttprequest'
+}
+
+
+class FormCacheTestCase(FormspreeTestCase):
+    def count_queries(self, fn):
+        queries = []
+        def count(*args):
+            queries.append(args)
+        event.listen(DB.engine, 'before_cursor_execute', count)
+        try:
+            res = fn()
+        finally:
+            event.remove(DB.engine, 'before_cursor_execute', count)
+        return res, len(queries)
+
+    def post(self):
+        return self.client.post('/bob@example.com',
+            headers=ajax_headers,
+            data={'name': 'alice'}
+        )
+
+    @httpretty.activate
+    def test_disabled_form_rejected_from_cache(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('bob@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+
+        r = self.post()
+        self.assertEqual(r.status_code, 200)
+        key = FORM_SNAPSHOT_KEY(kind='hash', value=HASH('bob@example.com', 'example.com'))
+        self.assertIsNotNone(redis_store.get(key))
+
+        # disabling the form invalidates the snapshot
+        form = Form.query.first()
+        form.disabled = True
+        DB.session.add(form)
+        DB.session.commit()
+        self.assertIsNone(redis_store.get(key))
+
+        # the first rejection loads it again, then no queries are needed
+        r = self.post()
+        self.assertEqual(r.status_code, 403)
+        r, nqueries = self.count_queries(self.post)
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(nqueries, 0)
+
+        # changes to other columns don't invalidate it
+        redis_store.set(key, redis_store.get(key))
+        form = Form.query.first()
+        form.counter = 3
+        DB.session.add(form)
+        DB.session.commit()
+        self.assertIsNotNone(redis_store.get(key))
+
+        # deletion does
+        DB.session.delete(form)
+        DB.session.commit()
+        self.assertIsNone(redis_store.get(key))
+        self.assertIsNone(cache.get_by_hash(HASH('bob@example.com', 'example.com')))
+
+    @httpretty.activate
+    def test_wrong_host_rejected_from_cache(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('bob@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+        hashid = form.hashid
+
+        form.hash = None
+        DB.session.add(form)
+        DB.session.commit()
+
+        self.client.post('/' + hashid, headers={'Referer': 'http://bad.com'}, data={'name': 'x'})
+        r, nqueries = self.count_queries(lambda: self.client.post('/' + hashid,
+            headers={'Referer': 'http://bad.com'},
+            data={'name': 'x'}
+        ))
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(nqueries, 0)
+
+        r = self.client.post('/' + hashid, headers=ajax_headers, data={'name': 'x'})
+        self.assertEqual(r.status_code, 200)
+
+    @httpretty.activate
+    def test_stale_snapshot_of_a_deleted_hashid_form(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('bob@example.com', 'example.com')
+        form.confirmed = True
+        form.hash = None
+        DB.session.add(form)
+        DB.session.commit()
+        hashid = form.hashid
+
+        r = self.client.post('/' + hashid, headers=ajax_headers, data={'name': 'x'})
+        self.assertEqual(r.status_code, 200)
+        key = FORM_SNAPSHOT_KEY(kind='hashid', value=hashid)
+        self.assertIsNotNone(redis_store.get(key))
+
+        # the row goes away without the snapshot being invalidated
+        DB.session.execute(Submission.__table__.delete())
+        DB.session.execute(Form.__table__.delete())
+        DB.session.commit()
+
+        # no form is created for the email behind the hashid
+        r = self.client.post('/' + hashid, headers=ajax_headers, data={'name': 'x'})
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(Form.query.count(), 0)
+        self.assertIsNone(redis_store.get(key))
+
+    @httpretty.activate
+    def test_garbage_rejected_before_resolving_form(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('bob@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+        cache.clear_local()
+
+        for data, status in [({'name': ''}, 400),
+                             ({'name': 'x', '_gotcha': 'spam'}, 200),
+                             ({'name': 'x', '_replyto': 'not an address'}, 500)]:
+            r, nqueries = self.count_queries(lambda: self.client.post('/bob@example.com',
+                headers=ajax_headers,
+                data=data
+            ))
+            self.assertEqual(r.status_code, status)
+            self.assertEqual(nqueries, 0)
+
+        # the form was never even looked up
+        key = FORM_SNAPSHOT_KEY(kind='hash', value=HASH('bob@example.com', 'example.com'))
+        self.assertIsNone(redis_store.get(key))
+        self.assertFalse(httpretty.has_request())
+
+    def test_snapshot_loaded_before_an_invalidation_is_not_kept(self):
+        form = Form('bob@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+        id, hash = form.id, form.hash
+        key = FORM_SNAPSHOT_KEY(kind='hash', value=hash)
+
+        def load_while_disabled_elsewhere():
+            stale = cache.snapshot_of(Form.query.get(id))
+
+            # another request commits a change before this one writes the snapshot
+            Form.query.get(id).disabled = True
+            DB.session.commit()
+            return stale
+
+        self.assertFalse(cache._get(key, load_while_disabled_elsewhere).disabled)
+        self.assertNotIn(key, cache._local)
+
+        # the stale copy written after the invalidation is never served
+        DB.session.remove()
+        snapshot, nqueries = self.count_queries(lambda: cache.get_by_hash(hash))
+        self.assertTrue(snapshot.disabled)
+        self.assertEqual(nqueries, 1)
@@ -2,8 +2,10 @@ import httpretty
 import json
 
 from formspree import settings
-from formspree.app import DB
-from formspree.forms.helpers import HASH
+from formspree.app import DB, redis_store
+from formspree.forms.helpers import HASH, SITEWIDE_RESULT_KEY, SITEWIDE_QUEUE_KEY, \
+                                    SITEWIDE_PENDING_KEY
+from formspree.forms import sitewide
 from formspree.users.models import User, Email
 from formspree.forms.models import Form, Submission
 
@@ -263,3 +265,172 @@ class TestFormCreationFromDashboard(FormspreeTestCase):
                              'sitewide': 'true'})
         )
         resp = json.loads(r.data)
+
+    def register_upgraded_user(self):
+        self.client.post('/register',
+            data={'email': 'user@formspree.io',
+                  'password': 'banana'}
+        )
+        user = User.query.filter_by(email='user@formspree.io').first()
+        user.upgraded = True
+        DB.session.add(user)
+        email = Email()
+        email.address = 'myemail@email.com'
+        email.owner_id = user.id
+        DB.session.add(email)
+        DB.session.commit()
+
+    @httpretty.activate
+    def test_sitewide_check_cache(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        fetches = []
+        def verify_file(request, uri, headers):
+            fetches.append(request.headers.get('If-None-Match'))
+            if request.headers.get('If-None-Match') == '"v1"':
+                return (304, headers, '')
+            headers['ETag'] = '"v1"'
+            return (200, headers, 'other_email@forms.com\nmyemail@email.com')
+        httpretty.register_uri(httpretty.GET, 'http://mysite.com/formspree-verify.txt',
+                               body=verify_file)
+
+        self.register_upgraded_user()
+        check = '/forms/sitewide-check?email=%s&url=http://mysite.com/contact'
+
+        # fetched once, then answered from the cache
+        self.assertEqual(self.client.get(check % 'myemail@email.com').status_code, 200)
+        self.assertEqual(self.client.get(check % 'myemail@email.com').status_code, 200)
+        self.assertEqual(fetches, [None])
+
+        # once the result expires the file is revalidated, not downloaded again
+        redis_store.delete(SITEWIDE_RESULT_KEY(url='http://mysite.com/formspree-verify.txt',
+                                               email='myemail@email.com'))
+        self.assertEqual(self.client.get(check % 'myemail@email.com').status_code, 200)
+        self.assertEqual(fetches, [None, '"v1"'])
+
+        # other emails are checked against the same file
+        self.assertEqual(self.client.get(check % 'nobody@email.com').status_code, 404)
+        self.assertEqual(fetches, [None, '"v1"', '"v1"'])
+
+    @httpretty.activate
+    def test_sitewide_check_in_background(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+        httpretty.register_uri(httpretty.GET, 'http://mysite.com/formspree-verify.txt',
+                               body='myemail@email.com')
+        httpretty.register_uri(httpretty.GET, 'http://naive.com/formspree-verify.txt',
+                               body='other_email@forms.com')
+
+        self.register_upgraded_user()
+        settings.SITEWIDE_CHECK_ASYNC = True
+        try:
+            for url in ['http://mysite.com', 'http://naive.com']:
+                r = self.client.post('/forms',
+                    headers={'Accept': 'application/json', 'Content-type': 'application/json'},
+                    data=json.dumps({'email': 'myemail@email.com',
+                                     'url': url,
+                                     'sitewide': 'true'})
+                )
+                self.assertEqual(r.status_code, 200)
+                self.assertTrue(json.loads(r.data)['pending'])
+        finally:
+            settings.SITEWIDE_CHECK_ASYNC = False
+
+        # created right away, but not usable yet
+        self.assertFalse(any(req.method == 'GET' for req in httpretty.HTTPretty.latest_requests))
+        self.assertEqual(2, Form.query.count())
+        for form in Form.query.all():
+            self.assertTrue(form.disabled)
+            self.assertIsNone(form.host)
+
+        # the worker enables the verified form
+        self.assertTrue(sitewide.process(timeout=1))
+        form = Form.query.order_by(Form.id).first()
+        self.assertEqual(form.host, 'mysite.com')
+        self.assertTrue(form.sitewide)
+        self.assertFalse(form.disabled)
+        self.assertTrue(form.confirmed)
+
+        # and drops the other
+        self.assertFalse(sitewide.process(timeout=1))
+        self.assertEqual(1, Form.query.count())
+        self.assertIsNone(sitewide.process(timeout=1))
+
+    @httpretty.activate
+    def test_sitewide_check_retried_when_the_site_is_down(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+        httpretty.register_uri(httpretty.GET, 'http://mysite.com/formspree-verify.txt',
+                               status=503, body='down for maintenance')
+
+        self.register_upgraded_user()
+        settings.SITEWIDE_CHECK_ASYNC = True
+        old_delay = settings.SITEWIDE_CHECK_RETRY_DELAY
+        settings.SITEWIDE_CHECK_RETRY_DELAY = 0
+        try:
+            self.client.post('/forms',
+                headers={'Accept': 'application/json', 'Content-type': 'application/json'},
+                data=json.dumps({'email': 'myemail@email.com',
+                                 'url': 'http://mysite.com',
+                                 'sitewide': 'true'})
+            )
+
+            # the form is kept and checked again
+            self.assertIsNone(sitewide.process(timeout=1))
+            self.assertEqual(1, Form.query.count())
+            job = json.loads(redis_store.lindex(SITEWIDE_QUEUE_KEY, 0))
+            self.assertEqual(job['attempts'], 1)
+
+            # until the file can be read
+            httpretty.register_uri(httpretty.GET, 'http://mysite.com/formspree-verify.txt',
+                                   body='myemail@email.com')
+            self.assertTrue(sitewide.process(timeout=1))
+            form = Form.query.first()
+            self.assertEqual(form.host, 'mysite.com')
+            self.assertFalse(form.disabled)
+        finally:
+            settings.SITEWIDE_CHECK_ASYNC = False
+            settings.SITEWIDE_CHECK_RETRY_DELAY = old_delay
+
+    @httpretty.activate
+    def test_sitewide_check_given_up(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+        httpretty.register_uri(httpretty.GET, 'http://mysite.com/formspree-verify.txt',
+                               status=503, body='down for maintenance')
+
+        self.register_upgraded_user()
+        settings.SITEWIDE_CHECK_ASYNC = True
+        old = settings.SITEWIDE_CHECK_RETRY_DELAY, settings.SITEWIDE_CHECK_MAX_ATTEMPTS
+        settings.SITEWIDE_CHECK_RETRY_DELAY, settings.SITEWIDE_CHECK_MAX_ATTEMPTS = 0, 2
+        try:
+            self.client.post('/forms',
+                headers={'Accept': 'application/json', 'Content-type': 'application/json'},
+                data=json.dumps({'email': 'myemail@email.com',
+                                 'url': 'http://mysite.com',
+                                 'sitewide': 'true'})
+            )
+
+            # the dashboard tells the form is being verified
+            self.assertIsNone(sitewide.process(timeout=1))
+            self.assertIn('Verifying the sitewide form on http://mysite.com',
+                          self.client.get('/dashboard').data)
+
+            # and, after the last attempt, that it couldn't be
+            self.assertFalse(sitewide.process(timeout=1))
+            self.assertEqual(redis_store.llen(SITEWIDE_QUEUE_KEY), 0)
+            form = Form.query.first()
+            self.assertTrue(form.disabled)
+            self.assertIn('Could not verify the sitewide form on http://mysite.com',
+                          self.client.get('/dashboard').data)
+
+            # the owner is told by email
+            sent = httpretty.last_request().parsed_body
+            self.assertEqual(sent['to'], ['user@formspree.io'])
+            self.assertIn('Could not verify', sent['subject'][0])
+
+            # deleting the form forgets it
+            self.client.post('/forms/' + form.hashid + '/delete',
+                headers={'Referer': settings.SERVICE_URL})
+            self.assertEqual(Form.query.count(), 0)
+            self.assertEqual(redis_store.hlen(SITEWIDE_PENDING_KEY), 0)
+        finally:
+            settings.SITEWIDE_CHECK_ASYNC = False
+            settings.SITEWIDE_CHECK_RETRY_DELAY, settings.SITEWIDE_CHECK_MAX_ATTEMPTS = old
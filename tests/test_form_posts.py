@@ -1,8 +1,13 @@
 import httpretty
+import json
+import time
+import threading
+import datetime
 
 from formspree import settings
-from formspree.app import DB
-from formspree.forms.models import Form
+from formspree.app import DB, redis_store
+from formspree.forms.helpers import MONTHLY_COUNTER_KEY, PENDING_COUNTERS_KEY
+from formspree.forms.models import Form, Submission
 from formspree.users.models import User, Email
 
 from formspree_test_case import FormspreeTestCase
@@ -237,3 +242,287 @@ class FormPostsTestCase(FormspreeTestCase):
         )
         self.assertEqual(r.status_code, 200)
         self.assertIn('noah', httpretty.last_request().body)
+
+    def test_monthly_counter_quota(self):
+        form = Form('luke@example.com', 'example.com')
+        DB.session.add(form)
+        DB.session.commit()
+
+        self.assertEqual(settings.MONTHLY_SUBMISSIONS_LIMIT, 2)
+        self.assertEqual(form.increase_monthly_counter(), (1, False))
+        self.assertEqual(form.increase_monthly_counter(), (2, False))
+        self.assertEqual(form.increase_monthly_counter(), (3, True))
+        self.assertEqual(form.get_monthly_counter(), 3)
+        self.assertEqual(Form.get_monthly_counters([form]), [3])
+
+        key = MONTHLY_COUNTER_KEY(form_id=form.id, month=datetime.date.today().month)
+        self.assertGreater(redis_store.ttl(key), 0)
+
+    @httpretty.activate
+    def test_hard_overlimit_rejects_before_writing(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('luke@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+
+        # 25 overlimit notifications were already sent this month
+        key = MONTHLY_COUNTER_KEY(form_id=form.id, month=datetime.date.today().month)
+        redis_store.set(key, settings.MONTHLY_SUBMISSIONS_LIMIT + 25)
+
+        for _ in range(2):
+            r = self.client.post('/luke@example.com',
+                headers=ajax_headers,
+                data={'name': 'peter'}
+            )
+            self.assertEqual(r.status_code, 200)
+            self.assertIn('over quota', r.data)
+            self.assertTrue(Form.is_hard_overlimit(form.id))
+
+        # nothing was stored or sent
+        form = Form.query.first()
+        self.assertEqual(form.counter, 0)
+        self.assertEqual(form.submissions.count(), 0)
+        self.assertFalse(httpretty.has_request())
+
+        # the flag only lasts until the owner upgrades, once that is committed
+        user = User('luke@example.com', 'banana')
+        user.upgraded = True
+        DB.session.add(user)
+        DB.session.commit()
+        DB.session.add(Email(address='luke@example.com', owner_id=user.id))
+        DB.session.flush()
+        self.assertTrue(Form.is_hard_overlimit(form.id))
+        DB.session.rollback()
+        self.assertTrue(Form.is_hard_overlimit(form.id))
+
+        DB.session.add(Email(address='luke@example.com', owner_id=user.id))
+        DB.session.commit()
+        self.assertFalse(Form.is_hard_overlimit(form.id))
+
+    def test_upgraded_flag_follows_controllers(self):
+        form = Form('luke@example.com', 'example.com')
+        DB.session.add(form)
+        DB.session.commit()
+        self.assertFalse(form.upgraded)
+
+        user = User('luke@example.com', 'banana')
+        user.upgraded = True
+        DB.session.add(user)
+        DB.session.commit()
+        self.assertFalse(Form.query.get(form.id).upgraded) # not a controller yet
+
+        # becoming a controller through a verified email
+        form.set_hard_overlimit()
+        DB.session.add(Email(address='luke@example.com', owner_id=user.id))
+        DB.session.commit()
+        self.assertTrue(Form.query.get(form.id).upgraded)
+        self.assertFalse(Form.is_hard_overlimit(form.id))
+
+        # downgrading
+        user.upgraded = False
+        DB.session.add(user)
+        DB.session.commit()
+        self.assertFalse(Form.query.get(form.id).upgraded)
+
+        # forms created for an upgraded owner start upgraded
+        user.upgraded = True
+        DB.session.add(user)
+        other = Form('other@example.com', 'example.com')
+        other.owner_id = user.id
+        DB.session.add(other)
+        DB.session.commit()
+        self.assertTrue(Form.query.get(other.id).upgraded)
+
+        # and so do the ones created by submissions to their email
+        self.assertTrue(Form.get_or_create('luke@example.com', 'other.com').upgraded)
+        DB.session.commit()
+        self.assertTrue(Form(email='luke@example.com', owner=user).upgraded)
+
+    @httpretty.activate
+    def test_counter_write_behind(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('luke@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+
+        settings.COUNTER_WRITE_BEHIND = True
+        try:
+            for name in ['peter', 'ana']:
+                r = self.client.post('/luke@example.com',
+                    headers=ajax_headers,
+                    data={'name': name}
+                )
+                self.assertEqual(r.status_code, 200)
+
+            # the row wasn't touched, but the merged value is right
+            form = Form.query.first()
+            self.assertEqual(form.counter, 0)
+            self.assertEqual(form.total_counter, 2)
+            self.assertEqual(Form.total_counters([form]), {form.id: 2})
+
+            self.assertEqual(Form.flush_counters(), 1)
+            form = Form.query.first()
+            self.assertEqual(form.counter, 2)
+            self.assertEqual(form.total_counter, 2)
+
+            # nothing left to flush, nor in the buffer
+            self.assertFalse(redis_store.hexists(PENDING_COUNTERS_KEY, form.id))
+            self.assertEqual(Form.flush_counters(), 0)
+            self.assertEqual(Form.query.first().counter, 2)
+        finally:
+            settings.COUNTER_WRITE_BEHIND = False
+
+    @httpretty.activate
+    def test_batch_submissions(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('luke@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+        batch_url = '/%s/batch' % form.hashid
+        default_limit = settings.MONTHLY_SUBMISSIONS_LIMIT
+        settings.MONTHLY_SUBMISSIONS_LIMIT = 10
+
+        def post_batch(body):
+            return self.client.post(batch_url,
+                headers=ajax_headers,
+                content_type='application/json',
+                data=json.dumps(body)
+            )
+
+        # one invalid submission rejects the whole batch
+        r = post_batch([{'name': 'peter'}, {}, {'_replyto': 'not an address'}])
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual([i['index'] for i in json.loads(r.data)['invalid']], [1, 2])
+        self.assertEqual(Submission.query.count(), 0)
+
+        # a combined batch is stored at once and delivered in one email
+        sent = len(httpretty.HTTPretty.latest_requests)
+        r = post_batch([{'name': 'peter'}, {'name': 'ana', '_gotcha': 'spam'}, {'name': 'joe'}])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests) - sent, 1)
+        self.assertIn('2 new submissions', httpretty.last_request().parsed_body['subject'][0])
+        self.assertEqual(Submission.query.count(), 2)
+        self.assertEqual(Form.query.get(form.id).counter, 2)
+        self.assertEqual(form.get_monthly_counter(), 2)
+
+        # individual delivery sends one email each
+        sent = len(httpretty.HTTPretty.latest_requests)
+        r = post_batch({'delivery': 'individual', 'submissions': [
+            {'name': 'mary', '_subject': 'first'},
+            {'name': 'carl', '_subject': 'second'}
+        ]})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests) - sent, 2)
+        self.assertEqual(httpretty.last_request().parsed_body['subject'][0], 'second')
+        self.assertEqual(Form.query.get(form.id).counter, 4)
+
+        # batches are capped
+        r = post_batch([{'name': 'x'}] * (settings.BATCH_SUBMISSIONS_LIMIT + 1))
+        self.assertEqual(r.status_code, 413)
+
+        # and come from the confirmed host only
+        r = self.client.post(batch_url,
+            headers={'Referer': 'other.com'},
+            content_type='application/json',
+            data=json.dumps([{'name': 'x'}])
+        )
+        self.assertEqual(r.status_code, 403)
+        self.assertEqual(Submission.query.count(), 4)
+
+        settings.MONTHLY_SUBMISSIONS_LIMIT = default_limit
+
+    @httpretty.activate
+    def test_digest_delivery(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('luke@example.com', 'example.com')
+        form.confirmed = True
+        form.digest = 'daily'
+        DB.session.add(form)
+        DB.session.commit()
+        default_limit = settings.MONTHLY_SUBMISSIONS_LIMIT
+        settings.MONTHLY_SUBMISSIONS_LIMIT = 10
+
+        sent = len(httpretty.HTTPretty.latest_requests)
+        for name in ['peter', 'ana', 'joe']:
+            r = self.client.post('/luke@example.com',
+                headers=ajax_headers,
+                data={'name': name}
+            )
+            self.assertEqual(r.status_code, 200)
+
+        # submissions are archived and counted, but not emailed
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), sent)
+        self.assertEqual(Submission.query.count(), 3)
+        self.assertEqual(Form.query.get(form.id).counter, 3)
+
+        # only the digests for the form's period are sent
+        self.assertEqual(Form.send_digests('hourly'), 0)
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), sent)
+
+        self.assertEqual(Form.send_digests('daily'), 1)
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), sent + 1)
+        body = httpretty.last_request().parsed_body
+        self.assertEqual(body['subject'][0], '3 new submissions from example.com')
+        for name in ['peter', 'ana', 'joe']:
+            self.assertIn(name, body['text'][0])
+
+        # nothing is left for the next one
+        self.assertEqual(Form.send_digests('daily'), 0)
+
+        # digests are capped, the rest is only counted
+        settings.DIGEST_MAX_SUBMISSIONS = 1
+        try:
+            for name in ['mary', 'carl']:
+                self.client.post('/luke@example.com',
+                    headers=ajax_headers,
+                    data={'name': name}
+                )
+            self.assertEqual(Form.query.get(form.id).send_digest(), 2)
+            text = httpretty.last_request().parsed_body['text'][0]
+            self.assertIn('mary', text)
+            self.assertNotIn('carl', text)
+            self.assertIn('Only the first 1 are listed here', text)
+        finally:
+            settings.DIGEST_MAX_SUBMISSIONS = 200
+            settings.MONTHLY_SUBMISSIONS_LIMIT = default_limit
+
+    @httpretty.activate
+    def test_concurrent_first_submissions(self):
+        def slow_sendgrid(request, uri, headers):
+            # keep the confirmation in flight while the other submissions arrive
+            time.sleep(0.2)
+            return (200, headers, '{"message": "success"}')
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json',
+                               body=slow_sendgrid)
+
+        go = threading.Event()
+        statuses = []
+
+        def submit(i):
+            client = self.app.test_client()
+            go.wait()
+            r = client.post('/alice@example.com',
+                headers=ajax_headers,
+                data={'name': 'alice %s' % i}
+            )
+            statuses.append(r.status_code)
+
+        threads = [threading.Thread(target=submit, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        go.set()
+        for t in threads:
+            t.join()
+
+        # one form, one confirmation, and every submitter is told it was sent
+        self.assertEqual(statuses, [200] * 8)
+        self.assertEqual(Form.query.count(), 1)
+        self.assertTrue(Form.query.first().confirm_sent)
+        self.assertEqual(len(httpretty.HTTPretty.latest_requests), 1)
@@ -0,0 +1,55 @@
+import time
+import httpretty
+import mock
+import structlog
+
+from flask import g, render_template
+
+from formspree import outbound, instrumentation
+from formspree.app import redis_store
+from formspree.forms.models import Form
+
+from formspree_test_case import FormspreeTestCase
+
+
+class InstrumentationTestCase(FormspreeTestCase):
+    @httpretty.activate
+    def test_components_are_timed(self):
+        httpretty.register_uri(httpretty.GET, 'https://example.com/formspree-verify.txt')
+
+        with self.app.test_request_context('/'):
+            g.timings = {}
+            Form.query.count()
+            redis_store.set('a', 1)
+            pipe = redis_store.pipeline()
+            pipe.get('a')
+            pipe.get('b')
+            pipe.execute()
+            outbound.get('https://example.com/formspree-verify.txt')
+            render_template('email/overlimit-notification.txt', host='example.com')
+
+            self.assertEqual(g.timings['db'][1], 1)
+            self.assertEqual(g.timings['redis'][1], 2)
+            self.assertEqual(g.timings['http'][1], 1)
+            self.assertEqual(g.timings['template'][1], 1)
+            for spent, calls in g.timings.values():
+                self.assertGreaterEqual(spent, 0)
+
+    def test_queue_time(self):
+        started = time.time()
+        received = int(started * 1000) - 250
+        with self.app.test_request_context('/', headers={'X-Request-Start': str(received)}):
+            self.assertAlmostEqual(instrumentation.queue_time(started), 250, delta=1)
+        with self.app.test_request_context('/', headers={'X-Request-Start': 't=%s' % (received * 1000)}):
+            self.assertAlmostEqual(instrumentation.queue_time(started), 250, delta=1)
+        with self.app.test_request_context('/'):
+            self.assertIsNone(instrumentation.queue_time(started))
+
+    def test_one_line_per_request(self):
+        with mock.patch.object(structlog.PrintLogger, 'info') as info:
+            self.client.get('/')
+        lines = [call[0][0] for call in info.call_args_list if 'Request timings.' in call[0][0]]
+        self.assertEqual(len(lines), 1)
+        for field in ['TOTAL_MS', 'QUEUE_MS', 'DB_MS', 'DB_CALLS', 'REDIS_MS',
+                      'HTTP_CALLS', 'TEMPLATE_MS', 'TEMPLATE_CALLS']:
+            self.assertIn(field, lines[0])
@@ -0,0 +1,89 @@
+import httpretty
+import requests
+import structlog
+
+from flask import g
+
+from formspree import settings, mailqueue
+from formspree.app import DB
+from formspree.utils import deliver_email
+from formspree.forms.models import Form
+
+from formspree_test_case import FormspreeTestCase
+
+
+class MailQueueTestCase(FormspreeTestCase):
+    def setUp(self):
+        super(MailQueueTestCase, self).setUp()
+        settings.MAIL_QUEUE = True
+        g.log = structlog.get_logger()
+
+    def tearDown(self):
+        settings.MAIL_QUEUE = False
+        super(MailQueueTestCase, self).tearDown()
+
+    @httpretty.activate
+    def test_submissions_are_delivered_by_the_worker(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        # the confirmation goes through the queue too
+        self.client.post('/alice@example.com',
+            headers={'referer': 'http://somewhere.com'},
+            data={'name': 'john'}
+        )
+        self.assertFalse(httpretty.has_request())
+        self.assertEqual(mailqueue.stats()['depth'], 1)
+        self.assertTrue(Form.query.first().confirm_sent)
+
+        form = Form.query.first()
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+
+        r = self.client.post('/alice@example.com',
+            headers={'referer': 'http://somewhere.com'},
+            data={'name': 'johann'}
+        )
+        self.assertEqual(r.status_code, 302)
+        self.assertFalse(httpretty.has_request())
+        self.assertEqual(mailqueue.stats()['depth'], 2)
+        self.assertGreaterEqual(mailqueue.stats()['age'], 0)
+
+        # the worker delivers them in order
+        self.assertTrue(mailqueue.process(deliver_email, timeout=1)[0])
+        self.assertIn('confirm+your+email', httpretty.last_request().body)
+        self.assertTrue(mailqueue.process(deliver_email, timeout=1)[0])
+        self.assertIn('johann', httpretty.last_request().body)
+
+        self.assertEqual(mailqueue.stats(), {'depth': 0, 'age': 0})
+        self.assertIsNone(mailqueue.process(deliver_email, timeout=1))
+
+    @httpretty.activate
+    def test_failed_deliveries_are_retried(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json',
+                               status=503, body='down')
+
+        self.client.post('/alice@example.com',
+            headers={'referer': 'http://somewhere.com'},
+            data={'name': 'john'}
+        )
+        for attempt in range(settings.MAIL_QUEUE_MAX_ATTEMPTS - 1):
+            self.assertFalse(mailqueue.process(deliver_email, timeout=1)[0])
+            self.assertEqual(mailqueue.stats()['depth'], 1)
+
+        # the last attempt drops the message
+        self.assertFalse(mailqueue.process(deliver_email, timeout=1)[0])
+        self.assertEqual(mailqueue.stats()['depth'], 0)
+
+    def test_unreachable_server_is_retried(self):
+        def unreachable(message):
+            raise requests.ConnectionError('connection refused')
+
+        mailqueue.enqueue({'to': 'alice@example.com', 'subject': 'hi'})
+
+        # the message isn't lost, and the worker keeps going
+        self.assertFalse(mailqueue.process(unreachable, timeout=1)[0])
+        self.assertEqual(mailqueue.stats()['depth'], 1)
+        for attempt in range(settings.MAIL_QUEUE_MAX_ATTEMPTS - 1):
+            mailqueue.process(unreachable, timeout=1)
+        self.assertEqual(mailqueue.stats()['depth'], 0)
@@ -0,0 +1,61 @@
+import httpretty
+
+from formspree import settings
+from formspree.app import DB
+from formspree.forms.models import Form
+
+from formspree_test_case import FormspreeTestCase
+
+
+class MetricsTestCase(FormspreeTestCase):
+    def create_app(self):
+        settings.METRICS = True
+        settings.METRICS_TOKEN = 'sekret'
+        return super(MetricsTestCase, self).create_app()
+
+    def tearDown(self):
+        settings.METRICS = False
+        settings.METRICS_TOKEN = None
+        super(MetricsTestCase, self).tearDown()
+
+    def metrics(self):
+        r = self.client.get('/metrics', headers={'Authorization': 'Bearer sekret'})
+        self.assertEqual(r.status_code, 200)
+        return dict(line.rsplit(' ', 1) for line in r.data.splitlines()
+                    if not line.startswith('#'))
+
+    def test_token_required(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics?token=wrong').status_code, 401)
+        self.assertEqual(self.client.get('/metrics?token=sekret').status_code, 200)
+
+    @httpretty.activate
+    def test_submission_metrics(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        form = Form('bob@example.com', 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+
+        for _ in range(2):
+            self.client.post('/bob@example.com',
+                headers={'Referer': 'http://example.com'},
+                data={'name': 'alice'}
+            )
+
+        metrics = self.metrics()
+        self.assertEqual(metrics['formspree_submissions_total{status="email_sent"}'], '2')
+        self.assertEqual(metrics['formspree_request_duration_seconds_count{endpoint="send",status="302"}'], '2')
+        self.assertEqual(metrics['formspree_request_duration_seconds_bucket{endpoint="send",le="+Inf",status="302"}'], '2')
+        self.assertEqual(metrics['formspree_outbound_duration_seconds_count{host="api.sendgrid.com",status="200"}'], '2')
+        self.assertGreater(float(metrics['formspree_request_duration_seconds_sum{endpoint="send",status="302"}']), 0)
+
+        # buckets are cumulative and listed in order
+        r = self.client.get('/metrics?token=sekret')
+        buckets = [line for line in r.data.splitlines()
+                   if line.startswith('formspree_request_duration_seconds_bucket{endpoint="send"')]
+        self.assertEqual(len(buckets), 12)
+        self.assertIn('le="+Inf"', buckets[-1])
+        counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+        self.assertEqual(counts, sorted(counts))
@@ -0,0 +1,48 @@
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from formspree import outbound
+
+from formspree_test_case import FormspreeTestCase
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class OutboundSessionTestCase(FormspreeTestCase):
+    def test_connections_are_reused(self):
+        server = Server(('127.0.0.1', 0), KeepAliveHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = 'http://127.0.0.1:%s/formspree-verify.txt' % server.server_port
+
+        try:
+            before = outbound.stats()
+            for _ in range(3):
+                self.assertEqual(outbound.get(url, timeout=2).text, 'ok')
+            after = outbound.stats()
+        finally:
+            outbound.session().close()
+            server.shutdown()
+            server.server_close()
+
+        self.assertIs(outbound.session(), outbound.session())
+        self.assertEqual(after['requests'] - before['requests'], 3)
+        self.assertEqual(after['connections'] - before['connections'], 1)
+        self.assertEqual(after['reused'] - before['reused'], 2)
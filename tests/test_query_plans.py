@@ -0,0 +1,59 @@
+from formspree.app import DB
+from formspree.forms.models import Form, Submission
+from formspree.users.models import User, Email
+
+from formspree_test_case import FormspreeTestCase
+
+
+class QueryPlansTestCase(FormspreeTestCase):
+    '''
+    The test tables are tiny and have no statistics, so sequential and
+    bitmap scans are disabled to see which indexes the planner would
+    pick for the hot queries.
+    '''
+
+    def setUp(self):
+        super(QueryPlansTestCase, self).setUp()
+
+        user = User('luke@example.com', 'banana')
+        DB.session.add(user)
+        DB.session.commit()
+        DB.session.add(Email(address='luke@example.com', owner_id=user.id))
+        form = Form('luke@example.com', 'example.com')
+        form.owner_id = user.id
+        DB.session.add(form)
+        DB.session.commit()
+        DB.session.add(Submission(form.id))
+        DB.session.commit()
+
+        self.user = user
+        self.form = form
+        DB.session.execute('SET enable_seqscan = off')
+        DB.session.execute('SET enable_bitmapscan = off')
+
+    def plan(self, query):
+        statement = query.statement.compile(DB.engine)
+        rows = DB.session.connection().execute('EXPLAIN ' + str(statement), statement.params)
+        return '\n'.join(row[0] for row in rows)
+
+    def test_submissions_by_form(self):
+        plan = self.plan(self.form.submissions.limit(10))
+        self.assertIn('ix_submissions_form_id_id', plan)
+        self.assertNotIn('Sort', plan) # the index already gives the order
+
+    def test_forms_by_email_and_host(self):
+        # either index will do here
+        plan = self.plan(Form.query.filter_by(email='luke@example.com', host='example.com'))
+        self.assertRegexpMatches(plan, 'Index Scan using ix_forms_(email_)?host ')
+
+        plan = self.plan(Form.query.filter_by(email='luke@example.com'))
+        self.assertIn('ix_forms_email_host', plan)
+
+        plan = self.plan(Form.query.filter_by(host='example.com'))
+        self.assertIn('ix_forms_host', plan)
+
+    def test_forms_of_user(self):
+        plan = self.plan(self.user.forms)
+        self.assertIn('ix_forms_owner_id', plan)
+        self.assertIn('ix_emails_owner_id', plan)
+        self.assertIn('ix_forms_email_host', plan)
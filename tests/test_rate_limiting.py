@@ -3,7 +3,7 @@ import httpretty
 from formspree import settings
 from formspree.app import DB
 from formspree.forms.models import Form
-from formspree_test_case import FormspreeTestCase
+from formspree_test_case import FormspreeTestCase, rlredis
 
 
 class RateLimitingTestCase(FormspreeTestCase):
@@ -39,3 +39,45 @@ class RateLimitingTestCase(FormspreeTestCase):
         # should have gotten some 302 and then many 429 responses
         self.assertLessEqual(replies.count(302), limit)
         self.assertGreaterEqual(replies.count(429), 900-limit)
+
+    @httpretty.activate
+    def test_local_rate_limiting(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        old = (settings.LOCAL_RATE_LIMIT_IP_BURST, settings.LOCAL_RATE_LIMIT_IP_PER_MINUTE,
+               settings.LOCAL_RATE_LIMIT_FORM_BURST, settings.LOCAL_RATE_LIMIT_FORM_PER_MINUTE)
+        settings.LOCAL_RATE_LIMIT_IP_BURST, settings.LOCAL_RATE_LIMIT_IP_PER_MINUTE = 5, 0
+        settings.LOCAL_RATE_LIMIT_FORM_BURST, settings.LOCAL_RATE_LIMIT_FORM_PER_MINUTE = 3, 0
+        try:
+            # static pages are turned away locally, without touching redis
+            replies = [self.client.get('/thanks').status_code for _ in range(8)]
+            self.assertEqual(replies, [200] * 5 + [429] * 3)
+            self.assertEqual(rlredis.keys(), [])
+
+            # a form gets its own bucket, shared by every address posting to it
+            # (and however its email is spelled)
+            replies = [self.client.post(['/bob@example.com', '/Bob@Example.com'][i % 2],
+                headers={'referer': 'http://somewhere.com',
+                         'X-Forwarded-For': '10.0.0.%s' % i},
+                data={'name': 'attacker'}
+            ).status_code for i in range(5)]
+            self.assertEqual(replies[3:], [429, 429])
+            self.assertNotIn(429, replies[:3])
+
+            # the same email on another site is another form
+            r = self.client.post('/bob@example.com',
+                headers={'referer': 'http://elsewhere.com',
+                         'X-Forwarded-For': '10.0.0.8'},
+                data={'name': 'john'}
+            )
+            self.assertNotEqual(r.status_code, 429)
+
+            r = self.client.post('/carl@example.com',
+                headers={'referer': 'http://somewhere.com',
+                         'X-Forwarded-For': '10.0.0.9'},
+                data={'name': 'john'}
+            )
+            self.assertNotEqual(r.status_code, 429)
+        finally:
+            (settings.LOCAL_RATE_LIMIT_IP_BURST, settings.LOCAL_RATE_LIMIT_IP_PER_MINUTE,
+             settings.LOCAL_RATE_LIMIT_FORM_BURST, settings.LOCAL_RATE_LIMIT_FORM_PER_MINUTE) = old
@@ -0,0 +1,163 @@
+import httpretty
+import json
+
+from formspree import settings
+from formspree.app import DB
+from formspree.forms.models import Form, Suppression
+from formspree.utils import send_email
+
+from formspree_test_case import FormspreeTestCase
+
+ajax_headers = {
+    'Referer': 'http://example.com',
+    'X_REQUESTED_WITH': 'xmlhttprequest'
+}
+
+
+class SuppressionsTestCase(FormspreeTestCase):
+    def setUp(self):
+        super(SuppressionsTestCase, self).setUp()
+        settings.SENDGRID_WEBHOOK_TOKEN = 'webhook-token'
+
+    def tearDown(self):
+        settings.SENDGRID_WEBHOOK_TOKEN = None
+        super(SuppressionsTestCase, self).tearDown()
+
+    def confirmed_form(self, email):
+        form = Form(email, 'example.com')
+        form.confirmed = True
+        DB.session.add(form)
+        DB.session.commit()
+        return form
+
+    def post_events(self, events, token='webhook-token'):
+        return self.client.post('/webhooks/sendgrid?token=' + token,
+            content_type='application/json',
+            data=json.dumps(events)
+        )
+
+    def sendgrid_calls(self, path='/api/mail.send.json'):
+        return [r for r in httpretty.HTTPretty.latest_requests if r.path.startswith(path)]
+
+    @httpretty.activate
+    def test_webhook_and_sending(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        self.assertEqual(self.post_events([], token='wrong').status_code, 401)
+
+        r = self.post_events([
+            {'email': 'Bob@example.com', 'event': 'bounce', 'type': 'bounce',
+             'reason': '550 5.1.1 The email account does not exist.'},
+            {'email': 'carl@example.com', 'event': 'bounce', 'type': 'blocked',
+             'reason': '421 try again later'},
+            {'email': 'dan@example.com', 'event': 'spamreport'},
+            {'email': 'ana@example.com', 'event': 'delivered'},
+        ])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(sorted(s.address for s in Suppression.query),
+                         ['bob@example.com', 'dan@example.com'])
+        self.assertIn('does not exist', Suppression.reason_for('bob@example.com'))
+
+        # the same events again don't duplicate anything
+        self.post_events([{'email': 'bob@example.com', 'event': 'bounce', 'type': 'bounce',
+                           'reason': 'bounced again'}])
+        self.assertEqual(Suppression.query.count(), 2)
+        self.assertEqual(Suppression.reason_for('bob@example.com'), 'bounced again')
+
+        # nothing is sent to suppressed addresses
+        self.confirmed_form('bob@example.com')
+        r = self.client.post('/bob@example.com',
+            headers=ajax_headers,
+            data={'name': 'alice'}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.sendgrid_calls(), [])
+
+        # and they are left out of cc, however they are spelled
+        self.confirmed_form('ana@example.com')
+        self.client.post('/ana@example.com',
+            headers=ajax_headers,
+            data={'name': 'alice', '_cc': 'Dan@Example.com, Eve@Example.com'}
+        )
+        self.assertEqual(len(self.sendgrid_calls()), 1)
+        self.assertEqual(httpretty.last_request().parsed_body['cc'], ['Eve@Example.com'])
+
+        # also when sending to them directly
+        self.assertEqual(send_email(to='BOB@example.com', subject='hi', text='hi',
+                                    sender=settings.DEFAULT_SENDER), (True, '', 200))
+        self.assertEqual(len(self.sendgrid_calls()), 1)
+
+        # the redis copy can be rebuilt from the table
+        self.assertEqual(Suppression.reload(), 2)
+        self.assertEqual(Suppression.reason_for('dan@example.com'), 'spamreport')
+
+    @httpretty.activate
+    def test_resend_and_unblock(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/bounces.delete.json',
+                               body='{"message": "success"}')
+        httpretty.register_uri(httpretty.POST, 'https://www.google.com/recaptcha/api/siteverify',
+                               body='{"success": true}')
+
+        form = Form('bob@example.com', 'example.com')
+        form.confirm_sent = True
+        DB.session.add(form)
+        DB.session.commit()
+        self.post_events([{'email': 'bob@example.com', 'event': 'bounce', 'type': 'bounce',
+                           'reason': 'mailbox full'}])
+
+        # the resend page tells the bounce reason, without asking SendGrid
+        r = self.client.post('/resend/bob@example.com',
+            headers={'Accept': 'application/json'},
+            data={'host': 'example.com', 'g-recaptcha-response': 'ok'}
+        )
+        self.assertEqual(json.loads(r.data)['reason'], 'mailbox full')
+        self.assertEqual(self.sendgrid_calls('/api/bounces'), [])
+
+        # unblocking is local too, SendGrid's list is cleared later
+        r = self.client.post('/unblock/bob@example.com',
+            data={'g-recaptcha-response': 'ok'}
+        )
+        self.assertIn('Successfully unblocked', r.data)
+        self.assertIsNone(Suppression.reason_for('bob@example.com'))
+        self.assertEqual(Suppression.query.count(), 0)
+        self.assertEqual(self.sendgrid_calls('/api/bounces'), [])
+
+        self.assertEqual(Suppression.sync_unblocks(), 1)
+        self.assertEqual(len(self.sendgrid_calls('/api/bounces.delete.json')), 1)
+
+        # and the confirmation can be sent again
+        r = self.client.post('/resend/bob@example.com',
+            headers={'Accept': 'application/json'},
+            data={'host': 'example.com', 'g-recaptcha-response': 'ok'}
+        )
+        self.assertEqual(json.loads(r.data), {'success': "confirmation email sent"})
+        self.assertEqual(len(self.sendgrid_calls()), 1)
+
+    @httpretty.activate
+    def test_resend_and_unblock_without_webhook(self):
+        httpretty.register_uri(httpretty.GET, 'https://api.sendgrid.com/api/bounces.get.json',
+                               body='[{"email": "bob@example.com", "reason": "mailbox full"}]')
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/bounces.delete.json',
+                               body='{"message": "success"}')
+        httpretty.register_uri(httpretty.POST, 'https://www.google.com/recaptcha/api/siteverify',
+                               body='{"success": true}')
+        settings.SENDGRID_WEBHOOK_TOKEN = None
+
+        form = Form('bob@example.com', 'example.com')
+        form.confirm_sent = True
+        DB.session.add(form)
+        DB.session.commit()
+
+        # SendGrid's bounce list is asked right away
+        r = self.client.post('/resend/bob@example.com',
+            headers={'Accept': 'application/json'},
+            data={'host': 'example.com', 'g-recaptcha-response': 'ok'}
+        )
+        self.assertEqual(json.loads(r.data)['reason'], 'mailbox full')
+
+        r = self.client.post('/unblock/bob@example.com',
+            data={'g-recaptcha-response': 'ok'}
+        )
+        self.assertIn('Successfully unblocked', r.data)
+        self.assertEqual(len(self.sendgrid_calls('/api/bounces.delete.json')), 1)
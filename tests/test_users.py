@@ -1,10 +1,16 @@
+import time
 import httpretty
 import json
+import mock
 import stripe
+from sqlalchemy import event
 
 from formspree import settings
-from formspree.app import DB
+from formspree.app import DB, redis_store
 from formspree.forms.helpers import HASH
+from formspree.users import cache as user_cache
+from formspree.users.helpers import USER_SNAPSHOT_KEY, PasswordHashingBusy, \
+                                    check_password, hash_pwd, needs_rehash
 from formspree.users.models import User, Email
 from formspree.forms.models import Form, Submission
 
@@ -501,3 +507,170 @@ class UserAccountsTestCase(FormspreeTestCase):
         
         # delete the customer
         customer.delete()
+
+    @httpretty.activate
+    def test_account_page_uses_stripe_snapshot(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        # every Stripe call is answered below, any key will do
+        patcher = mock.patch.object(stripe, 'api_key', 'sk_test_snapshot')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        def card(id, last4):
+            return {'id': id, 'object': 'card', 'brand': 'Visa', 'last4': last4,
+                    'exp_month': 11, 'exp_year': 2026, 'funding': 'credit',
+                    'country': 'US', 'cvc_check': 'pass', 'customer': 'cus_test'}
+
+        def stripe_customer(cards):
+            httpretty.register_uri(httpretty.GET, 'https://api.stripe.com/v1/customers/cus_test',
+                body=json.dumps({
+                    'id': 'cus_test', 'object': 'customer', 'default_source': 'card_1',
+                    'subscriptions': {'object': 'list', 'url': '/v1/customers/cus_test/subscriptions',
+                                      'data': [{'id': 'sub_1', 'object': 'subscription',
+                                                'current_period_end': 1800000000,
+                                                'cancel_at_period_end': False}]},
+                    'sources': {'object': 'list', 'url': '/v1/customers/cus_test/sources', 'data': []}
+                }))
+            httpretty.register_uri(httpretty.GET, 'https://api.stripe.com/v1/customers/cus_test/sources',
+                body=json.dumps({'object': 'list', 'url': '/v1/customers/cus_test/sources',
+                                 'data': cards}))
+
+        def stripe_calls():
+            return [r for r in httpretty.HTTPretty.latest_requests if '/v1/' in r.path]
+
+        self.client.post('/register',
+            data={'email': 'maria@example.com',
+                  'password': 'uva'}
+        )
+        user = User.query.filter_by(email='maria@example.com').first()
+        user.upgraded = True
+        user.stripe_id = 'cus_test'
+        DB.session.add(user)
+        DB.session.commit()
+        stripe_customer([card('card_1', '4242')])
+
+        # the first view fetches the customer, the next ones don't
+        r = self.client.get('/account')
+        self.assertIn('4242', r.data)
+        self.assertIn('will automatically renew', r.data)
+        self.assertEqual(len(stripe_calls()), 2)
+
+        r = self.client.get('/account')
+        self.assertIn('4242', r.data)
+        self.assertEqual(len(stripe_calls()), 2)
+
+        # a card added on Stripe shows up after the webhook
+        stripe_customer([card('card_1', '4242'), card('card_2', '1881')])
+        r = self.client.post('/webhooks/stripe', data=json.dumps({
+            'type': 'customer.source.created',
+            'data': {'object': card('card_2', '1881')}
+        }), headers={'Content-type': 'application/json'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(stripe_calls()), 4)
+
+        r = self.client.get('/account')
+        self.assertIn('1881', r.data)
+        self.assertEqual(len(stripe_calls()), 4)
+
+    @httpretty.activate
+    def test_cached_user_loader(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        queries = []
+        def count_users_query(conn, cursor, statement, *args):
+            if 'FROM users' in statement:
+                queries.append(statement)
+        event.listen(DB.engine, 'before_cursor_execute', count_users_query)
+
+        try:
+            self.client.post('/register',
+                data={'email': 'maria@example.com',
+                      'password': 'uva'}
+            )
+            user = User.query.filter_by(email='maria@example.com').first()
+            key = USER_SNAPSHOT_KEY(id=user.id)
+
+            # the first page load caches the user, the next ones don't query it
+            self.client.get('/account')
+            self.assertTrue(redis_store.get(key))
+            DB.session.remove()
+            del queries[:]
+            r = self.client.get('/account')
+            self.assertIn('maria@example.com', r.data)
+            self.assertEqual(queries, [])
+        finally:
+            event.remove(DB.engine, 'before_cursor_execute', count_users_query)
+
+        # the cached user still works as a normal one
+        DB.session.remove()
+        cached = user_cache.get(user.id)
+        self.assertTrue(check_password(cached.password, 'uva'))
+        self.assertEqual(cached.emails.count(), 0)
+
+        # and is dropped when it changes
+        cached.upgraded = True
+        DB.session.commit()
+        self.assertIsNone(redis_store.get(key))
+        DB.session.remove()
+        self.assertTrue(user_cache.get(user.id).upgraded)
+        self.assertTrue(redis_store.get(key))
+
+    def test_password_hashing_past_the_deadline(self):
+        hashed = hash_pwd('canada')
+        started = time.time()
+        clock = iter([started])
+
+        # a job that only starts once the deadline has passed
+        with mock.patch('formspree.users.helpers.time.time',
+                        lambda: next(clock, started + settings.PASSWORD_HASH_TIMEOUT + 1)):
+            self.assertRaises(PasswordHashingBusy, hash_pwd, 'canada')
+        clock = iter([started])
+        with mock.patch('formspree.users.helpers.time.time',
+                        lambda: next(clock, started + settings.PASSWORD_HASH_TIMEOUT + 1)):
+            self.assertRaises(PasswordHashingBusy, check_password, hashed, 'canada')
+
+    @httpretty.activate
+    def test_password_rehash_on_login(self):
+        httpretty.register_uri(httpretty.POST, 'https://api.sendgrid.com/api/mail.send.json')
+
+        old_method = settings.PASSWORD_HASH_METHOD
+        settings.PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+        try:
+            self.client.post('/register',
+                data={'email': 'alice@springs.com',
+                      'password': 'canada'}
+            )
+            self.client.get('/logout')
+            user = User.query.filter_by(email='alice@springs.com').first()
+            self.assertTrue(user.password.startswith('pbkdf2:sha256:1000$'))
+
+            # a cheaper or costlier method is applied at the next login
+            settings.PASSWORD_HASH_METHOD = 'pbkdf2:sha256:2000'
+            r = self.client.post('/login',
+                data={'email': 'alice@springs.com',
+                      'password': 'canada'}
+            )
+            self.assertTrue(r.location.endswith('/dashboard'))
+            DB.session.remove()
+            user = User.query.filter_by(email='alice@springs.com').first()
+            self.assertTrue(user.password.startswith('pbkdf2:sha256:2000$'))
+            self.assertTrue(check_password(user.password, 'canada'))
+
+            # but not after a failed one
+            settings.PASSWORD_HASH_METHOD = 'pbkdf2:sha256:3000'
+            self.client.get('/logout')
+            self.client.post('/login',
+                data={'email': 'alice@springs.com',
+                      'password': 'wrong'}
+            )
+            DB.session.remove()
+            user = User.query.filter_by(email='alice@springs.com').first()
+            self.assertTrue(user.password.startswith('pbkdf2:sha256:2000$'))
+
+            # a method without iterations means werkzeug's default
+            settings.PASSWORD_HASH_METHOD = 'pbkdf2:sha256'
+            self.assertTrue(needs_rehash(user.password))
+            self.assertFalse(needs_rehash(hash_pwd('canada')))
+        finally:
+            settings.PASSWORD_HASH_METHOD = old_method